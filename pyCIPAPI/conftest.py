@@ -12,6 +12,23 @@ def pytest_addoption(parser):
     parser.addoption(
         "--jpconfig", action="store", type=read_config, help="JellyPy config ini file"
     )
+    parser.addoption(
+        "--benchmarks", action="store_true", help="Run the throughput benchmarks in test/test_benchmarks.py"
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmarks: throughput benchmark, only run with --benchmarks")
+
+
+def pytest_collection_modifyitems(config, items):
+    # Benchmarks take a while, so they are left out of the default run
+    if config.getoption("--benchmarks"):
+        return
+    skip_benchmarks = pytest.mark.skip(reason="benchmarks only run with --benchmarks")
+    for item in items:
+        if "benchmarks" in item.keywords:
+            item.add_marker(skip_benchmarks)
 
 @pytest.fixture
 def jpconfig(request):
@@ -0,0 +1,305 @@
+"""Asyncio client for the GEL CIP API.
+
+Requires the optional aiohttp package (pip install jellypy_pyCIPAPI[async]).
+"""
+from __future__ import print_function
+
+import asyncio
+from datetime import datetime, timedelta
+
+import jwt
+from jwt.exceptions import DecodeError, ExpiredSignatureError, InvalidTokenError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .auth_credentials import auth_credentials
+from .codec import loads
+from .config import (beta_testing_auth_url, beta_testing_base_url, circuit_breaker_failures, connection_pool_size,
+                     live_100K_auth_url, live_100k_data_base_url, rate_limit_per_second, retry_attempts,
+                     token_refresh_minutes, use_active_directory)
+from .interpretation_requests import _remaining_page_urls
+from .summary_findings import _json_dict
+from .transport import (FAILURE_STATUS_CODES, IDEMPOTENT_METHODS, RETRY_STATUS_CODES, CircuitBreaker, CircuitOpenError,
+                        TokenBucket, parse_retry_after, retry_delay)
+
+
+class AsyncCIPAPIClient(object):
+    """Authenticated asyncio client for the GEL CIP API.
+
+    Mirrors the blocking functions in interpretation_requests and
+    summary_findings as coroutines. All tasks using a client share its token,
+    which is refreshed once (under an asyncio lock) when it is within
+    token_refresh_minutes of expiring, and at most max_concurrency requests
+    are in flight at a time. Requests are retried, rate limited and circuit
+    broken as by the blocking sessions (see transport.py). Use the client as
+    an async context manager so its connections are closed:
+
+        async with AsyncCIPAPIClient() as client:
+            irjsons = await client.get_interpretation_request_jsons([(12345, 1), (12346, 1)])
+    """
+
+    def __init__(self, testing_on=False, token=None, auth_credentials=auth_credentials, max_concurrency=100):
+        """Init AsyncCIPAPIClient. Authentication happens on the first request.
+
+        Args:
+            testing_on (bool): Use the beta CIP-API rather than live.
+            token (str): Optional pre-authorised JWT token.
+            auth_credentials (dict): Credentials in the format used by
+                auth.AuthenticatedCIPAPISession.
+            max_concurrency (int): Maximum number of requests in flight.
+        """
+        if aiohttp is None:
+            raise ImportError('The asyncio client requires the aiohttp package. '
+                              'Install it with: pip install aiohttp')
+        if testing_on and not use_active_directory:
+            raise ValueError(
+                "LDAP login no longer supported for testing. Please set use_active_directory to True in config.py"
+            )
+        self.testing_on = testing_on
+        self.token_supplied = bool(token)
+        self.auth_credentials = auth_credentials
+        self.max_concurrency = max_concurrency
+        self.base_url = beta_testing_base_url if testing_on else live_100k_data_base_url
+        if use_active_directory:
+            self.cip_auth_url = beta_testing_auth_url if testing_on else live_100K_auth_url
+        else:
+            self.cip_auth_url = live_100k_data_base_url + 'get-token/'
+        self.headers = {}
+        self.auth_time = False
+        self.session = None
+        self.rate_limiter = TokenBucket(rate_limit_per_second) if rate_limit_per_second else None
+        self.circuit_breaker = CircuitBreaker() if circuit_breaker_failures else None
+        if token:
+            self.update_token(token)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        """Create the connection pool, lock and semaphore on the running event loop."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=max(self.max_concurrency, connection_pool_size))
+            self.session = aiohttp.ClientSession(connector=connector)
+            self._auth_lock = asyncio.Lock()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def close(self):
+        """Close the client's connections."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def update_token(self, token):
+        """Use a user supplied JWT token, raising an exception if it is invalid or has expired."""
+        try:
+            decoded_token = jwt.decode(token, verify=False)
+            self.headers["Authorization"] = "JWT " + token
+            self.auth_time = datetime.fromtimestamp(decoded_token['orig_iat'])
+            self.auth_expires = datetime.fromtimestamp(decoded_token['exp'])
+        except (InvalidTokenError, DecodeError, ExpiredSignatureError, KeyError):
+            self.auth_time = False
+            raise Exception('Invalid or expired JWT token')
+        if self._token_expiring():
+            raise Exception('JWT token has expired')
+        return self
+
+    async def authenticate(self):
+        """Get a new token using auth_credentials, from AD or the legacy LDAP get-token endpoint."""
+        try:
+            if use_active_directory:
+                if self.testing_on:
+                    auth = aiohttp.BasicAuth(self.auth_credentials['beta_client_id'],
+                                             self.auth_credentials['beta_client_secret'])
+                else:
+                    auth = aiohttp.BasicAuth(self.auth_credentials['client_id'],
+                                             self.auth_credentials['client_secret'])
+                async with self.session.post(self.cip_auth_url, data="grant_type=client_credentials",
+                                             auth=auth) as response:
+                    auth_response = loads(await response.read())
+                self.headers["Authorization"] = "JWT " + auth_response['access_token']
+                self.auth_time = datetime.fromtimestamp(int(auth_response['not_before']))
+                self.auth_expires = datetime.fromtimestamp(int(auth_response['expires_on']))
+            else:
+                async with self.session.post(self.cip_auth_url, data={
+                        "username": self.auth_credentials['username'],
+                        "password": self.auth_credentials['password']}) as response:
+                    token = loads(await response.read())['token']
+                decoded_token = jwt.decode(token, verify=False)
+                self.headers["Authorization"] = "JWT " + token
+                self.auth_time = datetime.fromtimestamp(decoded_token['orig_iat'])
+                self.auth_expires = datetime.fromtimestamp(decoded_token['exp'])
+        except KeyError:
+            self.auth_time = False
+            raise Exception('Authentication Error')
+        return self
+
+    async def check_auth(self):
+        """Re-authenticate if the token is about to expire, once for all tasks waiting on the client."""
+        if self._token_expiring():
+            async with self._auth_lock:
+                # Another task may have refreshed the token while we waited for the lock
+                if not self._token_expiring():
+                    return self
+                if self.token_supplied:
+                    raise Exception('JWT token has expired')
+                self.headers.pop('Authorization', None)
+                await self.authenticate()
+        return self
+
+    def _token_expiring(self):
+        return not self.auth_time or datetime.now() > self.auth_expires - timedelta(minutes=token_refresh_minutes)
+
+    async def request(self, method, url, raise_for_status=False, not_found=False, **kwargs):
+        """Send an authenticated request, waiting for a free slot if max_concurrency requests are in flight.
+
+        Idempotent requests which fail with a connection error, timeout or
+        transient status code are retried with jittered exponential backoff,
+        honouring any Retry-After header.
+
+        Args:
+            method (str): HTTP method.
+            url (str): URL to request.
+            raise_for_status (bool): Raise aiohttp.ClientResponseError for error status codes.
+            not_found (bool): Return (404, None) for a 404 response rather than parsing its body.
+            **kwargs: Additional aiohttp request arguments (eg params, json).
+
+        Returns:
+            (status, body): The response status code and parsed json body.
+            Raises ValueError if the body is not json.
+        """
+        await self.open()
+        retries = retry_attempts if method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            await self.check_auth()
+            async with self._semaphore:
+                if self.rate_limiter is not None:
+                    await asyncio.sleep(self.rate_limiter.reserve())
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.before_request()
+                recorded = False
+                try:
+                    async with self.session.request(method, url, headers=self.headers, **kwargs) as response:
+                        self._record(response.status not in FAILURE_STATUS_CODES)
+                        recorded = True
+                        if response.status not in RETRY_STATUS_CODES or attempt == retries:
+                            if not_found and response.status == 404:
+                                return response.status, None
+                            if raise_for_status:
+                                response.raise_for_status()
+                            return response.status, loads(await response.read())
+                        delay = retry_delay(attempt, retry_after=parse_retry_after(response.headers.get('Retry-After')))
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == retries:
+                        raise
+                    delay = retry_delay(attempt)
+                finally:
+                    # Any error before the response arrived is a failure, so a half-open trial always ends
+                    if not recorded:
+                        self._record(False)
+            # Wait outside the semaphore so other requests can use the slot
+            await asyncio.sleep(delay)
+
+    def _record(self, success):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(success)
+
+    async def get_interpretation_request_json(self, ir_id, ir_version, reports_v6=True):
+        """Get an interpretation request as a json."""
+        status, interpretation_request = await self.request(
+            'GET', self.base_url + 'interpretation-request/{}/{}/'.format(ir_id, ir_version),
+            params={'reports_v6': str(reports_v6)})
+        return interpretation_request
+
+    async def get_interpretation_request_jsons(self, ir_ids, reports_v6=True):
+        """Get many interpretation requests as json concurrently.
+
+        Args:
+            ir_ids: Iterable of (ir_id, ir_version) tuples.
+            reports_v6 (bool): Request the reports v6 version of the data.
+
+        Returns:
+            List of (ir_id, ir_version, interpretation_request) tuples in the
+            order of ir_ids. interpretation_request is None if the download
+            failed.
+
+        Raises:
+            CircuitOpenError: If the circuit breaker stopped any of the downloads.
+        """
+        ir_ids = list(ir_ids)
+        results = await asyncio.gather(*[self.get_interpretation_request_json(ir_id, ir_version, reports_v6)
+                                         for ir_id, ir_version in ir_ids], return_exceptions=True)
+        output = []
+        for (ir_id, ir_version), result in zip(ir_ids, results):
+            # The server is failing, so report that rather than a None for every case
+            if isinstance(result, CircuitOpenError):
+                raise result
+            if isinstance(result, Exception):
+                print('Unable to get interpretation request {}-{}: {}'.format(ir_id, ir_version, result))
+                result = None
+            output.append((ir_id, ir_version, result))
+        return output
+
+    async def get_interpretation_request_list(self, page_size=100, minimize=True, **filters):
+        """Get a list of interpretation requests.
+
+        Once the first page shows the total number of results the remaining
+        pages are downloaded concurrently.
+
+        Args:
+            page_size (int): Number of results per page.
+            minimize (bool): Request the minimal representation of each case.
+            **filters: List filters as for
+                interpretation_requests.get_interpretation_request_list (eg
+                sample_type='raredisease', last_status='sent_to_gmcs').
+
+        Returns:
+            List of interpretation requests.
+        """
+        params = {key: str(value) for key, value in dict(filters, page_size=page_size, minimize=minimize).items()
+                  if value is not None}
+        status, page = await self.request('GET', self.base_url + 'interpretation-request', params=params)
+        interpretation_requests = list(page['results'])
+        page_urls = _remaining_page_urls(page)
+        if page_urls is None:
+            # Unable to compute the page URLs up front so follow the next links
+            while page.get('next'):
+                status, page = await self.request('GET', page['next'])
+                interpretation_requests.extend(page['results'])
+            return interpretation_requests
+        pages = await asyncio.gather(*[self.request('GET', page_url) for page_url in page_urls])
+        for status, page in pages:
+            interpretation_requests.extend(page['results'])
+        return interpretation_requests
+
+    async def get_interpreted_genome_for_case(self, ir, version, tiering_service):
+        """Get the last interpreted genome from tiering_service for a case, or None if there isn't one."""
+        request_url = self.base_url + 'interpreted-genome/{ir}/{ver}/{service}/last/?reports_v6=true'.format(
+            ir=ir, ver=version, service=tiering_service)
+        status, interpreted_genome = await self.request('GET', request_url, raise_for_status=True, not_found=True)
+        if status == 404:
+            print('No {service} analysis for {ir}-{ver}'.format(service=tiering_service, ir=ir, ver=version))
+        return interpreted_genome
+
+    async def post_cr(self, ir_json_v6, clinical_report):
+        """Submit a clinical report (aka summary of findings), see summary_findings.post_cr."""
+        cr_endpoint = "clinical-report/genomics_england_tiering/raredisease/{ir_id}/?reports_v6=true".format(
+            ir_id=ir_json_v6.get('case_id'))
+        status, response = await self.request('POST', self.base_url + cr_endpoint, raise_for_status=True,
+                                              json=_json_dict(clinical_report))
+        return response
+
+    async def put_eq(self, exit_questionnaire, ir_id, ir_version, clinical_report_version=1):
+        """Submit an exit questionnaire, see summary_findings.put_eq."""
+        eq_endpoint = "exit-questionnaire/{ir_id}/{ir_version}/{clinical_report_version}/?reports_v6=true".format(
+            ir_id=ir_id, ir_version=ir_version, clinical_report_version=clinical_report_version)
+        status, response = await self.request('PUT', self.base_url + eq_endpoint, raise_for_status=True,
+                                              json=_json_dict(exit_questionnaire))
+        return response
@@ -1,7 +1,9 @@
 """Objects for authenticating with the GEL CIP API."""
 
 import json
+import time
 from datetime import datetime, timedelta
+from threading import Lock
 
 import jwt
 import maya
@@ -10,14 +12,59 @@ from jwt.exceptions import (DecodeError, ExpiredSignatureError,
                             InvalidTokenError)
 
 from .auth_credentials import auth_credentials
-from .config import beta_testing_auth_url, live_100K_auth_url, live_100k_data_base_url, use_active_directory
+from .config import (beta_testing_auth_url, connection_pool_size, live_100K_auth_url, live_100k_data_base_url,
+                     token_refresh_minutes, use_active_directory)
+from .metrics import default_metrics, request_bytes, response_bytes
+from .transport import make_adapter
+
+# Shared sessions keyed by (testing_on, token, credentials). See get_cipapi_session().
+_cipapi_sessions = {}
+_cipapi_sessions_lock = Lock()
+# Shared openCGA session. See get_opencga_session().
+_opencga_session = None
+_opencga_session_lock = Lock()
+
+
+class InstrumentedSession(requests.Session):
+    """Subclass of requests Session which records the latency and size of every request in a Metrics object."""
+
+    def __init__(self, metrics=None):
+        """
+        Args:
+            metrics (Metrics): Where to record requests, defaults to metrics.default_metrics.
+        """
+        requests.Session.__init__(self)
+        self.metrics = metrics if metrics is not None else default_metrics
+        # The adapter retries transient failures, rate limits and stops sending to a failing server. Keep a larger
+        # pool of keep-alive connections so that threads sharing this session reuse TLS connections.
+        adapter = make_adapter(connection_pool_size, metrics=self.metrics)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def endpoint(self, url):
+        """Label to record requests to url under, or None to derive it from the URL."""
+        return None
+
+    def request(self, method, url, *args, **kwargs):
+        """Send a request, recording its latency, status and size."""
+        start = time.perf_counter()
+        try:
+            response = requests.Session.request(self, method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            self.metrics.observe_request(method, url, None, time.perf_counter() - start, endpoint=self.endpoint(url))
+            raise
+        self.metrics.observe_request(method, url, response.status_code, time.perf_counter() - start,
+                                     bytes_sent=request_bytes(response.request),
+                                     bytes_received=response_bytes(response, stream=kwargs.get('stream', False)),
+                                     endpoint=self.endpoint(url))
+        return response
 
 
 # get an authenticated session
-class AuthenticatedCIPAPISession(requests.Session):
+class AuthenticatedCIPAPISession(InstrumentedSession):
     """Subclass of requests Session for authenticating against GEL CIPAPI."""
 
-    def __init__(self, testing_on=False, token=None, auth_credentials=auth_credentials):
+    def __init__(self, testing_on=False, token=None, auth_credentials=auth_credentials, metrics=None):
         """Init AuthenticatedCIPAPISession and run authenticate function.
 
         Authentication credentials are stored in auth_credentials.py and are in
@@ -25,9 +72,14 @@ class AuthenticatedCIPAPISession(requests.Session):
 
         auth_credentials = {"username": "username", "password": "password"}
 
+        Requests are recorded in metrics (defaults to metrics.default_metrics).
         """
-        requests.Session.__init__(self)
+        InstrumentedSession.__init__(self, metrics=metrics)
         self.auth_credentials = auth_credentials
+        self.testing_on = testing_on
+        self.token_supplied = bool(token)
+        self.auth_time = False
+        self._auth_lock = Lock()
         self.set_auth_url(testing_on=testing_on)
         if token:
             self.update_token(token)
@@ -56,7 +108,7 @@ class AuthenticatedCIPAPISession(requests.Session):
             raise
 
         # Check whether the token has expired
-        if datetime.now() > self.auth_expires - timedelta(minutes=10):
+        if datetime.now() > self.auth_expires - timedelta(minutes=token_refresh_minutes):
             raise Exception('JWT token has expired')
         else:
             pass
@@ -145,11 +197,78 @@ class AuthenticatedCIPAPISession(requests.Session):
             self.authenticate_ldap()
         return self
 
+    def check_auth(self):
+        """Re-authenticate if the session token is about to expire.
+
+        Sessions created with a user supplied token cannot be refreshed, so an
+        exception is raised once that token is within token_refresh_minutes of
+        expiring.
+
+        Returns:
+            The current instance of AuthenticatedCIPAPISession.
+        """
+        if not self.auth_time or datetime.now() > self.auth_expires - timedelta(minutes=token_refresh_minutes):
+            with self._auth_lock:
+                # Another thread may have refreshed the token while we waited for the lock
+                if self.auth_time and datetime.now() <= self.auth_expires - timedelta(minutes=token_refresh_minutes):
+                    return self
+                if self.token_supplied:
+                    raise Exception('JWT token has expired')
+                self.headers.pop('Authorization', None)
+                self.authenticate(testing_on=self.testing_on)
+        return self
 
-class AuthenticatedOpenCGASession(requests.Session):
+    def endpoint(self, url):
+        """Record token requests as 'auth' rather than under the AD tenant URL."""
+        return 'auth' if url == self.cip_auth_url else None
+
+    def request(self, method, url, *args, **kwargs):
+        """Send a request, refreshing the token first if it is about to expire."""
+        if url != self.cip_auth_url:
+            self.check_auth()
+        return InstrumentedSession.request(self, method, url, *args, **kwargs)
+
+
+def get_cipapi_session(testing_on=False, token=None, auth_credentials=auth_credentials):
+    """Get a shared AuthenticatedCIPAPISession for this process.
+
+    One session is kept per combination of testing_on, token and
+    auth_credentials, so repeated calls reuse the same token and pooled
+    keep-alive connections rather than authenticating again. The token is
+    refreshed automatically before it expires.
+
+    Args:
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        auth_credentials (dict): Credentials in the format used by
+            AuthenticatedCIPAPISession.
+
+    Returns:
+        session: Authenticated AuthenticatedCIPAPISession.
+    """
+    credentials_key = tuple(sorted(auth_credentials.items())) if auth_credentials else None
+    key = (bool(testing_on), token, credentials_key)
+    with _cipapi_sessions_lock:
+        session = _cipapi_sessions.get(key)
+        if session is None:
+            session = AuthenticatedCIPAPISession(testing_on=testing_on, token=token,
+                                                 auth_credentials=auth_credentials)
+            _cipapi_sessions[key] = session
+    return session.check_auth()
+
+
+def clear_cipapi_sessions():
+    """Close and forget all shared sessions created by get_cipapi_session()."""
+    with _cipapi_sessions_lock:
+        for session in _cipapi_sessions.values():
+            session.close()
+        _cipapi_sessions.clear()
+
+
+class AuthenticatedOpenCGASession(InstrumentedSession):
     """Subclass of requests Session for accessing GEL openCGA instance."""
 
-    def __init__(self):
+    def __init__(self, metrics=None):
         """Init AuthenticatedOpenCGASession and run authenticate function.
 
         Authentication credentials are stored in auth_credentials.py and are in
@@ -157,8 +276,9 @@ class AuthenticatedOpenCGASession(requests.Session):
 
         auth_credentials = {"username": "username", "password": "password"}
 
+        Requests are recorded in metrics (defaults to metrics.default_metrics).
         """
-        requests.Session.__init__(self)
+        InstrumentedSession.__init__(self, metrics=metrics)
         self.host_url = ('https://apps.genomicsengland.nhs.uk/opencga/'
                          'webservices/rest/v1')
         self.authenticate()
@@ -193,8 +313,23 @@ class AuthenticatedOpenCGASession(requests.Session):
         return self
 
     def check_auth(self, testing_on=False):
-        """Check whether the session is still authenticated."""
-        if maya.now() > self.auth_expires():
-            self.authenticate(testing_on=testing_on)
-        else:
-            pass
+        """Check whether the session is still authenticated, re-authenticating if not."""
+        if not self.auth_time or maya.now() > self.auth_expires:
+            self.authenticate()
+        return self
+
+
+def get_opencga_session():
+    """Get a shared AuthenticatedOpenCGASession for this process.
+
+    The session is created on first use and re-authenticated when its
+    session ID expires, so repeated openCGA lookups reuse one login.
+
+    Returns:
+        session: Authenticated AuthenticatedOpenCGASession.
+    """
+    global _opencga_session
+    with _opencga_session_lock:
+        if _opencga_session is None:
+            _opencga_session = AuthenticatedOpenCGASession()
+        return _opencga_session.check_auth()
@@ -0,0 +1,172 @@
+"""Persistent on-disk cache for CIP-API json documents."""
+from __future__ import print_function
+
+import os
+import sqlite3
+import time
+import zlib
+from threading import Lock
+
+from .codec import dumps, loads
+from .config import cache_max_bytes, cache_path
+from .metrics import default_metrics
+
+# Number of cache hits whose access times are held in memory before they are written to the database
+ACCESS_FLUSH_SIZE = 1000
+
+
+class ContentCache(object):
+    """Size-bounded, compressed SQLite cache of json documents.
+
+    Each entry is stored against a key identifying the request that produced
+    it (for example the endpoint URL and query parameters) along with an
+    optional validator string, such as the last_modified value of the case in
+    the interpretation request list. An entry is only returned if the
+    validator supplied on lookup matches the one it was stored with, so
+    cases which have changed since they were cached are fetched again. When
+    the compressed size of all entries exceeds max_bytes the least recently
+    used entries are evicted.
+
+    Hits don't write to the database: their access times are buffered and
+    written in one transaction by the next put, by close, or once
+    ACCESS_FLUSH_SIZE hits are waiting, so close the cache when done with
+    it (or use it as a context manager). The total size of the entries is
+    kept in memory, and only counted again when it says the cache is full.
+    """
+
+    def __init__(self, path=cache_path, max_bytes=cache_max_bytes, metrics=None):
+        """Open (creating if required) the cache database at path.
+
+        Args:
+            path (str): Path to the SQLite cache file.
+            max_bytes (int): Maximum total size of compressed entries.
+            metrics (Metrics): Where to record hits and misses, defaults to
+                metrics.default_metrics.
+        """
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.metrics = metrics if metrics is not None else default_metrics
+        self._lock = Lock()
+        # The connection is shared by threads using the cache, guarded by self._lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, validator TEXT, data BLOB NOT NULL, '
+                         'size INTEGER NOT NULL, last_access REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)')
+        self._db.commit()
+        # Access times of hits not yet written to the database, keyed by cache key
+        self._accessed = {}
+        self._total = self._size()
+
+    def get(self, key, validator=None):
+        """Return the cached document for key, or None if missing or stale.
+
+        Args:
+            key (str): Cache key.
+            validator (str): If given, the entry is only returned if it was
+                stored with the same validator.
+
+        Returns:
+            The cached json document, or None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT validator, data FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or (validator is not None and row[0] != validator):
+                self.misses += 1
+                self.metrics.record_cache('content_cache', False)
+                return None
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_accessed()
+                self._db.commit()
+            self.hits += 1
+        self.metrics.record_cache('content_cache', True)
+        return loads(zlib.decompress(row[1]))
+
+    def put(self, key, document, validator=None):
+        """Compress and store a json document, evicting old entries if the cache is full.
+
+        Args:
+            key (str): Cache key.
+            document: json serialisable document to store.
+            validator (str): Optional validator to store with the entry.
+        """
+        data = zlib.compress(dumps(document))
+        with self._lock:
+            # Eviction uses the access times of recent hits
+            self._flush_accessed()
+            row = self._db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO entries (key, validator, data, size, last_access) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (key, validator, sqlite3.Binary(data), len(data), time.time()))
+            self._total += len(data) - (row[0] if row else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """Delete least recently used entries until the cache is within max_bytes. Call with the lock held."""
+        if self._total <= self.max_bytes:
+            return
+        # Count again in case another process sharing the cache file has added or evicted entries
+        self._total = self._size()
+        if self._total <= self.max_bytes:
+            return
+        for key, size in self._db.execute('SELECT key, size FROM entries ORDER BY last_access').fetchall():
+            self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self._total -= size
+            if self._total <= self.max_bytes:
+                break
+
+    def _flush_accessed(self):
+        """Write the buffered access times of hits. Call with the lock held."""
+        if self._accessed:
+            self._db.executemany('UPDATE entries SET last_access = ? WHERE key = ?',
+                                 [(last_access, key) for key, last_access in self._accessed.items()])
+            self._accessed.clear()
+
+    def _size(self):
+        """Total compressed size of the entries in the database."""
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def clear(self):
+        """Delete all entries from the cache."""
+        with self._lock:
+            self._accessed.clear()
+            self._db.execute('DELETE FROM entries')
+            self._db.commit()
+            self._total = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Write the access times of recent hits and close the cache database."""
+        with self._lock:
+            self._flush_accessed()
+            self._db.commit()
+            self._db.close()
+
+
+def case_validator(case):
+    """Make a cache validator from an entry in the interpretation request list.
+
+    Args:
+        case: Interpretation request from get_interpretation_request_list.
+
+    Returns:
+        validator (str): String which changes whenever the case is modified.
+    """
+    return '{}|{}'.format(case.get('last_modified'), case.get('last_status'))
@@ -0,0 +1,219 @@
+"""Local snapshot of the interpretation request list, kept up to date incrementally."""
+from __future__ import print_function
+
+import datetime
+import json
+import os
+import sqlite3
+from itertools import islice
+from threading import Lock
+
+from .codec import dumps_text, loads
+from .config import case_store_path
+from .interpretation_requests import get_interpretation_request_list
+
+# Fields of each case copied into indexed columns of the cases table, see CaseStore.query()
+INDEXED_FIELDS = ('last_status', 'sample_type', 'assembly', 'family_id', 'cip', 'last_modified')
+# Version of the case store schema, stored in the database's user_version
+SCHEMA_VERSION = 1
+# Number of cases written to the store in each transaction by CaseStore.update()
+UPDATE_BATCH_SIZE = 500
+
+
+class CaseStore(object):
+    """SQLite snapshot of the interpretation request list.
+
+    The first sync() downloads the full interpretation request list. Each
+    sync records the date it started as a high-water mark, and later syncs
+    only request cases with an update_date on or after that mark, merging
+    them into the snapshot. A separate high-water mark is kept for each
+    combination of list filters and testing_on. Live and beta cases share
+    interpretation request IDs, so use a separate store for each (see
+    case_store_path and beta_case_store_path in config.py).
+
+    Sites, status, sample type, assembly, family ID, CIP and last modified
+    date are indexed so that query() can select cases without loading and
+    scanning the whole list.
+    """
+
+    def __init__(self, path=case_store_path):
+        """Open (creating if required) the case store database at path.
+
+        Args:
+            path (str): Path to the SQLite case store file.
+        """
+        store_dir = os.path.dirname(path)
+        if store_dir and not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.path = path
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cases ('
+                         'interpretation_request_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS case_sites (site TEXT NOT NULL, '
+                         'interpretation_request_id TEXT NOT NULL, PRIMARY KEY (site, interpretation_request_id))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS case_sites_case ON case_sites (interpretation_request_id)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sync_state (query TEXT PRIMARY KEY, high_water_mark TEXT)')
+        self._upgrade()
+        self._db.commit()
+
+    def _upgrade(self):
+        """Add the indexed columns to a case store created by an earlier version, filling them from the cases."""
+        if self._db.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+        columns = set(row[1] for row in self._db.execute('PRAGMA table_info(cases)'))
+        for field in INDEXED_FIELDS:
+            if field not in columns:
+                self._db.execute('ALTER TABLE cases ADD COLUMN {} TEXT'.format(field))
+            self._db.execute('CREATE INDEX IF NOT EXISTS cases_{0} ON cases ({0})'.format(field))
+        self._index([(loads(data), data) for (data,) in self._db.execute('SELECT data FROM cases').fetchall()])
+        self._db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    def sync(self, full=False, testing_on=False, token=None, session=None, max_workers=8, **filters):
+        """Update the snapshot with cases changed since the last sync.
+
+        Args:
+            full (bool): Ignore the high-water mark and download the full list.
+            testing_on (bool): Use the beta CIP-API rather than live.
+            token (str): Optional pre-authorised JWT token.
+            session: Optional authenticated session, defaults to the shared session.
+            max_workers (int): Maximum number of list pages downloaded at once.
+            **filters: Additional get_interpretation_request_list arguments.
+
+        Returns:
+            count (int): Number of cases added or updated.
+        """
+        query = json.dumps(dict(filters, testing_on=testing_on), sort_keys=True)
+        with self._lock:
+            row = self._db.execute('SELECT high_water_mark FROM sync_state WHERE query = ?', (query,)).fetchone()
+        high_water_mark = None if (full or row is None) else row[0]
+        # Record the mark before listing so that cases updated during the sync are picked up next time
+        sync_started = datetime.date.today().strftime('%Y-%m-%d')
+        cases = get_interpretation_request_list(update_date=high_water_mark, testing_on=testing_on, token=token,
+                                                session=session, stream=True, max_workers=max_workers, **filters)
+        count = self.update(cases)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO sync_state (query, high_water_mark) VALUES (?, ?)',
+                             (query, sync_started))
+            self._db.commit()
+        return count
+
+    def update(self, cases):
+        """Add or replace cases in the snapshot.
+
+        Cases are read from the iterable (which may be downloading list pages
+        as it goes) without holding the store's lock, and written in batches
+        of UPDATE_BATCH_SIZE, so several syncs can download at once.
+
+        Args:
+            cases: Iterable of interpretation requests from the list endpoint.
+
+        Returns:
+            count (int): Number of cases added or updated.
+        """
+        count = 0
+        cases = iter(cases)
+        while True:
+            batch = [(case, dumps_text(case)) for case in islice(cases, UPDATE_BATCH_SIZE)]
+            if not batch:
+                return count
+            with self._lock:
+                self._index(batch)
+                self._db.commit()
+            count += len(batch)
+
+    def _index(self, batch):
+        """Store (case, data) pairs with their indexed fields and sites. Call with the lock held."""
+        # A case listed twice keeps its last entry, as if the cases were stored one at a time
+        batch = list(dict((case['interpretation_request_id'], (case, data)) for case, data in batch).values())
+        self._db.executemany('INSERT OR REPLACE INTO cases (interpretation_request_id, data, {}) VALUES (?, ?, {})'
+                             .format(', '.join(INDEXED_FIELDS), ', '.join('?' * len(INDEXED_FIELDS))),
+                             [[case['interpretation_request_id'], data] + [_text(case.get(field))
+                                                                         for field in INDEXED_FIELDS]
+                              for case, data in batch])
+        self._db.executemany('DELETE FROM case_sites WHERE interpretation_request_id = ?',
+                             [(case['interpretation_request_id'],) for case, data in batch])
+        self._db.executemany('INSERT OR IGNORE INTO case_sites (site, interpretation_request_id) VALUES (?, ?)',
+                             [(site, case['interpretation_request_id'])
+                              for case, data in batch for site in case.get('sites') or []])
+
+    def query(self, sites=None, last_status=None, sample_type=None, assembly=None, family_id=None, cip=None,
+              updated_since=None, updated_before=None):
+        """Select cases from the snapshot using the indexed fields.
+
+        Each filter can be a single value or a list of values, any of which
+        may match. Filters which are None are ignored, so query() with no
+        arguments returns every case.
+
+        Args:
+            sites: ODS codes of sites, matching cases at any of the sites (eg 'RR8').
+            last_status: Case status (eg 'sent_to_gmcs').
+            sample_type: Sample type (eg 'raredisease').
+            assembly: Genome assembly (eg 'GRCh38').
+            family_id: Family ID.
+            cip: CIP name (eg 'omicia').
+            updated_since (str): Only cases last modified on or after this date (YYYY-MM-DD).
+            updated_before (str): Only cases last modified before this date (YYYY-MM-DD).
+
+        Returns:
+            cases (list): Matching cases, ordered by interpretation request ID.
+        """
+        conditions, parameters = [], []
+        for field, values in (('last_status', last_status), ('sample_type', sample_type), ('assembly', assembly),
+                              ('family_id', family_id), ('cip', cip)):
+            if values is not None:
+                values = _values(values)
+                conditions.append('{} IN ({})'.format(field, ', '.join('?' * len(values))))
+                parameters.extend(values)
+        if sites is not None:
+            sites = _values(sites)
+            conditions.append('interpretation_request_id IN (SELECT interpretation_request_id FROM case_sites '
+                              'WHERE site IN ({}))'.format(', '.join('?' * len(sites))))
+            parameters.extend(sites)
+        if updated_since is not None:
+            conditions.append('last_modified >= ?')
+            parameters.append(updated_since)
+        if updated_before is not None:
+            conditions.append('last_modified < ?')
+            parameters.append(updated_before)
+        sql = 'SELECT data FROM cases'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            rows = self._db.execute(sql + ' ORDER BY interpretation_request_id', parameters).fetchall()
+        return [loads(row[0]) for row in rows]
+
+    def get(self, interpretation_request_id):
+        """Return the case with the given interpretation request ID (eg '12345-1'), or None."""
+        with self._lock:
+            row = self._db.execute('SELECT data FROM cases WHERE interpretation_request_id = ?',
+                                   (interpretation_request_id,)).fetchone()
+        return loads(row[0]) if row else None
+
+    def cases(self):
+        """Return a list of every case in the snapshot."""
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM cases').fetchall()
+        return [loads(row[0]) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM cases').fetchone()[0]
+
+    def close(self):
+        """Close the case store database."""
+        with self._lock:
+            self._db.close()
+
+
+def _values(values):
+    """Return a filter value or list of values as a list of strings."""
+    if isinstance(values, (list, tuple, set, frozenset)):
+        return [_text(value) for value in values]
+    return [_text(values)]
+
+
+def _text(value):
+    """Store indexed fields as text so numeric IDs compare equal to query strings."""
+    return None if value is None else str(value)
@@ -0,0 +1,117 @@
+"""JSON encoding and decoding for pyCIPAPI sessions, caches and snapshots.
+
+Documents are decoded straight from response bytes using the fastest
+available backend: orjson (pip install jellypy_pyCIPAPI[fastjson]) or
+msgspec (pip install msgspec) if one is installed, otherwise the standard
+library json module.
+Set json_backend in config.py, or call set_backend(), to choose one.
+"""
+from __future__ import print_function
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from .config import json_backend
+
+# Backends in order of preference
+BACKENDS = ('orjson', 'msgspec', 'json')
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _backend_functions(name):
+    """Return the (loads, dumps, errors) of a backend, where dumps returns UTF-8 bytes."""
+    if name == 'orjson':
+        return orjson.loads, orjson.dumps, (orjson.JSONDecodeError, orjson.JSONEncodeError)
+    if name == 'msgspec':
+        return msgspec.json.decode, msgspec.json.encode, (msgspec.DecodeError, msgspec.EncodeError)
+    return json.loads, _json_dumps, ()
+
+
+def available_backends():
+    """Names of the installed backends, in order of preference."""
+    installed = {'orjson': orjson is not None, 'msgspec': msgspec is not None, 'json': True}
+    return [name for name in BACKENDS if installed[name]]
+
+
+def set_backend(name=None):
+    """Choose the backend used by loads() and dumps().
+
+    Args:
+        name (str): One of BACKENDS, defaults to the first one installed.
+
+    Returns:
+        name (str): The backend now in use.
+    """
+    global _backend, _loads, _dumps, _errors
+    if name is None:
+        name = available_backends()[0]
+    if name not in BACKENDS:
+        raise ValueError('Unknown JSON backend {}, expected one of {}'.format(name, ', '.join(BACKENDS)))
+    if name not in available_backends():
+        raise ImportError('The {0} JSON backend is not installed. Install it with: pip install {0}'.format(name))
+    _loads, _dumps, _errors = _backend_functions(name)
+    _backend = name
+    return name
+
+
+def get_backend():
+    """Name of the backend in use."""
+    return _backend
+
+
+def loads(data):
+    """Decode a JSON document from bytes or str.
+
+    Documents the backend rejects (eg ones containing NaN) are decoded
+    with the standard library instead.
+
+    Raises:
+        ValueError: If data is not valid JSON.
+    """
+    try:
+        return _loads(data)
+    except _errors:
+        return json.loads(data)
+
+
+def dumps(obj):
+    """Encode obj as JSON, returning UTF-8 bytes.
+
+    Objects the backend can't encode (eg dictionaries with non-string keys)
+    are encoded with the standard library instead.
+    """
+    try:
+        return _dumps(obj)
+    except _errors + (TypeError, OverflowError):
+        return _json_dumps(obj)
+
+
+def dumps_text(obj):
+    """Encode obj as a JSON str."""
+    return dumps(obj).decode('utf-8')
+
+
+def response_json(response):
+    """Decode the JSON body of a requests response.
+
+    Raises:
+        ValueError: If the body is not valid JSON, eg it was truncated.
+    """
+    return loads(response.content)
+
+
+_backend = _loads = _dumps = None
+_errors = ()
+set_backend(json_backend)
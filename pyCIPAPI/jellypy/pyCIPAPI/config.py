@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import os
 
 # Configuration file for setting common variables to avoid hard-coding them in code:
 
@@ -12,3 +13,39 @@ beta_testing_auth_url = 'https://login.microsoftonline.com/99515578-fda0-444c-8f
 # CIP-API base URLs for live data and beta testing:
 live_100k_data_base_url = 'https://cipapi.gel.zone/api/2/'
 beta_testing_base_url = 'https://cipapi-beta.genomicsengland.co.uk/api/2/'
+
+# Minutes before a CIP-API token expires at which shared sessions re-authenticate:
+token_refresh_minutes = 10
+
+# Maximum number of pooled keep-alive connections held open per host by each session:
+connection_pool_size = 20
+
+# Location and maximum size (in bytes, after compression) of the on-disk CIP-API content cache:
+cache_path = os.path.join(os.path.expanduser('~'), '.jellypy', 'cipapi_cache.sqlite')
+cache_max_bytes = 5 * 1024 ** 3
+
+# Location of the local snapshots of the live and beta interpretation request lists kept up to date by
+# case_store.CaseStore:
+case_store_path = os.path.join(os.path.expanduser('~'), '.jellypy', 'case_store.sqlite')
+beta_case_store_path = os.path.join(os.path.expanduser('~'), '.jellypy', 'beta_case_store.sqlite')
+
+# Size in bytes of the chunks read from the network and buffered before writing when downloading files from openCGA:
+download_chunk_size = 8 * 1024 * 1024
+
+# Retries of idempotent CIP-API and openCGA requests which fail with a connection error or transient status code. The
+# wait before each retry is random, up to retry_backoff seconds doubling for each retry and capped at retry_max_backoff:
+retry_attempts = 5
+retry_backoff = 1
+retry_max_backoff = 60
+
+# Maximum average number of requests per second sent by each session (None for no limit):
+rate_limit_per_second = None
+
+# Number of consecutive server failures after which a session stops sending requests, and the seconds it waits before
+# trying again (set circuit_breaker_failures to None to disable):
+circuit_breaker_failures = 10
+circuit_breaker_reset_seconds = 60
+
+# JSON backend used to decode responses and encode caches and snapshots: 'orjson', 'msgspec' or 'json' (None for the
+# fastest one installed):
+json_backend = None
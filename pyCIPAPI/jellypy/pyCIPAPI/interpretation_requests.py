@@ -2,26 +2,162 @@
 from __future__ import print_function
 
 import datetime
-import json
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from math import ceil
 from time import strptime
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 
-from .auth import AuthenticatedCIPAPISession
+from requests.exceptions import ConnectionError, HTTPError, RequestException, Timeout
+
+from .auth import get_cipapi_session
+from .codec import dumps, response_json
 from .config import beta_testing_base_url, live_100k_data_base_url
+from .transport import RETRY_STATUS_CODES, CircuitOpenError
+
+def get_interpretation_request_json(ir_id, ir_version, reports_v6=True, testing_on=False, token=None, session=None,
+                                    cache=None, validator=None):
+    """Get an interpretation request as a json.
 
-def get_interpretation_request_json(ir_id, ir_version, reports_v6=True, testing_on=False, token=None, session=None):
-    """Get an interpretation request as a json."""
-    s = session if session else AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    If a ContentCache is given it is checked before downloading, and the
+    downloaded json is stored in it. Pass the validator from
+    cache.case_validator() so cases modified since they were cached are
+    downloaded again.
+    """
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
     payload = {
         'reports_v6': reports_v6
     }
     # Use the correct url if using beta dataset for testing (imported form config.py):
+    request_url = _interpretation_request_url(ir_id, ir_version, testing_on)
+    cache_key = '{}?reports_v6={}'.format(request_url, reports_v6)
+    if cache is not None:
+        interpretation_request = cache.get(cache_key, validator)
+        if interpretation_request is not None:
+            return interpretation_request
+
+    r = s.get(request_url, params=payload)
+    interpretation_request = response_json(r)
+    if cache is not None and r.status_code == 200:
+        cache.put(cache_key, interpretation_request, validator)
+    return interpretation_request
+
+
+def _interpretation_request_url(ir_id, ir_version, testing_on=False):
+    """Return the live or beta URL for an interpretation request."""
     if testing_on == False:
-        request_url = (live_100k_data_base_url + 'interpretation-request/{}/{}/'.format(ir_id, ir_version))
+        return live_100k_data_base_url + 'interpretation-request/{}/{}/'.format(ir_id, ir_version)
     else:
-        request_url = (beta_testing_base_url + 'interpretation-request/{}/{}/'.format(ir_id, ir_version))
+        return beta_testing_base_url + 'interpretation-request/{}/{}/'.format(ir_id, ir_version)
+
+
+def get_interpretation_request_jsons(ir_ids, max_workers=8, reports_v6=True, testing_on=False, token=None,
+                                     session=None, retries=0, backoff=1, cache=None, validators=None, errors=None):
+    """Get many interpretation requests as json, downloading them in parallel.
+
+    Interpretation requests are downloaded by a pool of threads sharing one
+    authenticated session. At most max_workers requests are in flight at any
+    time and results are yielded in the order they complete. Connection
+    errors, timeouts and transient HTTP errors are retried by the session's
+    transport (see transport.py), and can be retried again here with
+    exponential backoff by setting retries. If a ContentCache is given, cases found in it with a matching
+    validator are not downloaded again.
+
+    Args:
+        ir_ids: Iterable of (ir_id, ir_version) pairs.
+        max_workers (int): Maximum number of concurrent requests.
+        reports_v6 (bool): Request the reports v6 version of the data.
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        session: Optional authenticated session, defaults to the shared session.
+        retries (int): Number of times to retry a request which still fails
+            after the session's own retries.
+        backoff (float): Seconds to wait before the first retry, doubling for
+            each subsequent retry.
+        cache (ContentCache): Optional cache of interpretation request json.
+        validators (dict): Optional mapping of (ir_id, ir_version) to the
+            cache validator for that case, see cache.case_validator().
+        errors (dict): Optional dictionary to record the exception for each
+            (ir_id, ir_version) which could not be downloaded.
+
+    Yields:
+        (ir_id, ir_version, interpretation_request): The interpretation request
+            json will be None if it could not be downloaded.
+    """
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
+    validators = validators if validators else {}
 
-    return s.get(request_url, params=payload).json()
+    def fetch(ir):
+        return _fetch_interpretation_request_json(s, ir[0], ir[1], reports_v6, testing_on, retries, backoff, cache,
+                                                  validators.get(tuple(ir)))
+
+    for (ir_id, ir_version), interpretation_request, error in _iter_concurrent(fetch, ir_ids, max_workers):
+        if error is not None:
+            print('Unable to get interpretation request {}-{}: {}'.format(ir_id, ir_version, error))
+            if errors is not None:
+                errors[(ir_id, ir_version)] = error
+        yield ir_id, ir_version, interpretation_request
+
+
+def _iter_concurrent(fetch, items, max_workers):
+    """Call fetch on each item in a bounded thread pool, yielding results as they complete.
+
+    At most max_workers * 2 items are queued at a time so long or lazy
+    iterables are not consumed up front.
+
+    Yields:
+        (item, result, error): result is None and error is the exception if
+            fetch raised a RequestException or ValueError.
+
+    Raises:
+        CircuitOpenError: If the circuit breaker stopped a request. The
+            server is failing, so this isn't reported as a per-item error.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        # Queue up a little more than the worker count so threads are never idle waiting for the caller
+        for item in islice(items, max_workers * 2):
+            pending[executor.submit(fetch, item)] = item
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    result, error = future.result(), None
+                except CircuitOpenError:
+                    raise
+                except (RequestException, ValueError) as e:
+                    result, error = None, e
+                for next_item in islice(items, 1):
+                    pending[executor.submit(fetch, next_item)] = next_item
+                yield item, result, error
+
+
+def _fetch_interpretation_request_json(session, ir_id, ir_version, reports_v6, testing_on, retries, backoff,
+                                      cache=None, validator=None):
+    """Download one interpretation request, retrying transient failures with exponential backoff."""
+    request_url = _interpretation_request_url(ir_id, ir_version, testing_on)
+    cache_key = '{}?reports_v6={}'.format(request_url, reports_v6)
+    if cache is not None:
+        interpretation_request = cache.get(cache_key, validator)
+        if interpretation_request is not None:
+            return interpretation_request
+    for attempt in range(retries + 1):
+        try:
+            r = session.get(request_url, params={'reports_v6': reports_v6})
+            r.raise_for_status()
+            interpretation_request = response_json(r)
+            if cache is not None:
+                cache.put(cache_key, interpretation_request, validator)
+            return interpretation_request
+        except (ConnectionError, Timeout, HTTPError) as e:
+            transient = not isinstance(e, HTTPError) or e.response.status_code in RETRY_STATUS_CODES
+            if attempt == retries or not transient:
+                raise
+            time.sleep(backoff * 2 ** attempt)
 
 
 def get_interpretation_request_list(page_size=100,
@@ -47,10 +183,18 @@ def get_interpretation_request_list(page_size=100,
                                     search=None,
                                     testing_on=False,
                                     token=None,
-                                    minimize=True):
-    """Get a list of interpretation requests."""
-    s = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
-    interpretation_request_list = []
+                                    minimize=True,
+                                    session=None,
+                                    max_workers=8,
+                                    stream=False):
+    """Get a list of interpretation requests.
+
+    Once the first page shows the total number of results the remaining pages
+    are downloaded in parallel, up to max_workers at a time. If stream is True
+    a generator is returned which yields interpretation requests in order as
+    their pages arrive, rather than a list.
+    """
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
 
     # Use the correct url if using beta dataset for testing (imported form config.py):
     if testing_on == False:
@@ -84,14 +228,71 @@ def get_interpretation_request_list(page_size=100,
         'search': search,
         'minimize': minimize
     }
-    r = s.get(base_url, params=payload)
-    interpretation_request_list += r.json()['results']
-    next = r.json().get('next', False)
-    while next:
-        r = s.get(next)
-        interpretation_request_list += r.json()['results']
-        next = r.json().get('next', False)
-    return interpretation_request_list
+    interpretation_requests = iter_paginated_results(s, base_url, params=payload, max_workers=max_workers)
+    return interpretation_requests if stream else list(interpretation_requests)
+
+
+def iter_paginated_results(session, url, params=None, max_workers=8):
+    """Yield the results from every page of a paginated CIP-API endpoint.
+
+    The first page is used to work out how many pages there are, and the
+    remaining pages are then downloaded in parallel with at most max_workers
+    requests in flight. Each page is parsed once and its results are yielded
+    in page order. Endpoints which do not report a count or page number are
+    followed one 'next' link at a time.
+
+    Args:
+        session: Authenticated session.
+        url (str): URL of the first page.
+        params (dict): Query parameters for the first page.
+        max_workers (int): Maximum number of concurrent page requests.
+
+    Yields:
+        result: Each item of the 'results' list from every page.
+    """
+    page = response_json(session.get(url, params=params))
+    for result in page['results']:
+        yield result
+    page_urls = _remaining_page_urls(page)
+    if page_urls is None:
+        # Unable to compute the page URLs up front so follow the next links
+        while page.get('next'):
+            page = response_json(session.get(page['next']))
+            for result in page['results']:
+                yield result
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(_get_json, session, page_url)
+                   for page_url in islice(page_urls, max_workers * 2)]
+        while pending:
+            page = pending.pop(0).result()
+            for page_url in islice(page_urls, 1):
+                pending.append(executor.submit(_get_json, session, page_url))
+            for result in page['results']:
+                yield result
+
+
+def _remaining_page_urls(page):
+    """Return an iterator of URLs for the pages after this one, or None if they can't be computed."""
+    if not page.get('next') or not page.get('count') or not page['results']:
+        return None
+    next_url = urlparse(page['next'])
+    query = parse_qs(next_url.query)
+    if 'page' not in query:
+        return None
+    first_page = int(query['page'][0])
+    num_pages = int(ceil(float(page['count']) / len(page['results'])))
+
+    def page_urls():
+        for page_number in range(first_page, num_pages + 1):
+            query['page'] = [str(page_number)]
+            yield urlunparse(next_url._replace(query=urlencode(query, doseq=True)))
+    return page_urls()
+
+
+def _get_json(session, url):
+    """GET a URL and parse the json response."""
+    return response_json(session.get(url))
 
 
 def get_pedigree_dict(interpretation_request):
@@ -122,6 +323,63 @@ def get_pedigree_dict(interpretation_request):
     return pedigree
 
 
+def get_pedigree_index(interpretation_request):
+    """Make an index of the pedigree from gelId to relation to proband.
+
+    Unlike get_pedigree_dict every participant with a known relation is kept,
+    so families with several relatives of the same type are fully indexed.
+    Build it once per interpretation request and pass it to
+    get_call_zygosities for each variant.
+
+    Args:
+        interpretation_request: JSON representation of an
+            interpretation_request (output of get_interpretation_request_json).
+
+    Returns:
+        pedigree_index: Dictionary of 'gelId' keys and 'relation_to_proband'
+            values, with the proband's relation given as 'Proband'.
+    """
+    pedigree_index = {}
+    for p in (interpretation_request['interpretation_request_data']
+    ['interpretation_request_data']['json_request']['pedigree']
+    ['participants']):
+        if p['isProband']:
+            pedigree_index[p['gelId']] = 'Proband'
+        else:
+            try:
+                pedigree_index[p['gelId']] = (
+                    p['additionalInformation']['relation_to_proband'])
+            except KeyError:
+                pass
+    return pedigree_index
+
+
+def get_call_zygosities(variant, pedigree_index,
+                        family_members=('Proband', 'Mother', 'Father')):
+    """Get the zygosity of a variant for every family member in one pass.
+
+    Each called genotype is looked up in the pedigree index once, rather than
+    scanning the genotypes separately for each family member.
+
+    Args:
+        variant: Variant object from the TieredVariants in an interpretation
+            request.
+        pedigree_index: Output of get_pedigree_index.
+        family_members: Relations to proband to report, eg 'Proband',
+            'Mother', or 'Father'.
+
+    Returns:
+        zygosities: Dictionary of family member to zygosity. 'Unknown' for
+            family members without a called genotype.
+    """
+    zygosities = dict.fromkeys(family_members, 'Unknown')
+    for genotype in variant['calledGenotypes']:
+        relation = pedigree_index.get(genotype['gelId'])
+        if relation in zygosities:
+            zygosities[relation] = genotype['genotype']
+    return zygosities
+
+
 def get_variant_tier(variant):
     """Get the most significant tier (lowest) for a variant.
 
@@ -153,15 +411,16 @@ def save_interpretation_request_list_json(interpretation_request_list,
     if not (os.path.isfile(output_file_path)) or (force_update is True):
         print('Writing interprettion requests data to {}'
               .format(output_file_path))
-        with open(output_file_path, 'w') as fout:
-            json.dump(interpretation_request_list, fout)
+        with open(output_file_path, 'wb') as fout:
+            fout.write(dumps(interpretation_request_list))
 
 
-def access_date_summary_content(date1, date2, testing_on=False, token=None):
+def access_date_summary_content(date1, date2, testing_on=False, token=None, session=None):
     """
     method for accessing the JSON response from the date summary endpoint
     :param date1: '%d-%m-%Y' format date string
     :param date2: '%d-%m-%Y' format date string, exclusive of this date
+    :param session: optional authenticated session, defaults to the shared session
     :return:
     """
 
@@ -174,16 +433,17 @@ def access_date_summary_content(date1, date2, testing_on=False, token=None):
 
     date_summary_ext = 'interpretation-request/date-summary/{start}/{fin}/'.format(start=date1, fin=date2)
 
-    s = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
 
     # switch based on test arg - currently a single results page
     if testing_on:
-        return s.get(beta_testing_base_url + date_summary_ext).json()
+        return response_json(s.get(beta_testing_base_url + date_summary_ext))
     else:
-        return s.get(live_100k_data_base_url + date_summary_ext).json()
+        return response_json(s.get(live_100k_data_base_url + date_summary_ext))
 
 
-def get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=False, token=None):
+def get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=False, token=None, session=None,
+                                    cache=None, validator=None):
     """
 
     :param ir: case ID, e.g. X in GEL-XXXX-y
@@ -191,51 +451,90 @@ def get_interpreted_genome_for_case(ir, version, tiering_service, testing_on=Fal
     :param tiering_service: name of the interpreted genome service to check for
     :param testing_on:
     :param token:
-    :return: an interpreted genome JSON, or None
+    :param session: optional authenticated session, defaults to the shared session
+    :param cache: optional ContentCache checked before downloading
+    :param validator: optional cache validator for the case, see cache.case_validator()
+    :return: an interpreted genome JSON, or None if there is no analysis from tiering_service for the case
     """
 
-    s = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
 
     endpoint_suffix = 'interpreted-genome/{ir}/{ver}/{service}/last/?reports_v6=true'.format(ir=ir, ver=version,
                                                                                              service=tiering_service)
 
     # switch based on test arg - currently a single results page
-    try:
-        if testing_on:
-            return s.get(beta_testing_base_url + endpoint_suffix).json()
-        else:
-            return s.get(live_100k_data_base_url + endpoint_suffix).json()
-    except ValueError:
+    request_url = (beta_testing_base_url if testing_on else live_100k_data_base_url) + endpoint_suffix
+    if cache is not None:
+        interpreted_genome = cache.get(request_url, validator)
+        if interpreted_genome is not None:
+            return interpreted_genome
+    r = s.get(request_url)
+    if r.status_code == 404:
         print('No {service} analysis for {ir}-{ver}'.format(service=tiering_service,
                                                             ir=ir,
                                                             ver=version))
         return None
+    # Other errors (eg a server error which persisted through retries, or a truncated response) are raised rather
+    # than being mistaken for a case without an analysis
+    r.raise_for_status()
+    interpreted_genome = response_json(r)
+    if cache is not None:
+        cache.put(request_url, interpreted_genome, validator)
+    return interpreted_genome
+
 
+def get_interpreted_genomes_for_cases(cases, tiering_service, max_workers=8, testing_on=False, token=None,
+                                      session=None, cache=None, validators=None):
+    """Get the interpreted genome from a tiering service for many cases in parallel.
 
-def get_workspace_mapping(token=None):
+    Interpreted genomes are downloaded by a pool of threads sharing one
+    authenticated session, with at most max_workers requests in flight.
+
+    Args:
+        cases: Iterable of (ir, version) pairs.
+        tiering_service (str): Name of the interpreted genome service.
+        max_workers (int): Maximum number of concurrent requests.
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        session: Optional authenticated session, defaults to the shared session.
+        cache (ContentCache): Optional cache of interpreted genome json.
+        validators (dict): Optional mapping of (ir, version) to the cache
+            validator for that case, see cache.case_validator().
+
+    Yields:
+        (ir, version, interpreted_genome): The interpreted genome json will be
+            None if there is no analysis or it could not be downloaded.
+    """
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
+    validators = validators if validators else {}
+
+    def fetch(case):
+        return get_interpreted_genome_for_case(case[0], case[1], tiering_service, testing_on=testing_on, session=s,
+                                               cache=cache, validator=validators.get(tuple(case)))
+
+    for (ir, version), interpreted_genome, error in _iter_concurrent(fetch, cases, max_workers):
+        if error is not None:
+            print('Unable to get {service} analysis for {ir}-{ver}: {error}'.format(service=tiering_service, ir=ir,
+                                                                                   ver=version, error=error))
+        yield ir, version, interpreted_genome
+
+
+def get_workspace_mapping(token=None, session=None):
     """
     Currently 100k only, no need for a test mode
     Returns a lookup dictionary of short LDP code to GMC name
     :param: token: a pre-authorised CIP API token
+    :param session: optional authenticated session, defaults to the shared session
     :return:
     """
 
-    s = AuthenticatedCIPAPISession(token=token)
+    s = session if session else get_cipapi_session(token=token)
 
     workspaces = dict()
     url = live_100k_data_base_url + "/api/2/workspace-groups"
 
     # parse out all the endpoint results
-    while True:
-        json_returned = s.get(url=url).json()
-
-        for ws in json_returned['results']:
-            workspaces[ws['short_name']] = ws['gmc_name']
-
-        # more to loop through?
-        if json_returned['next']:
-            url = json_returned['next']
-        else:
-            break
+    for ws in iter_paginated_results(s, url):
+        workspaces[ws['short_name']] = ws['gmc_name']
 
     return workspaces
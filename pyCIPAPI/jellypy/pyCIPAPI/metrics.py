@@ -0,0 +1,220 @@
+"""Request timing, size, retry and cache metrics for pyCIPAPI sessions."""
+from __future__ import print_function
+
+import datetime
+import json
+import re
+from threading import Lock
+
+from urllib.parse import urlparse
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+# Path segments replaced by '{id}' in endpoint labels, eg interpretation request IDs and versions
+_ID_SEGMENT = re.compile(r'^(\d+|[A-Z]+-\d+-\d+)$')
+
+
+def endpoint_label(url):
+    """Make a low cardinality label for the endpoint of a URL.
+
+    The query string is dropped, numeric path segments and case IDs (eg
+    SAP-12345-1) are replaced with '{id}', and the CIP-API '/api/2/' prefix
+    is removed, eg 'interpretation-request/{id}/{id}/'.
+    """
+    parsed = urlparse(url)
+    path = parsed.path
+    prefix = parsed.netloc
+    if path.startswith('/api/2/'):
+        path, prefix = path[len('/api/2/'):], ''
+    return prefix + '/'.join('{id}' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+class Metrics(object):
+    """Thread-safe collector of request and cache metrics.
+
+    Sessions record every request they send (latency, status, bytes sent and
+    received), transports record each retry and caches record hits and
+    misses. snapshot() returns everything as a dictionary, and to_json() and
+    to_prometheus() format it for logs or a Prometheus textfile collector.
+    If trace_path is set, each request is also appended to that file as a
+    line of JSON.
+    """
+
+    def __init__(self, trace_path=None):
+        """
+        Args:
+            trace_path (str): Optional JSON Lines file to append a record of every request to.
+        """
+        self._lock = Lock()
+        self._trace = None
+        self.reset()
+        if trace_path:
+            self.enable_trace(trace_path)
+
+    def reset(self):
+        """Forget all recorded metrics."""
+        with self._lock:
+            self._requests = {}
+            self._retries = {}
+            self._caches = {}
+
+    def enable_trace(self, trace_path):
+        """Append a line of JSON describing each request to trace_path."""
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+            self._trace = open(trace_path, 'a')
+
+    def disable_trace(self):
+        """Stop writing the per-request trace log."""
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+    def observe_request(self, method, url, status, seconds, bytes_sent=0, bytes_received=0, endpoint=None):
+        """Record a completed (or failed, with status None) request."""
+        endpoint = endpoint if endpoint else endpoint_label(url)
+        key = (method, endpoint)
+        with self._lock:
+            stats = self._requests.get(key)
+            if stats is None:
+                stats = self._requests[key] = {'count': 0, 'errors': 0, 'seconds_sum': 0.0, 'bytes_sent': 0,
+                                               'bytes_received': 0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+            stats['count'] += 1
+            stats['errors'] += 1 if status is None or status >= 400 else 0
+            stats['seconds_sum'] += seconds
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    stats['buckets'][index] += 1
+                    break
+            if self._trace is not None:
+                self._trace.write(json.dumps({
+                    'time': datetime.datetime.now().isoformat(), 'method': method, 'url': url,
+                    'endpoint': endpoint, 'status': status, 'seconds': round(seconds, 6),
+                    'bytes_sent': bytes_sent, 'bytes_received': bytes_received
+                }) + '\n')
+                self._trace.flush()
+
+    def record_retry(self, method, url):
+        """Record that a request to url is being retried."""
+        key = (method, endpoint_label(url))
+        with self._lock:
+            self._retries[key] = self._retries.get(key, 0) + 1
+
+    def record_cache(self, cache, hit):
+        """Record a cache lookup.
+
+        Args:
+            cache (str): Name of the cache, eg 'content_cache'.
+            hit (bool): Whether the lookup found a usable entry.
+        """
+        with self._lock:
+            stats = self._caches.setdefault(cache, {'hits': 0, 'misses': 0})
+            stats['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        """Return the current metrics as a dictionary.
+
+        Returns:
+            snapshot (dict): 'requests' is a list with the method, endpoint,
+                count, errors, retries, seconds_sum, seconds_mean, bytes_sent,
+                bytes_received and cumulative latency 'buckets' (keyed by
+                upper bound) of each endpoint. 'caches' maps each cache name
+                to its hits, misses and hit_rate.
+        """
+        with self._lock:
+            keys = sorted(set(self._requests).union(self._retries))
+            requests = []
+            for method, endpoint in keys:
+                stats = self._requests.get((method, endpoint), {'count': 0, 'errors': 0, 'seconds_sum': 0.0,
+                                                                'bytes_sent': 0, 'bytes_received': 0,
+                                                                'buckets': [0] * len(LATENCY_BUCKETS)})
+                cumulative, buckets = 0, {}
+                for upper_bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                    cumulative += count
+                    buckets['+Inf' if upper_bound == float('inf') else str(upper_bound)] = cumulative
+                requests.append({
+                    'method': method,
+                    'endpoint': endpoint,
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'retries': self._retries.get((method, endpoint), 0),
+                    'seconds_sum': stats['seconds_sum'],
+                    'seconds_mean': stats['seconds_sum'] / stats['count'] if stats['count'] else 0.0,
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received'],
+                    'buckets': buckets,
+                })
+            caches = {}
+            for cache, stats in self._caches.items():
+                lookups = stats['hits'] + stats['misses']
+                caches[cache] = dict(stats, hit_rate=float(stats['hits']) / lookups if lookups else 0.0)
+        return {'requests': requests, 'caches': caches}
+
+    def to_json(self, **kwargs):
+        """Return the metrics snapshot as a JSON string (kwargs are passed to json.dumps)."""
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix='jellypy'):
+        """Return the metrics snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, str(label).replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append('{}_{}{}{{{}}} {}'.format(prefix, name, suffix, label_text, value))
+
+        histogram = []
+        for stats in snapshot['requests']:
+            labels = [('method', stats['method']), ('endpoint', stats['endpoint'])]
+            for upper_bound, count in stats['buckets'].items():
+                histogram.append(('_bucket', labels + [('le', upper_bound)], count))
+            histogram.append(('_sum', labels, stats['seconds_sum']))
+            histogram.append(('_count', labels, stats['count']))
+        metric('request_duration_seconds', 'histogram', 'Latency of CIP-API and openCGA requests.', histogram)
+        for name, key, help_text in (('request_errors_total', 'errors', 'Requests which failed or returned an error.'),
+                                     ('request_retries_total', 'retries', 'Requests retried by the transport.'),
+                                     ('request_bytes_total', 'bytes_sent', 'Bytes sent in request bodies.'),
+                                     ('response_bytes_total', 'bytes_received', 'Bytes received in responses.')):
+            metric(name, 'counter', help_text,
+                   [('', [('method', stats['method']), ('endpoint', stats['endpoint'])], stats[key])
+                    for stats in snapshot['requests']])
+        cache_samples = []
+        for cache, stats in sorted(snapshot['caches'].items()):
+            cache_samples.append(('', [('cache', cache), ('result', 'hit')], stats['hits']))
+            cache_samples.append(('', [('cache', cache), ('result', 'miss')], stats['misses']))
+        metric('cache_lookups_total', 'counter', 'Cache lookups by result.', cache_samples)
+        return '\n'.join(lines) + '\n'
+
+
+def response_bytes(response, stream=False):
+    """Bytes received for a response: its Content-Length, or the size of the body if it has been read."""
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        return int(content_length)
+    if stream:
+        return 0
+    return len(response.content or b'')
+
+
+def request_bytes(request):
+    """Bytes sent in the body of a prepared request."""
+    body = request.body if request is not None else None
+    return len(body) if isinstance(body, (bytes, str)) else 0
+
+
+# Metrics shared by every session and cache unless they are given their own
+default_metrics = Metrics()
+
+
+def get_metrics():
+    """Get the process-wide Metrics recorded by pyCIPAPI sessions and caches."""
+    return default_metrics
@@ -1,9 +1,15 @@
 """Functions for interacting with GEL instance of openCGA."""
 from __future__ import print_function
 
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from .auth import AuthenticatedOpenCGASession
+import requests
+
+from .auth import get_opencga_session
+from .codec import response_json
+from .config import download_chunk_size
 
 
 def get_study_id(study_type, assembly=None, sample_type=None):
@@ -45,7 +51,7 @@ def get_study_id(study_type, assembly=None, sample_type=None):
     return study_id
 
 
-def find_file_id(study_id, file_format, file_name):
+def find_file_id(study_id, file_format, file_name, session=None):
     """Find the file ID for the given filename, format, and study ID.
 
     Use the openCGA file search endpoint to get the file_id for the given
@@ -55,59 +61,232 @@ def find_file_id(study_id, file_format, file_name):
         study_id (int): ID for appropriate study within the CIPAPI.
         file_format (str): Format of file to search for (eg VCF).
         file_name (str): Name of file to search for.
+        session: Optional AuthenticatedOpenCGASession, defaults to the shared
+            session.
 
     Returns:
         file_id (int): ID for given file in openCGA. Will be None if failed
             search or no search results are found.
     """
-    s = AuthenticatedOpenCGASession()
-    # Construct search url
-    search_url = ("{host}/files/search?format=VCF&sid={sid}&study={study_id}"
-                  "&name={file_name}&exclude=meta&limit=1&sort=creationDate"
-                  .format(host=s.host_url, sid=s.sid, study_id=study_id,
-                          file_name=file_name))
-    r = s.get(search_url)
-    file_id = None
-    if r.status_code == 200:
-        try:
-            file_id = r.json()['response'][0]['result'][0]['id']
-        except (KeyError, IndexError):
-            print('Unable to find file {file_idname}'
-                  .format(filename=file_name))
-    else:
-        print('Search for file {file_name} failed'.format(filename=file_name))
-    return file_id
+    file_ids = find_file_ids([(study_id, file_format, file_name)],
+                             session=session)
+    return file_ids[(study_id, file_format, file_name)]
+
+
+def find_file_ids(files, session=None, batch_size=50, cache=None):
+    """Find the file IDs for many files using grouped openCGA searches.
+
+    Files are grouped by study_id and file_format and each group is searched
+    for batch_size names at a time over one shared session. Where several
+    files share a name the earliest created is used, as in find_file_id.
+
+    Args:
+        files: Iterable of (study_id, file_format, file_name) tuples.
+        session: Optional AuthenticatedOpenCGASession, defaults to the shared
+            session.
+        batch_size (int): Maximum number of file names in each search.
+        cache (ContentCache): Optional cache of previously resolved file IDs.
+            Only files missing from the cache are searched for.
+
+    Returns:
+        file_ids (dict): (study_id, file_format, file_name) to file ID. The
+            file ID will be None if the search failed or the file was not
+            found.
+    """
+    file_ids = {}
+    groups = {}
+    for study_id, file_format, file_name in files:
+        key = (study_id, file_format, file_name)
+        file_id = (cache.get(_file_id_cache_key(*key))
+                   if cache is not None else None)
+        if file_id is not None:
+            file_ids[key] = file_id
+        else:
+            file_ids[key] = None
+            groups.setdefault((study_id, file_format), set()).add(file_name)
+    if not groups:
+        return file_ids
+    s = session if session else get_opencga_session()
+    for (study_id, file_format), file_names in groups.items():
+        file_names = sorted(file_names)
+        for start in range(0, len(file_names), batch_size):
+            batch = file_names[start:start + batch_size]
+            # Construct search url, openCGA treats comma separated names as OR
+            # Allow headroom in the limit for files which share a name
+            search_url = ("{host}/files/search?format={file_format}&sid={sid}"
+                          "&study={study_id}&name={file_names}&exclude=meta"
+                          "&limit={limit}&sort=creationDate"
+                          .format(host=s.host_url, file_format=file_format,
+                                  sid=s.sid, study_id=study_id,
+                                  file_names=','.join(batch),
+                                  limit=len(batch) * 10))
+            r = s.get(search_url)
+            if r.status_code != 200:
+                print('Search for files {file_names} failed'
+                      .format(file_names=', '.join(batch)))
+                continue
+            try:
+                results = response_json(r)['response'][0]['result']
+            except (KeyError, IndexError):
+                results = []
+            for result in results:
+                key = (study_id, file_format, result.get('name'))
+                # Keep the earliest created file where names are duplicated
+                if key in file_ids and file_ids[key] is None:
+                    file_ids[key] = result['id']
+                    if cache is not None:
+                        cache.put(_file_id_cache_key(*key), result['id'])
+            for file_name in batch:
+                if file_ids[(study_id, file_format, file_name)] is None:
+                    print('Unable to find file {file_name}'
+                          .format(file_name=file_name))
+    return file_ids
+
+
+def _file_id_cache_key(study_id, file_format, file_name):
+    """Return the ContentCache key for an openCGA file ID."""
+    return 'opencga-file-id/{}/{}/{}'.format(study_id, file_format, file_name)
 
 
-def download_file(file_id, study_id, file_name, download_folder=None):
+def download_file(file_id, study_id, file_name, download_folder=None, session=None, chunk_size=download_chunk_size,
+                  resume=True, md5=None):
     """Download a file from the GEL openCGA instance.
 
+    The file is written to <file_name>.part and renamed once complete. If a
+    partial download exists and resume is True, only the remaining bytes are
+    requested using an HTTP Range header. The downloaded size is checked
+    against the size reported by the server and, if given, the md5 checksum.
+
     Args:
         file_id (int): ID for given file in openCGA.
         study_id (int): ID for appropriate study within the CIPAPI.
         file_name (str): Name of file to create with download.
         download_folder (str): Path to download location. Defaults to current
             working directory.
+        session: Optional AuthenticatedOpenCGASession to download with,
+            defaults to the shared session.
+        chunk_size (int): Bytes to read and write at a time.
+        resume (bool): Continue a partial download rather than starting again.
+        md5 (str): Optional expected md5 hex digest of the complete file.
 
+    Returns:
+        download_path (str): Path to the downloaded file. Will be None if the
+            download failed or could not be verified.
     """
-    s = AuthenticatedOpenCGASession()
+    s = session if session else get_opencga_session()
     # Construct download url
     download_url = ("{host}/files/{file_id}/download?sid={sid}&"
                     "study={study_id}"
                     .format(host=s.host_url, file_id=file_id, sid=s.sid,
                             study_id=study_id))
-    r = s.get(download_url, stream=True)
-    if r.status_code == 200:
-        if not download_folder:
-            download_folder = os.getcwd()
-        download_path = os.path.join(download_folder, file_name)
+    if not download_folder:
+        download_folder = os.getcwd()
+    download_path = os.path.join(download_folder, file_name)
+    partial_path = download_path + '.part'
+    offset = (os.path.getsize(partial_path)
+              if resume and os.path.isfile(partial_path) else 0)
+    r = _request_download(s, download_url, offset)
+    if r.status_code == 416:
+        # The partial file is no smaller than the remote file so start again
+        r.close()
+        offset = 0
+        r = _request_download(s, download_url, offset)
+    # Always release the streamed response's connection back to the pool
+    try:
+        if r.status_code not in (200, 206):
+            print('Unable to download file {file_id} for study {study_id}'
+                  .format(file_id=file_id, study_id=study_id))
+            return None
+        if r.status_code == 200:
+            # The server ignored the Range header (or none was sent)
+            offset = 0
+        expected_size = _expected_size(r, offset)
         print('Downloading to {download_path}'
               .format(download_path=download_path))
-        with open(download_path, 'wb') as fout:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    fout.write(chunk)
-                    fout.flush()
-    else:
-        print('Unable to download file {file_id} for study {study_id}'
-              .format(file_id=file_id, study_id=study_id))
+        with open(partial_path, 'ab' if offset else 'wb',
+                  buffering=chunk_size) as fout:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                fout.write(chunk)
+    finally:
+        r.close()
+    size = os.path.getsize(partial_path)
+    if expected_size is not None and size != expected_size:
+        print('Incomplete download of file {file_id}: {size} of {expected} '
+              'bytes. Run again to resume.'
+              .format(file_id=file_id, size=size, expected=expected_size))
+        return None
+    if md5 and _md5sum(partial_path, chunk_size) != md5.lower():
+        print('Checksum mismatch for file {file_id}, removing download'
+              .format(file_id=file_id))
+        os.remove(partial_path)
+        return None
+    os.rename(partial_path, download_path)
+    return download_path
+
+
+def download_files(downloads, download_folder=None, max_workers=4,
+                   session=None, **kwargs):
+    """Download several files from the GEL openCGA instance concurrently.
+
+    All downloads share one authenticated session.
+
+    Args:
+        downloads: Iterable of (file_id, study_id, file_name) tuples, or
+            (file_id, study_id, file_name, md5) tuples to verify checksums.
+        download_folder (str): Path to download location. Defaults to current
+            working directory.
+        max_workers (int): Maximum number of concurrent downloads.
+        session: Optional AuthenticatedOpenCGASession to download with,
+            defaults to the shared session.
+        **kwargs: Additional arguments passed to download_file.
+
+    Returns:
+        download_paths (dict): File name to downloaded path, or None for
+            failed downloads. A download which fails part way through (eg
+            the connection drops or the file can't be written) is left as
+            a .part file to resume, and doesn't stop the other downloads.
+    """
+    s = session if session else get_opencga_session()
+
+    def download(args):
+        file_id, study_id, file_name = args[:3]
+        md5 = args[3] if len(args) > 3 else None
+        try:
+            return file_name, download_file(file_id, study_id, file_name,
+                                            download_folder=download_folder,
+                                            session=s, md5=md5, **kwargs)
+        except (requests.RequestException, IOError) as error:
+            print('Download of file {file_id} failed: {error}'
+                  .format(file_id=file_id, error=error))
+            return file_name, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(download, downloads))
+
+
+def _request_download(session, download_url, offset):
+    """Start streaming a download, from offset bytes into the file if non-zero."""
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+    return session.get(download_url, stream=True, headers=headers)
+
+
+def _expected_size(response, offset):
+    """Return the full size of the file being downloaded, or None if unknown."""
+    content_range = response.headers.get('Content-Range')
+    if response.status_code == 206 and content_range:
+        total = content_range.rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get('Content-Length')
+    # Content-Length is of the encoded body so can't be compared if the content is compressed in transit
+    if content_length and not response.headers.get('Content-Encoding'):
+        return offset + int(content_length)
+    return None
+
+
+def _md5sum(path, chunk_size=download_chunk_size):
+    """Return the md5 hex digest of a file."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -0,0 +1,158 @@
+"""Turn case selection criteria into the narrowest interpretation request list queries."""
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+from .auth import get_cipapi_session
+from .config import connection_pool_size
+from .interpretation_requests import get_interpretation_request_list
+
+
+def build_queries(sites=None, **criteria):
+    """Make the interpretation request list queries needed to select cases.
+
+    The list endpoint filters on one value per parameter, so a query is made
+    for every combination of criteria given as a list. Sites are filtered
+    with the workspace parameter.
+
+    Args:
+        sites: Site code or list of site codes (eg 'RR8').
+        **criteria: get_interpretation_request_list filters (eg
+            sample_type='raredisease', last_status=['sent_to_gmcs',
+            'report_generated']). None values are ignored.
+
+    Returns:
+        queries (list): Dictionaries of get_interpretation_request_list
+            filters. A single empty query selects every case.
+    """
+    if sites is not None:
+        criteria['workspace'] = sites
+    names = sorted(name for name, value in criteria.items() if value is not None)
+    values = [_as_list(criteria[name]) for name in names]
+    return [dict(zip(names, combination)) for combination in product(*values)]
+
+
+def run_queries(queries, max_workers=8, testing_on=False, token=None, session=None):
+    """Run interpretation request list queries in parallel and merge the results.
+
+    Cases returned by more than one query are only included once, in the
+    position of the first query that returned them.
+
+    Args:
+        queries: Dictionaries of get_interpretation_request_list filters.
+        max_workers (int): Maximum number of requests in flight, shared
+            between the queries running at once and the pages each query
+            downloads in parallel (see split_workers).
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        session: Optional authenticated session, defaults to the shared session.
+
+    Returns:
+        cases (list): Interpretation requests from the list endpoint.
+    """
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
+    queries = list(queries)
+    query_workers, page_workers = split_workers(max_workers, len(queries))
+
+    def fetch(query):
+        return get_interpretation_request_list(testing_on=testing_on, session=s, max_workers=page_workers, **query)
+
+    with ThreadPoolExecutor(max_workers=query_workers) as executor:
+        results = list(executor.map(fetch, queries))
+    cases, seen = [], set()
+    for result in results:
+        for case in result:
+            if case['interpretation_request_id'] not in seen:
+                seen.add(case['interpretation_request_id'])
+                cases.append(case)
+    return cases
+
+
+def select_cases(sites=None, max_workers=8, testing_on=False, token=None, session=None, **criteria):
+    """Get the interpretation requests matching the given criteria.
+
+    Criteria are pushed down to the CIP-API as list filters so only matching
+    pages are downloaded, with one query per site (and per value of any
+    other criterion given as a list) run in parallel.
+
+    Args:
+        sites: Site code or list of site codes (eg 'RR8').
+        max_workers (int): Maximum number of requests in flight.
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        session: Optional authenticated session, defaults to the shared session.
+        **criteria: get_interpretation_request_list filters (eg
+            sample_type='raredisease').
+
+    Returns:
+        cases (list): Matching interpretation requests from the list endpoint.
+    """
+    cases = run_queries(build_queries(sites=sites, **criteria), max_workers=max_workers, testing_on=testing_on,
+                        token=token, session=session)
+    return _at_sites(cases, sites)
+
+
+def sync_selection(case_store, sites=None, full=False, max_workers=8, testing_on=False, token=None, session=None,
+                   **criteria):
+    """Bring the cases matching the given criteria up to date in a CaseStore.
+
+    Each query from build_queries() is synced in parallel with its own
+    high-water mark, so later syncs only download matching cases updated
+    since the previous sync. Select the cases afterwards with
+    case_store.query().
+
+    Args:
+        case_store (CaseStore): Case store to update.
+        sites: Site code or list of site codes (eg 'RR8').
+        full (bool): Ignore the high-water marks and download every matching case.
+        max_workers (int): Maximum number of requests in flight, see split_workers.
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        session: Optional authenticated session, defaults to the shared session.
+        **criteria: get_interpretation_request_list filters.
+
+    Returns:
+        count (int): Number of cases added or updated.
+    """
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
+    queries = build_queries(sites=sites, **criteria)
+    query_workers, page_workers = split_workers(max_workers, len(queries))
+
+    def sync(query):
+        return case_store.sync(full=full, testing_on=testing_on, session=s, max_workers=page_workers, **query)
+
+    with ThreadPoolExecutor(max_workers=query_workers) as executor:
+        return sum(executor.map(sync, queries))
+
+
+def split_workers(max_workers, num_queries):
+    """Share max_workers between queries run at once and the list pages each query downloads at once.
+
+    The total number of requests in flight is kept within max_workers and
+    connection_pool_size, so every request can reuse a pooled connection
+    rather than the pool discarding connections it has no room for.
+
+    Args:
+        max_workers (int): Maximum number of requests in flight.
+        num_queries (int): Number of queries to run.
+
+    Returns:
+        (query_workers, page_workers): Number of queries run at once, and
+            the number of pages each of them downloads at once.
+    """
+    budget = max(1, min(max_workers, connection_pool_size))
+    query_workers = max(1, min(budget, num_queries))
+    return query_workers, max(1, budget // query_workers)
+
+
+def _at_sites(cases, sites):
+    """Keep cases at any of the sites, in case the server applied the workspace filter more loosely."""
+    if sites is None:
+        return cases
+    sites = set(_as_list(sites))
+    return [case for case in cases if sites.intersection(case.get('sites') or [])]
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
@@ -0,0 +1,242 @@
+"""Columnar snapshots of the interpretation request list and per-case summaries.
+
+Snapshots are written as Parquet files, which can be memory mapped and read
+a column at a time, so later runs only load the fields they need. JSON is
+kept as an export format. Parquet requires the optional pyarrow package
+(pip install jellypy_pyCIPAPI[snapshot]); without it snapshots are written as
+JSON.
+"""
+from __future__ import print_function
+
+import datetime
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from .codec import dumps, dumps_text, loads
+
+SNAPSHOT_FORMATS = ('parquet', 'json')
+# Format used when one is not given
+DEFAULT_FORMAT = 'parquet' if pa is not None else 'json'
+# Name of the daily interpretation request list snapshot
+CASE_LIST_SNAPSHOT = 'interpretation_request_audit'
+# Interpretation request payloads are kept in the ContentCache rather than in snapshots
+PAYLOAD_FIELDS = ('interpretation_request_data', 'simple_pedigree')
+
+# Parquet schema metadata listing the columns stored as JSON text
+_JSON_COLUMNS_KEY = b'jellypy.json_columns'
+
+
+def snapshot_path(name, fmt=DEFAULT_FORMAT, date=None, directory=None):
+    """Date stamped path of a snapshot, eg output/20200101_interpretation_request_audit.parquet
+
+    Args:
+        name (str): Snapshot name.
+        fmt (str): One of SNAPSHOT_FORMATS.
+        date (datetime.date): Date of the snapshot, defaults to today.
+        directory (str): Directory of the snapshot, defaults to output/ in the working directory.
+    """
+    date = date if date else datetime.datetime.today()
+    directory = directory if directory else os.path.join(os.getcwd(), 'output')
+    return os.path.join(directory, '{}_{}.{}'.format(date.strftime('%Y%m%d'), name, fmt))
+
+
+def write_snapshot(data, path, fmt=None):
+    """Write records or a DataFrame to a Parquet or JSON snapshot.
+
+    Nested values which don't fit a column type (eg dictionaries) are stored
+    in Parquet as JSON text and decoded again by read_snapshot. The file is
+    written next to path and renamed into place, so readers never see a
+    partial snapshot.
+
+    Args:
+        data: List of dictionaries (eg interpretation request list entries)
+            or a pandas DataFrame (eg from variant_table.variant_table).
+        path (str): Output file path.
+        fmt (str): One of SNAPSHOT_FORMATS, defaults to the path's extension.
+    """
+    fmt = _snapshot_format(path, fmt)
+    temp_path = path + '.tmp'
+    if fmt == 'json':
+        records = data.to_dict('records') if isinstance(data, pd.DataFrame) else list(data)
+        with open(temp_path, 'wb') as fout:
+            fout.write(dumps(records))
+    else:
+        _require_pyarrow()
+        if isinstance(data, pd.DataFrame):
+            table = pa.Table.from_pandas(data, preserve_index=False)
+        else:
+            table = records_table(data)
+        pq.write_table(table, temp_path)
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path, columns=None, fmt=None):
+    """Read a snapshot into a DataFrame.
+
+    Parquet snapshots are memory mapped and only the requested columns are
+    read.
+
+    Args:
+        path (str): Snapshot file path.
+        columns (list): Columns to read, defaults to all of them.
+        fmt (str): One of SNAPSHOT_FORMATS, defaults to the path's extension.
+
+    Returns:
+        table: pandas DataFrame with a row per record.
+    """
+    fmt = _snapshot_format(path, fmt)
+    if fmt == 'json':
+        with open(path, 'rb') as fin:
+            table = pd.DataFrame(loads(fin.read()))
+        return table[columns] if columns is not None else table
+    table = _read_table(path, columns)
+    frame = table.to_pandas()
+    for column in _json_columns(table):
+        frame[column] = [_decode(value) for value in frame[column]]
+    return frame
+
+
+def read_snapshot_records(path, columns=None, fmt=None):
+    """Read a snapshot as a list of dictionaries, as it was written by write_snapshot.
+
+    Args:
+        path (str): Snapshot file path.
+        columns (list): Fields to read, defaults to all of them.
+        fmt (str): One of SNAPSHOT_FORMATS, defaults to the path's extension.
+
+    Returns:
+        records (list): A dictionary per record. Fields missing from a record
+            when it was written to Parquet are read as None.
+    """
+    fmt = _snapshot_format(path, fmt)
+    if fmt == 'json':
+        with open(path, 'rb') as fin:
+            records = loads(fin.read())
+        if columns is not None:
+            records = [{column: record.get(column) for column in columns} for record in records]
+        return records
+    table = _read_table(path, columns)
+    data = table.to_pydict()
+    for column in _json_columns(table):
+        data[column] = [_decode(value) for value in data[column]]
+    names = list(data)
+    return [dict(zip(names, values)) for values in zip(*(data[name] for name in names))]
+
+
+def records_table(records):
+    """Convert a list of dictionaries to an Arrow table.
+
+    Each field becomes a column, in the order fields are first seen. Fields
+    whose values Arrow can't give a single type (eg dictionaries or lists of
+    mixed types) are stored as JSON text and listed in the schema metadata.
+    """
+    _require_pyarrow()
+    records = list(records)
+    names = []
+    for record in records:
+        for name in record:
+            if name not in names:
+                names.append(name)
+    arrays, json_columns = [], []
+    for name in names:
+        values = [record.get(name) for record in records]
+        try:
+            if any(_nested(value) for value in values):
+                raise TypeError('Store nested values as JSON')
+            arrays.append(pa.array(values))
+        except (TypeError, ValueError, pa.ArrowException):
+            arrays.append(pa.array([None if value is None else dumps_text(value) for value in values],
+                                   type=pa.string()))
+            json_columns.append(name)
+    metadata = {_JSON_COLUMNS_KEY: json.dumps(json_columns).encode()} if json_columns else None
+    return pa.Table.from_arrays(arrays, names=names, metadata=metadata)
+
+
+def save_case_list(interpretation_request_list, fmt=DEFAULT_FORMAT, force_update=False, directory=None):
+    """Save today's interpretation request list snapshot, without interpretation request payloads.
+
+    Args:
+        interpretation_request_list: Interpretation request list entries, eg
+            with tier counts added by an audit.
+        fmt (str): One of SNAPSHOT_FORMATS.
+        force_update (bool): Overwrite a snapshot which already exists for today.
+        directory (str): Directory of the snapshot, defaults to output/ in the working directory.
+
+    Returns:
+        path (str): Path of the snapshot.
+    """
+    path = snapshot_path(CASE_LIST_SNAPSHOT, fmt=fmt, directory=directory)
+    if not os.path.isfile(path) or force_update is True:
+        print('Writing interpretation request list snapshot to {}'.format(path))
+        write_snapshot([{key: value for key, value in case.items() if key not in PAYLOAD_FIELDS}
+                        for case in interpretation_request_list], path, fmt=fmt)
+    return path
+
+
+def load_case_list(columns=None, date=None, directory=None):
+    """Load the interpretation request list snapshot saved on a date.
+
+    A Parquet snapshot is used if there is one (and pyarrow is installed),
+    otherwise a JSON snapshot.
+
+    Args:
+        columns (list): Fields to load, defaults to all of them.
+        date (datetime.date): Date of the snapshot, defaults to today.
+        directory (str): Directory of the snapshot, defaults to output/ in the working directory.
+
+    Returns:
+        interpretation_request_list: List of interpretation request list entries.
+
+    Raises:
+        FileNotFoundError: If there is no snapshot for the date.
+    """
+    formats = SNAPSHOT_FORMATS if pa is not None else ('json',)
+    for fmt in formats:
+        path = snapshot_path(CASE_LIST_SNAPSHOT, fmt=fmt, date=date, directory=directory)
+        if os.path.isfile(path):
+            return read_snapshot_records(path, columns=columns, fmt=fmt)
+    raise FileNotFoundError('No interpretation request list snapshot for {}'
+                            .format((date if date else datetime.datetime.today()).strftime('%Y%m%d')))
+
+
+def _read_table(path, columns):
+    _require_pyarrow()
+    return pq.read_table(path, columns=columns, memory_map=True)
+
+
+def _json_columns(table):
+    metadata = table.schema.metadata or {}
+    json_columns = json.loads(metadata.get(_JSON_COLUMNS_KEY, b'[]').decode())
+    return [column for column in json_columns if column in table.column_names]
+
+
+def _nested(value):
+    """Whether a value is a dictionary or a list containing anything other than scalars."""
+    if isinstance(value, dict):
+        return True
+    return isinstance(value, (list, tuple)) and any(isinstance(item, (dict, list, tuple)) for item in value)
+
+
+def _decode(value):
+    return None if value is None else loads(value)
+
+
+def _snapshot_format(path, fmt):
+    fmt = fmt if fmt else os.path.splitext(path)[1].lstrip('.')
+    if fmt not in SNAPSHOT_FORMATS:
+        raise ValueError('Unknown snapshot format {}, expected one of {}'.format(fmt, ', '.join(SNAPSHOT_FORMATS)))
+    return fmt
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('Parquet snapshots require the pyarrow package. '
+                          'Install it with: pip install pyarrow')
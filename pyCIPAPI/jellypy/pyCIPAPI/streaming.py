@@ -0,0 +1,126 @@
+"""Functions for reading parts of large interpretation requests without loading the whole document.
+
+Requires the optional ijson package (pip install jellypy_pyCIPAPI[streaming]).
+"""
+from __future__ import print_function
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+from .auth import get_cipapi_session
+from .interpretation_requests import _interpretation_request_url
+
+# Locations of commonly used sub-documents within a reports v6 interpretation request json
+INTERPRETATION_REQUEST_SECTIONS = {
+    'pedigree': 'interpretation_request_data.json_request.pedigree',
+    'tiered_variants': 'interpretation_request_data.json_request.TieredVariants',
+    'clinical_report': 'clinical_report',
+    'interpreted_genome': 'interpreted_genome',
+}
+
+
+def iter_tiered_variants(ir_id, ir_version, reports_v6=True, testing_on=False, token=None, session=None):
+    """Yield the tiered variants of an interpretation request one at a time.
+
+    The response is parsed incrementally as it is downloaded, so only one
+    variant is held in memory at a time.
+
+    Args:
+        ir_id: Interpretation request ID.
+        ir_version: Interpretation request version.
+        reports_v6 (bool): Request the reports v6 version of the data.
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        session: Optional authenticated session, defaults to the shared session.
+
+    Yields:
+        variant: Variant object from the TieredVariants in the interpretation
+            request.
+    """
+    response = _stream_interpretation_request(ir_id, ir_version, reports_v6, testing_on, token, session)
+    try:
+        for variant in ijson.items(response.raw, INTERPRETATION_REQUEST_SECTIONS['tiered_variants'] + '.item',
+                                   use_float=True):
+            yield variant
+    finally:
+        response.close()
+
+
+def get_interpretation_request_sections(ir_id, ir_version, sections=('pedigree', 'clinical_report',
+                                                                       'interpreted_genome'),
+                                        reports_v6=True, testing_on=False, token=None, session=None):
+    """Get selected sub-documents of an interpretation request in a single streaming pass.
+
+    Only the requested sections are built in memory; the rest of the
+    document is discarded as it is parsed.
+
+    Args:
+        ir_id: Interpretation request ID.
+        ir_version: Interpretation request version.
+        sections: Names from INTERPRETATION_REQUEST_SECTIONS, or dotted ijson
+            prefixes (eg 'interpretation_request_data.json_request.pedigree').
+        reports_v6 (bool): Request the reports v6 version of the data.
+        testing_on (bool): Use the beta CIP-API rather than live.
+        token (str): Optional pre-authorised JWT token.
+        session: Optional authenticated session, defaults to the shared session.
+
+    Returns:
+        sections: Dictionary of section name to sub-document. Sections not
+            present in the interpretation request are omitted.
+    """
+    prefixes = {INTERPRETATION_REQUEST_SECTIONS.get(section, section): section for section in sections}
+    response = _stream_interpretation_request(ir_id, ir_version, reports_v6, testing_on, token, session)
+    try:
+        return extract_sections(ijson.parse(response.raw, use_float=True), prefixes)
+    finally:
+        response.close()
+
+
+def extract_sections(events, prefixes):
+    """Build the values found at the given prefixes from a stream of ijson parse events.
+
+    Args:
+        events: Iterable of (prefix, event, value) tuples from ijson.parse.
+        prefixes (dict): Mapping of ijson prefix to the name to return it under.
+
+    Returns:
+        sections: Dictionary of name to value for each prefix found.
+    """
+    sections = {}
+    builder = None
+    for prefix, event, value in events:
+        if builder is None:
+            if prefix not in prefixes or event in ('map_key', 'end_map', 'end_array'):
+                continue
+            if event in ('start_map', 'start_array'):
+                builder = ObjectBuilder()
+                current_prefix = prefix
+                end_event = 'end_' + event[len('start_'):]
+                builder.event(event, value)
+            else:
+                sections[prefixes[prefix]] = value
+        else:
+            builder.event(event, value)
+            if event == end_event and prefix == current_prefix:
+                sections[prefixes[current_prefix]] = builder.value
+                builder = None
+                if len(sections) == len(prefixes):
+                    break
+    return sections
+
+
+def _stream_interpretation_request(ir_id, ir_version, reports_v6, testing_on, token, session):
+    """Start a streaming download of an interpretation request and return the response."""
+    if ijson is None:
+        raise ImportError('Streaming interpretation requests requires the ijson package. '
+                          'Install it with: pip install ijson')
+    s = session if session else get_cipapi_session(testing_on=testing_on, token=token)
+    response = s.get(_interpretation_request_url(ir_id, ir_version, testing_on), params={'reports_v6': reports_v6},
+                     stream=True)
+    response.raise_for_status()
+    # Let urllib3 undo any gzip content encoding as ijson reads from the raw stream
+    response.raw.decode_content = True
+    return response
@@ -3,15 +3,113 @@ Functions for creating a clinical report (aka summary of findings), submitting a
 This is designed to emulate the closing of a case via the interpretation portal.
 """
 import datetime
+from collections import OrderedDict
+from threading import Lock
 
 from protocols.reports_6_0_0 import (ClinicalReport, FamilyLevelQuestions,
                                      InterpretedGenome,
                                      RareDiseaseExitQuestionnaire)
 
-from .auth import AuthenticatedCIPAPISession
+from .auth import get_cipapi_session
+from .codec import response_json
 from .config import beta_testing_base_url, live_100k_data_base_url
 from .interpretation_requests import get_interpretation_request_list
 
+# Number of cases whose interpreted genome summaries are remembered, see interpreted_genome_summaries()
+INTERPRETED_GENOME_SUMMARIES_SIZE = 1024
+# Interpreted genome summaries keyed by (testing_on, interpretation request ID, version), least recently used first
+_interpreted_genome_summaries = OrderedDict()
+_interpreted_genome_summaries_lock = Lock()
+
+
+class ValidatedPayload(object):
+    """
+    A GeL report models object together with its JSON dictionary, serialised once when created.
+    toJsonDict() returns the cached dictionary, so validating and then submitting the object doesn't serialise it
+    again. Other attributes are read from the wrapped object, which should not be modified after validation.
+    Args:
+        model = GeL report models object (e.g. ClinicalReport)
+        json_dict = optional JSON dictionary of model, if already serialised
+    """
+    def __init__(self, model, json_dict=None):
+        self.model = model
+        self.json_dict = json_dict if json_dict is not None else model.toJsonDict()
+
+    def toJsonDict(self):
+        return self.json_dict
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def validate_payload(model, description="Report models"):
+    """
+    Serialise a GeL report models object once and validate the result, returning a ValidatedPayload.
+    Args:
+        model = GeL report models object (e.g. output from create_cr(validate=False))
+        description = name of the object used in the error raised if it is not valid
+    """
+    payload = ValidatedPayload(model)
+    # Check object is valid using inbuilt validate method. Report errors if not, reusing the serialised dictionary
+    if not model.validate(payload.json_dict):
+        raise TypeError("{description} object not valid. See details:\n{message}".format(
+            description=description,
+            message=model.validate(payload.json_dict, verbose=True).messages
+            )
+        )
+    return payload
+
+
+def validate_payloads(models):
+    """
+    Validate a batch of GeL report models objects (e.g. clinical reports for many cases) in a single pass,
+    serialising each object once.
+    Args:
+        models = iterable of GeL report models objects (e.g. outputs from create_cr(validate=False))
+    Returns:
+        List of ValidatedPayload objects, in the same order as models.
+    Raises TypeError listing every invalid object (by position in the batch) if any are not valid.
+    """
+    payloads = []
+    errors = []
+    for index, model in enumerate(models):
+        payload = ValidatedPayload(model)
+        if not model.validate(payload.json_dict):
+            errors.append("{index} ({name}): {message}".format(
+                index=index,
+                name=type(model).__name__,
+                message=model.validate(payload.json_dict, verbose=True).messages
+                )
+            )
+        payloads.append(payload)
+    if errors:
+        raise TypeError("{num} of {total} objects not valid. See details:\n{message}".format(
+            num=len(errors), total=len(payloads), message="\n".join(errors)
+            )
+        )
+    return payloads
+
+
+def _unwrap(obj):
+    """Return the GeL report models object wrapped by a ValidatedPayload, so it can be nested in another object"""
+    return obj.model if isinstance(obj, ValidatedPayload) else obj
+
+
+def _validate_and_keep(model, description):
+    """
+    Validate a GeL report models object, keeping the JSON dictionary it was validated with on the object so that
+    post_cr() and put_eq() submit it without serialising the object again.
+    """
+    model._validated_json_dict = validate_payload(model, description).json_dict
+
+
+def _json_dict(report):
+    """Return the JSON dictionary to submit for a report, reusing the one made when it was validated"""
+    if isinstance(report, ValidatedPayload):
+        return report.json_dict
+    json_dict = getattr(report, '_validated_json_dict', None)
+    return json_dict if json_dict is not None else report.toJsonDict()
+
 
 def create_cr(
         interpretationRequestId,
@@ -28,7 +126,8 @@ def create_cr(
         uniparentalDisomies=None,
         karyotypes=None,
         additionalAnalysisPanels=None,
-        references=[]
+        references=[],
+        validate=True
         ):
     """Create a GeL Report Models v6 Clinical Report (aka Summary of Findings)
 
@@ -54,6 +153,11 @@ def create_cr(
         references: string (optional)
         referenceDatabasesVersions: dictionary (required) - Use get_reference_db_versions()
         softwareVersions: dictionary (required) - Use gel_software_versions()
+        validate: boolean (optional) - Set to False to skip validation, e.g. to validate many reports in one pass with
+        validate_payloads()
+
+    Returns the ClinicalReport object. If validated, the JSON dictionary it was validated with is kept and submitted
+    by post_cr(), so don't modify the object after creating it.
     """
     # Check date in correct format (YYYY-MM-DD) by converting to datetime object
     reportingDate = datetime.datetime.strptime(reportingDate, "%Y-%m-%d")
@@ -77,17 +181,13 @@ def create_cr(
         referenceDatabasesVersions=referenceDatabasesVersions,
         softwareVersions=softwareVersions
         )
-    # Check clinical report object is valid using inbuilt validate method. Report errors if not.
-    if not cr.validate(cr.toJsonDict()):
-        raise TypeError("Clinical report object not valid. See details:\n{message}".format(
-            message=cr.validate(cr.toJsonDict(), verbose=True).messages
-            )
-        )
-    else:
-        return cr
+    if validate:
+        # Check clinical report object is valid, serialising it once. Report errors if not.
+        _validate_and_keep(cr, "Clinical report")
+    return cr
 
 
-def create_flq(caseSolvedFamily, segregationQuestion, additionalComments):
+def create_flq(caseSolvedFamily, segregationQuestion, additionalComments, validate=True):
     """Create a GeL Report Models v6 Family Level Questionnaire (submitted with exit questionnaire)
 
     See here for field definitions:
@@ -97,6 +197,9 @@ def create_flq(caseSolvedFamily, segregationQuestion, additionalComments):
         caseSolvedFamily: "yes", "no", "partially" or "unknown"
         segregationQuestion: "yes" or "no"
         additionalComments: string
+        validate: boolean (optional) - Set to False to skip validation
+
+    Returns the FamilyLevelQuestions object
     """
     # Create the Family Level Questions object
     flqs = FamilyLevelQuestions(
@@ -104,17 +207,13 @@ def create_flq(caseSolvedFamily, segregationQuestion, additionalComments):
         segregationQuestion=segregationQuestion,
         additionalComments=additionalComments
     )
-    # Check family level questions object is valid using inbuilt validate method. Report errors if not.
-    if not flqs.validate(flqs.toJsonDict()):
-        raise TypeError("Family level questions object not valid. See details:\n{message}".format(
-            message=flqs.validate(flqs.toJsonDict(), verbose=True).messages
-            )
-        )
-    else:
-        return flqs
+    if validate:
+        # Check family level questions object is valid, serialising it once. Report errors if not.
+        _validate_and_keep(flqs, "Family level questions")
+    return flqs
 
 
-def create_eq(eventDate, reporter, familyLevelQuestions, variantGroupLevelQuestions=[]):
+def create_eq(eventDate, reporter, familyLevelQuestions, variantGroupLevelQuestions=[], validate=True):
     """Create a GeL Report Models v6 Exit Questionnaire
 
     See here for field definitions:
@@ -126,6 +225,11 @@ def create_eq(eventDate, reporter, familyLevelQuestions, variantGroupLevelQuesti
         familyLevelQuestions: populated FamilyLevelQuestions object (output from create_flq())
         variantGroupLevelQuestions: VariantGroupLevelQuestions object (optional - for negatives
         with no variants just submit empty list, this emulates closing a case through interpretation portal)
+        validate: boolean (optional) - Set to False to skip validation, e.g. to validate many exit questionnaires in
+        one pass with validate_payloads()
+
+    Returns the RareDiseaseExitQuestionnaire object. If validated, the JSON dictionary it was validated with is kept
+    and submitted by put_eq(), so don't modify the object after creating it.
     """
     # Get date into correct format (YYYY-MM-DD) by converting to datetime object
     eventDate = datetime.datetime.strptime(eventDate, "%Y-%m-%d")
@@ -135,24 +239,25 @@ def create_eq(eventDate, reporter, familyLevelQuestions, variantGroupLevelQuesti
     eq = RareDiseaseExitQuestionnaire(
         eventDate=eventDate,
         reporter=reporter,
-        familyLevelQuestions=familyLevelQuestions,
-        variantGroupLevelQuestions=variantGroupLevelQuestions
+        familyLevelQuestions=_unwrap(familyLevelQuestions),
+        variantGroupLevelQuestions=[_unwrap(vglq) for vglq in variantGroupLevelQuestions]
     )
-    # Check exit questionnaire object is valid using inbuilt validate method. Report errors if not.
-    if not eq.validate(eq.toJsonDict()):
-        raise TypeError("Exit questionnaire object not valid. See details:\n{message}".format(message=eq.validate(eq.toJsonDict(), verbose=True).messages))
-    else:
-        return eq
+    if validate:
+        # Check exit questionnaire object is valid, serialising it once. Report errors if not.
+        _validate_and_keep(eq, "Exit questionnaire")
+    return eq
 
-def post_cr(ir_json_v6, clinical_report, testing_on=False, token=None):
+def post_cr(ir_json_v6, clinical_report, testing_on=False, token=None, session=None):
     """
     Submit clinical report (aka summary of findings) to CIP-API.
     This uses genomics_england_tiering as the analysis partner, emulating the closing of a case through
     the interpretation portal. It is currently hardcoded for raredisease.
     Args:
         ir_json_v6 = get using interpretation_requests.get_interpretation_request_json() with reports_v6=True
-        clinical_report = populated clinical report object output from create_cr()
+        clinical_report = populated clinical report object output from create_cr(), or a ValidatedPayload
+        from validate_payloads() (either is submitted using the JSON dictionary made when it was validated)
         testing_on = setting to True will use beta cip-api rather than live
+        session = optional authenticated session, defaults to the shared session
     """
     # Get the full interpretation request ID (including cip prefix and version e.g. SAP-12345-1)
     ir_id = ir_json_v6.get('case_id')
@@ -168,26 +273,29 @@ def post_cr(ir_json_v6, clinical_report, testing_on=False, token=None):
         cip_api_url = live_100k_data_base_url
     # Create urls for uploading summary of findings
     summary_of_findings_url = cip_api_url + cr_endpoint
-    # Open Authenticated CIP-API session:
-    gel_session = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    # Use the supplied or shared authenticated CIP-API session:
+    gel_session = session if session else get_cipapi_session(testing_on=testing_on, token=token)
     # Upload Summary of findings:
-    response = gel_session.post(url=summary_of_findings_url, json=clinical_report.toJsonDict())
+    response = gel_session.post(url=summary_of_findings_url, json=_json_dict(clinical_report))
     # Raise error if unsuccessful status code returned
     response.raise_for_status()
 
-    return response.json()
+    return response_json(response)
 
 
-def put_eq(exit_questionnaire, ir_id, ir_version, clinical_report_version=1, testing_on=False, token=None):
+def put_eq(exit_questionnaire, ir_id, ir_version, clinical_report_version=1, testing_on=False, token=None,
+           session=None):
     """
     Submit exit questionnaire to CIP-API.
     Args:
-        exit_questionnaire = populated exit_questionnaire object output from create_cr()
+        exit_questionnaire = populated exit_questionnaire object output from create_eq(), or a ValidatedPayload
+        from validate_payloads() (either is submitted using the JSON dictionary made when it was validated)
         ir_id = interpretation request ID (without cip prefix or version, i.e. would be '12345' for SAP-12345-1)
         ir_version = interpretation request version (the version following the ir-id, i.e. would be '1' for SAP-12345-1)
         clinical_report_version = If there are multiple summary of findings for a case (use num_existing_reports() to check)
         which one should the exit questionnaire be attached to? default = 1
         testing_on = setting to True will use beta cip-api rather than live
+        session = optional authenticated session, defaults to the shared session
     """
     # Create endpoint from user supplied variables ir_id and ir_version (hardcoded clinical_report_version 1 is OK
     # because script checks no other clinical reports have been generated before calling this function:
@@ -201,14 +309,14 @@ def put_eq(exit_questionnaire, ir_id, ir_version, clinical_report_version=1, tes
         cip_api_url = live_100k_data_base_url
     # Create urls for uploading exit questionnaire
     exit_questionnaire_url = cip_api_url + eq_endpoint
-    # Open Authenticated CIP-API session:
-    gel_session = AuthenticatedCIPAPISession(testing_on=testing_on, token=token)
+    # Use the supplied or shared authenticated CIP-API session:
+    gel_session = session if session else get_cipapi_session(testing_on=testing_on, token=token)
     # Upload Exit Questionnaire:
-    response = gel_session.put(url=exit_questionnaire_url, json=exit_questionnaire.toJsonDict())
+    response = gel_session.put(url=exit_questionnaire_url, json=_json_dict(exit_questionnaire))
     # Raise error if unsuccessful status code returned
     response.raise_for_status()
 
-    return response.json()
+    return response_json(response)
 
 
 def num_existing_reports(ir_json_v6):
@@ -229,22 +337,81 @@ def get_ref_db_versions(ir_json_v6):
     return {"genomeAssembly": ir_json_v6.get('assembly')}
 
 
-def gel_software_versions(ir_json_v6):
+def gel_software_versions(ir_json_v6, testing_on=False):
     """
     This returns a dictionary that can be submitted for the softwareVersions field of clinical report
     This function will pull out the softwareVersions from the genomics_england_tiering interpreted genome
     (equivalent to creating summary of findings in the interpretation portal)
+    Args:
+        ir_json_v6 = get using interpretation_requests.get_interpretation_request_json() with reports_v6=True
+        testing_on = set to True if ir_json_v6 was downloaded from the beta cip-api rather than live
     """
     # Loop through interpreted genomes, and pull out softwareVersions from the genomics_england_tiering interpreted genome
-    interpreted_genomes = ir_json_v6['interpreted_genome']
-    for ig in interpreted_genomes:
-        ig_obj = InterpretedGenome.fromJsonDict(ig['interpreted_genome_data'])
-        cip = ig_obj.interpretationService.lower()
-        if cip == 'genomics_england_tiering':
-            return ig_obj.softwareVersions
+    for summary in interpreted_genome_summaries(ir_json_v6, testing_on=testing_on):
+        if summary['interpretationService'].lower() == 'genomics_england_tiering':
+            return summary['softwareVersions']
+
+
+def interpreted_genome_summaries(ir_json_v6, testing_on=False):
+    """
+    This returns a list with the interpretationService and softwareVersions of each interpreted genome in a case.
+    The fields are read straight from the interpreted genome JSON rather than parsing the whole InterpretedGenome
+    model, which is slow for genomes with many variants. The model is only parsed if a field is missing from the JSON.
+    Results are remembered for the INTERPRETED_GENOME_SUMMARIES_SIZE most recently used interpretation request IDs and
+    versions on live and beta, which share IDs (use clear_interpreted_genome_summaries() to forget them).
+    Args:
+        ir_json_v6 = get using interpretation_requests.get_interpretation_request_json() with reports_v6=True
+        testing_on = set to True if ir_json_v6 was downloaded from the beta cip-api rather than live
+    """
+    key = _interpretation_request_key(ir_json_v6)
+    if key is not None:
+        key = (bool(testing_on),) + key
+        with _interpreted_genome_summaries_lock:
+            if key in _interpreted_genome_summaries:
+                _interpreted_genome_summaries.move_to_end(key)
+                return _interpreted_genome_summaries[key]
+    summaries = []
+    for ig in ir_json_v6['interpreted_genome']:
+        ig_data = ig['interpreted_genome_data']
+        if 'interpretationService' in ig_data and 'softwareVersions' in ig_data:
+            summaries.append({'interpretationService': ig_data['interpretationService'],
+                              'softwareVersions': ig_data['softwareVersions']})
+        else:
+            ig_obj = parse_interpreted_genome(ig)
+            summaries.append({'interpretationService': ig_obj.interpretationService,
+                              'softwareVersions': ig_obj.softwareVersions})
+    if key is not None:
+        with _interpreted_genome_summaries_lock:
+            _interpreted_genome_summaries[key] = summaries
+            while len(_interpreted_genome_summaries) > INTERPRETED_GENOME_SUMMARIES_SIZE:
+                _interpreted_genome_summaries.popitem(last=False)
+    return summaries
+
+
+def parse_interpreted_genome(interpreted_genome):
+    """
+    This returns the GeL Report Models v6 InterpretedGenome object for an interpreted genome from an ir json.
+    Use this when the full model is needed, interpreted_genome_summaries() is much quicker for the service and
+    software versions.
+    """
+    return InterpretedGenome.fromJsonDict(interpreted_genome['interpreted_genome_data'])
+
+
+def clear_interpreted_genome_summaries():
+    """Forget the interpreted genome summaries remembered by interpreted_genome_summaries()"""
+    with _interpreted_genome_summaries_lock:
+        _interpreted_genome_summaries.clear()
+
+
+def _interpretation_request_key(ir_json_v6):
+    """Return (interpretation request ID, version) from the case_id of an ir json (e.g. SAP-12345-1), or None"""
+    case_id = ir_json_v6.get('case_id')
+    if not case_id or case_id.count('-') < 2:
+        return None
+    return tuple(case_id.rsplit('-', 2)[1:])
 
 
-def download_sum_findings(ir_id, ir_version, clinical_report_version=1):
+def download_sum_findings(ir_id, ir_version, clinical_report_version=1, session=None):
     """
     Downloads summary of findings HTML for a given case
 
@@ -253,8 +420,11 @@ def download_sum_findings(ir_id, ir_version, clinical_report_version=1):
         ir_version = interpretation request version (the version following the ir-id, i.e. would be '1' for SAP-12345-1)
         clinical_report_version = If there are multiple summary of findings for a case (use num_existing_reports() to check)
         which one should be downloaded? default = 1
+        session = optional authenticated session, defaults to the shared session
     """
-    ir_details = get_interpretation_request_list(interpretation_request_id=ir_id, version=ir_version)
+    # Use the supplied or shared authenticated CIP-API session:
+    session = session if session else get_cipapi_session()
+    ir_details = get_interpretation_request_list(interpretation_request_id=ir_id, version=ir_version, session=session)
     # Check only one record is returned
     if len(ir_details) != 1:
         raise Exception(
@@ -266,7 +436,6 @@ def download_sum_findings(ir_id, ir_version, clinical_report_version=1):
                 )
             )
     # Download the report from CIP API
-    session = AuthenticatedCIPAPISession()
     response = session.get(ir_details[0]["clinical_reports"][clinical_report_version-1]['url'])
     # Raise error if unsuccessful status code returned
     response.raise_for_status()
@@ -0,0 +1,222 @@
+"""HTTP transport with retries, rate limiting and a circuit breaker, used by the CIP-API and openCGA sessions."""
+from __future__ import print_function
+
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from .config import (circuit_breaker_failures, circuit_breaker_reset_seconds, rate_limit_per_second, retry_attempts,
+                     retry_backoff, retry_max_backoff)
+
+# HTTP status codes which indicate a transient server problem worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# HTTP status codes counted as server failures by the circuit breaker (429 means slow down, not broken)
+FAILURE_STATUS_CODES = (500, 502, 503, 504)
+# Methods which are safe to send again if the first attempt fails
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a request while the circuit breaker is open."""
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket limiting the average request rate.
+
+    Up to capacity requests can be made in a burst, after which requests are
+    spaced out to rate per second. Callers reserve a token and wait for the
+    returned delay, so waiting threads are served in the order they arrive.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate (float): Average number of requests per second.
+            capacity (int): Maximum burst size, defaults to one second's worth of requests.
+        """
+        self.rate = float(rate)
+        self.capacity = capacity if capacity else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self):
+        """Take a token, returning the number of seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a server which keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and
+    requests raise CircuitOpenError without being sent. Once reset_seconds
+    have passed a single trial request is let through; if it succeeds the
+    circuit closes, otherwise it stays open for another reset_seconds. Every
+    request let through by before_request() must be followed by a call to
+    record(), whatever its outcome, or the trial never ends.
+    """
+
+    def __init__(self, failure_threshold=circuit_breaker_failures, reset_seconds=circuit_breaker_reset_seconds):
+        """
+        Args:
+            failure_threshold (int): Consecutive failures which open the circuit.
+            reset_seconds (float): Seconds to wait before sending a trial request.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = Lock()
+
+    def before_request(self):
+        """Raise CircuitOpenError if the circuit is open and a request should not be sent."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial_in_flight or time.monotonic() - self.opened_at < self.reset_seconds:
+                raise CircuitOpenError('Circuit breaker open after {} consecutive failures'.format(self.failures))
+            self._trial_in_flight = True
+
+    def record(self, success):
+        """Record the outcome of a request."""
+        with self._lock:
+            self._trial_in_flight = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+
+
+def retry_delay(attempt, backoff=retry_backoff, max_backoff=retry_max_backoff, retry_after=None):
+    """Seconds to wait before retry number attempt (counting from 0).
+
+    The server's Retry-After is used if given, otherwise a random delay of up
+    to backoff * 2 ** attempt so that many clients retrying at once are spread
+    out. Either is capped at max_backoff, so a far off Retry-After doesn't
+    block a worker for hours.
+    """
+    if retry_after is not None:
+        return min(retry_after, max_backoff)
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    """Convert a Retry-After header (seconds or an HTTP date) to seconds from now, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryingHTTPAdapter(HTTPAdapter):
+    """requests transport adapter which retries, rate limits and circuit breaks requests.
+
+    Idempotent requests (GET, HEAD, OPTIONS) which fail with a connection
+    error, timeout or one of RETRY_STATUS_CODES are retried with jittered
+    exponential backoff, honouring any Retry-After header. If every attempt
+    fails the last response is returned (or the last exception raised) as it
+    would be without retries. Every attempt, including retries, takes a token
+    from the rate limiter and is counted by the circuit breaker.
+    """
+
+    def __init__(self, retries=retry_attempts, backoff=retry_backoff, max_backoff=retry_max_backoff,
+                 rate_limiter=None, circuit_breaker=None, metrics=None, **kwargs):
+        """
+        Args:
+            retries (int): Number of times to retry a failed idempotent request.
+            backoff (float): Maximum seconds to wait before the first retry, doubling for each retry.
+            max_backoff (float): Maximum seconds to wait between retries.
+            rate_limiter (TokenBucket): Optional rate limiter.
+            circuit_breaker (CircuitBreaker): Optional circuit breaker.
+            metrics (Metrics): Optional metrics to count retries in.
+            **kwargs: HTTPAdapter arguments, eg pool_connections and pool_maxsize.
+        """
+        HTTPAdapter.__init__(self, **kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
+
+    def send(self, request, **kwargs):
+        retries = self.retries if request.method in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_request()
+            try:
+                response = HTTPAdapter.send(self, request, **kwargs)
+            except (ConnectionError, Timeout):
+                self._record(False)
+                if attempt == retries:
+                    raise
+                self._record_retry(request)
+                time.sleep(retry_delay(attempt, self.backoff, self.max_backoff))
+                continue
+            except BaseException:
+                # Any other error still counts as a failure, so a half-open trial always ends
+                self._record(False)
+                raise
+            self._record(response.status_code not in FAILURE_STATUS_CODES)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            delay = retry_delay(attempt, self.backoff, self.max_backoff,
+                                parse_retry_after(response.headers.get('Retry-After')))
+            # Release the connection back to the pool before waiting
+            response.close()
+            self._record_retry(request)
+            time.sleep(delay)
+
+    def _record(self, success):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(success)
+
+    def _record_retry(self, request):
+        if self.metrics is not None:
+            self.metrics.record_retry(request.method, request.url)
+
+
+def make_adapter(pool_size, **kwargs):
+    """Make a RetryingHTTPAdapter configured from config.py, with its own rate limiter and circuit breaker.
+
+    Args:
+        pool_size (int): Number of keep-alive connections to pool per host.
+        **kwargs: Override RetryingHTTPAdapter arguments.
+    """
+    options = {
+        'rate_limiter': TokenBucket(rate_limit_per_second) if rate_limit_per_second else None,
+        'circuit_breaker': CircuitBreaker() if circuit_breaker_failures else None,
+    }
+    options.update(kwargs)
+    return RetryingHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, **options)
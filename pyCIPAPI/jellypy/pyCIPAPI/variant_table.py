@@ -0,0 +1,151 @@
+"""Functions for building columnar tables of tiered variants from interpretation requests.
+
+Tables pay off when many cases are combined and summarised at once. For a
+single case, case_tier_counts and write_case_variant_tsv walk the variants
+directly, which is much faster than building a table per case.
+"""
+from __future__ import print_function
+
+import csv
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from .interpretation_requests import get_call_zygosities, get_pedigree_index, get_variant_tier
+
+# Zygosity values used in GeL report models, plus 'Unknown' for family members without a called genotype
+ZYGOSITIES = ['reference_homozygous', 'heterozygous', 'alternate_homozygous', 'missing', 'half_missing_reference',
+              'half_missing_alternate', 'alternate_hemizigous', 'reference_hemizigous', 'unk', 'na', 'Unknown']
+
+# Family members given a zygosity column in the variant table
+FAMILY_MEMBERS = ('Proband', 'Mother', 'Father')
+
+# Header and columns of the Alamut Batch variant TSV
+VARIANT_TSV_HEADER = ('#id\tchr\tposition\tref\talt\tTier\tproband_zygosity\t'
+                      'mother_zygosity\tfather_zygosity\n')
+VARIANT_TSV_COLUMNS = ['dbSNPid', 'chromosome', 'position', 'reference', 'alternate', 'tier', 'proband_zygosity',
+                       'mother_zygosity', 'father_zygosity']
+
+
+def variant_table(interpretation_request, case_id=None, family_members=FAMILY_MEMBERS):
+    """Make a columnar table of the tiered variants in an interpretation request.
+
+    Chromosome, reference and alternate alleles and zygosities are stored as
+    categoricals and the tier as int8, so tables for many cases can be
+    concatenated and summarised without walking the nested variant dicts.
+
+    Args:
+        interpretation_request: JSON representation of an interpretation
+            request (output of get_interpretation_request_json).
+        case_id (str): Identifier for the case in the table, defaults to the
+            case_id of the interpretation request.
+        family_members: Relations to proband to make zygosity columns for.
+
+    Returns:
+        table: pandas DataFrame with one row per tiered variant and columns
+            case_id, dbSNPid, chromosome, position, reference, alternate,
+            tier and <family_member>_zygosity.
+    """
+    json_request = interpretation_request['interpretation_request_data']['json_request']
+    variants = json_request['TieredVariants']
+    zygosities = {member: [] for member in family_members}
+    if family_members:
+        pedigree_index = get_pedigree_index({'interpretation_request_data': interpretation_request})
+        for variant in variants:
+            for member, zygosity in get_call_zygosities(variant, pedigree_index, family_members).items():
+                zygosities[member].append(zygosity)
+    case_id = case_id if case_id else interpretation_request.get('case_id')
+    table = pd.DataFrame({
+        'case_id': pd.Categorical([case_id] * len(variants)),
+        'dbSNPid': [variant['dbSNPid'] for variant in variants],
+        'chromosome': pd.Categorical([variant['chromosome'] for variant in variants]),
+        'position': np.array([variant['position'] for variant in variants], dtype=np.int64),
+        'reference': pd.Categorical([variant['reference'] for variant in variants]),
+        'alternate': pd.Categorical([variant['alternate'] for variant in variants]),
+        'tier': np.array([get_variant_tier(variant) for variant in variants], dtype=np.int8),
+    })
+    for member in family_members:
+        table['{}_zygosity'.format(member.lower())] = _zygosity_categorical(zygosities[member])
+    return table
+
+
+def concat_variant_tables(tables):
+    """Concatenate variant tables for several cases, keeping categorical columns categorical."""
+    tables = list(tables)
+    if not tables:
+        return pd.DataFrame()
+    categorical_columns = [column for column in tables[0].columns if hasattr(tables[0][column], 'cat')]
+    table = pd.concat(tables, ignore_index=True)
+    for column in categorical_columns:
+        if column.endswith('_zygosity'):
+            table[column] = _zygosity_categorical(table[column].astype(object))
+        else:
+            table[column] = table[column].astype('category')
+    return table
+
+
+def tier_counts(table, tiers=(1, 2, 3)):
+    """Count the variants in each tier for each case in a variant table.
+
+    Args:
+        table: Output of variant_table or concat_variant_tables.
+        tiers: Tiers to report counts for.
+
+    Returns:
+        counts: pandas DataFrame indexed by case_id with a 'T<tier>' column
+            for each tier.
+    """
+    counts = (pd.crosstab(table['case_id'].astype(str), table['tier'])
+              .reindex(columns=list(tiers), fill_value=0))
+    counts.columns = ['T{}'.format(tier) for tier in tiers]
+    return counts
+
+
+def write_variant_tsv(table, path):
+    """Write a variant table as a TSV matching the Alamut Batch format for annotation."""
+    with open(path, 'w') as fout:
+        fout.write(VARIANT_TSV_HEADER)
+        table[VARIANT_TSV_COLUMNS].to_csv(fout, sep='\t', header=False, index=False)
+
+
+def case_tier_counts(interpretation_request, tiers=(1, 2, 3)):
+    """Count the tiered variants of a single interpretation request in each tier.
+
+    Args:
+        interpretation_request: JSON representation of an interpretation
+            request (output of get_interpretation_request_json).
+        tiers: Tiers to report counts for.
+
+    Returns:
+        counts (dict): 'T<tier>' to the number of variants in that tier.
+    """
+    variants = interpretation_request['interpretation_request_data']['json_request']['TieredVariants']
+    counter = Counter(get_variant_tier(variant) for variant in variants)
+    return {'T{}'.format(tier): counter[tier] for tier in tiers}
+
+
+def variant_rows(interpretation_request, family_members=FAMILY_MEMBERS):
+    """Yield a list of the VARIANT_TSV_COLUMNS values for each tiered variant of an interpretation request."""
+    json_request = interpretation_request['interpretation_request_data']['json_request']
+    pedigree_index = get_pedigree_index({'interpretation_request_data': interpretation_request})
+    for variant in json_request['TieredVariants']:
+        zygosities = get_call_zygosities(variant, pedigree_index, family_members)
+        yield ([variant['dbSNPid'], variant['chromosome'], variant['position'], variant['reference'],
+                variant['alternate'], get_variant_tier(variant)] + [zygosities[member] for member in family_members])
+
+
+def write_case_variant_tsv(interpretation_request, path):
+    """Write the tiered variants of a single interpretation request as an Alamut Batch TSV.
+
+    The output is the same as write_variant_tsv(variant_table(interpretation_request), path).
+    """
+    with open(path, 'w', newline='') as fout:
+        fout.write(VARIANT_TSV_HEADER)
+        csv.writer(fout, delimiter='\t', lineterminator='\n').writerows(variant_rows(interpretation_request))
+
+
+def _zygosity_categorical(values):
+    """Make a categorical of zygosities using the fixed GeL categories so codes are comparable across cases."""
+    categories = ZYGOSITIES + sorted(set(values).difference(ZYGOSITIES))
+    return pd.Categorical(values, categories=categories)
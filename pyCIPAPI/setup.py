@@ -21,5 +21,11 @@ setup(
         'requests == 2.22.0',
         'pandas == 0.25.1',
         'openpyxl == 2.6.3'
-    ]
+    ],
+    extras_require={
+        'streaming': ['ijson >= 3.1'],
+        'async': ['aiohttp >= 3.6'],
+        'snapshot': ['pyarrow >= 1.0'],
+        'fastjson': ['orjson >= 3.0'],
+    }
 )
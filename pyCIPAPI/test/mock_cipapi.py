@@ -0,0 +1,318 @@
+"""Offline stand-in for the CIP-API and openCGA, serving synthetic or recorded interpretation requests.
+
+Usage:
+    with MockCIPAPI(num_cases=200, latency=0.01, max_page_size=50) as server:
+        server.patch(monkeypatch)
+        cases = irs.get_interpretation_request_list(session=server.session())
+"""
+import glob
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import jwt
+import maya
+
+import jellypy.pyCIPAPI.async_client as async_client
+import jellypy.pyCIPAPI.auth as auth
+import jellypy.pyCIPAPI.interpretation_requests as irs
+import jellypy.pyCIPAPI.summary_findings as summary_findings
+
+# Filters of the interpretation request list endpoint supported by the mock, matched exactly
+LIST_FILTERS = ('cip', 'sample_type', 'last_status', 'assembly', 'family_id', 'proband_id', 'version')
+
+
+def make_token(expires_in=3600):
+    """Make an unsigned JWT accepted by AuthenticatedCIPAPISession(token=...)."""
+    now = int(time.time())
+    return jwt.encode({'orig_iat': now, 'exp': now + expires_in}, 'secret').decode()
+
+
+def make_interpretation_request(ir_id, version, num_variants=50, site='RGT', last_modified='2020-01-01T00:00:00Z'):
+    """Make a synthetic reports v6 interpretation request json for a trio.
+
+    Args:
+        ir_id (int): Interpretation request ID.
+        version (int): Interpretation request version.
+        num_variants (int): Number of tiered variants, cycling through tiers 1 to 3.
+        site (str): ODS code of the site the case belongs to.
+        last_modified (str): Last modified date of the case.
+    """
+    members = [('p{}'.format(ir_id), None), ('m{}'.format(ir_id), 'Mother'), ('f{}'.format(ir_id), 'Father')]
+    participants = [{'gelId': gel_id, 'isProband': relation is None,
+                     'additionalInformation': {'relation_to_proband': relation} if relation else {}}
+                    for gel_id, relation in members]
+    genotypes = ('heterozygous', 'reference_homozygous', 'alternate_homozygous')
+    variants = [{
+        'dbSNPid': 'rs{}'.format(position),
+        'chromosome': str(position % 22 + 1),
+        'position': 1000 + position * 100,
+        'reference': 'A',
+        'alternate': 'T',
+        'reportEvents': [{'tier': 'TIER{}'.format(position % 3 + 1)}],
+        'calledGenotypes': [{'gelId': gel_id, 'genotype': genotypes[(position + index) % 3]}
+                            for index, (gel_id, relation) in enumerate(members)],
+    } for position in range(num_variants)]
+    return {
+        'interpretation_request_id': '{}-{}'.format(ir_id, version),
+        'case_id': 'SAP-{}-{}'.format(ir_id, version),
+        'version': version,
+        'cip': 'omicia',
+        'sample_type': 'raredisease',
+        'assembly': 'GRCh38',
+        'last_status': 'sent_to_gmcs',
+        'last_modified': last_modified,
+        'family_id': str(ir_id),
+        'proband': 'p{}'.format(ir_id),
+        'number_of_samples': len(members),
+        'sites': [site],
+        'clinical_report': [],
+        'interpreted_genome': [{'interpreted_genome_data': {
+            'interpretationService': 'genomics_england_tiering',
+            'softwareVersions': {'gel-tiering': '1.0.0'},
+            'variants': [],
+        }}],
+        'interpretation_request_data': {'json_request': {
+            'TieredVariants': variants,
+            'pedigree': {'participants': participants},
+        }},
+    }
+
+
+def list_entry(interpretation_request):
+    """Make the interpretation request list entry for an interpretation request json."""
+    return {key: value for key, value in interpretation_request.items()
+            if key not in ('clinical_report', 'interpreted_genome', 'interpretation_request_data')}
+
+
+class MockCIPAPI(object):
+    """Local HTTP server answering the CIP-API and openCGA endpoints used by pyCIPAPI.
+
+    Interpretation requests are synthetic (see make_interpretation_request)
+    or loaded from a directory of recorded reports v6 JSON files. Every
+    request waits latency seconds before it is answered, and list pages hold
+    at most max_page_size results whatever page_size is requested. Submitted
+    clinical reports and exit questionnaires are kept in clinical_reports and
+    exit_questionnaires. openCGA files are served from files, a dictionary of
+    file ID to (study_id, file_format, file_name, content bytes), with
+    support for Range requests. The number of requests answered is counted
+    in requests, and the most answered at once in max_in_flight.
+    """
+
+    def __init__(self, num_cases=100, num_variants=50, fixture_dir=None, latency=0, max_page_size=100,
+                 files=None):
+        """
+        Args:
+            num_cases (int): Number of synthetic interpretation requests, if fixture_dir is not given.
+            num_variants (int): Number of tiered variants in each synthetic interpretation request.
+            fixture_dir (str): Directory of recorded interpretation request JSON files to serve instead.
+            latency (float): Seconds to wait before answering each request.
+            max_page_size (int): Maximum number of results in a list page.
+            files (dict): openCGA files to serve.
+        """
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.files = files if files else {}
+        self.interpretation_requests = {}
+        if fixture_dir:
+            for path in sorted(glob.glob(os.path.join(fixture_dir, '*.json'))):
+                with open(path) as fixture:
+                    interpretation_request = json.load(fixture)
+                ir_id, version = interpretation_request['case_id'].rsplit('-', 2)[1:]
+                self.interpretation_requests[(ir_id, version)] = interpretation_request
+        else:
+            for ir_id in range(1, num_cases + 1):
+                self.interpretation_requests[(str(ir_id), '1')] = make_interpretation_request(
+                    ir_id, 1, num_variants, site=('RGT', 'RVJ', 'R1K')[ir_id % 3])
+        self.cases = [list_entry(interpretation_request)
+                      for interpretation_request in self.interpretation_requests.values()]
+        self.clinical_reports = []
+        self.exit_questionnaires = []
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start serving on a free local port in a background thread."""
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._server.daemon_threads = True
+        host, port = self._server.server_address
+        self.root_url = 'http://{}:{}'.format(host, port)
+        self.base_url = self.root_url + '/api/2/'
+        self.opencga_url = self.root_url + '/opencga/webservices/rest/v1'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop the server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def patch(self, monkeypatch):
+        """Point the live CIP-API base URL used by pyCIPAPI modules at this server."""
+        for module in (irs, summary_findings, async_client):
+            monkeypatch.setattr(module, 'live_100k_data_base_url', self.base_url)
+
+    def session(self, **kwargs):
+        """Make an AuthenticatedCIPAPISession with a local token, without contacting an auth server."""
+        return auth.AuthenticatedCIPAPISession(token=make_token(), **kwargs)
+
+    def opencga_session(self, **kwargs):
+        """Make an openCGA session pointing at this server."""
+        return MockOpenCGASession(self.opencga_url, **kwargs)
+
+
+class MockOpenCGASession(auth.AuthenticatedOpenCGASession):
+    """AuthenticatedOpenCGASession for a MockCIPAPI, using a fixed session ID rather than logging in."""
+
+    def __init__(self, host_url, metrics=None):
+        auth.InstrumentedSession.__init__(self, metrics=metrics)
+        self.host_url = host_url
+        self.authenticate()
+
+    def authenticate(self):
+        self.sid = 'mock-sid'
+        self.auth_time = maya.now()
+        self.auth_expires = self.auth_time.add(minutes=30)
+        return self
+
+
+def _make_handler(mock):
+    """Make a request handler class answering requests from the state of a MockCIPAPI."""
+
+    routes = []
+
+    def route(method, pattern):
+        def register(function):
+            routes.append((method, re.compile(pattern), function))
+            return function
+        return register
+
+    @route('GET', r'^/api/2/interpretation-request/?$')
+    def interpretation_request_list(handler, query):
+        page = int(query.get('page', ['1'])[0])
+        page_size = min(int(query.get('page_size', ['100'])[0]), mock.max_page_size)
+        cases = [case for case in mock.cases
+                 if all(str(case.get(key)) == query[key][0] for key in LIST_FILTERS if key in query)
+                 # interpretation_request_id filters on the ID without its version, eg 12345 for 12345-1
+                 and ('interpretation_request_id' not in query
+                      or case['interpretation_request_id'].split('-')[0] == query['interpretation_request_id'][0])
+                 and ('update_date' not in query or case['last_modified'] >= query['update_date'][0])
+                 and ('workspace' not in query or query['workspace'][0] in case['sites'])]
+        results = cases[(page - 1) * page_size:page * page_size]
+        next_url = None
+        if page * page_size < len(cases):
+            next_query = dict((key, values[0]) for key, values in query.items())
+            next_query.update({'page': page + 1, 'page_size': page_size})
+            next_url = '{}{}?{}'.format(mock.root_url, urlparse(handler.path).path, urlencode(next_query))
+        return 200, {'count': len(cases), 'next': next_url, 'results': results}
+
+    @route('GET', r'^/api/2/interpretation-request/(\d+)/(\d+)/?$')
+    def interpretation_request(handler, query, ir_id, version):
+        interpretation_request = mock.interpretation_requests.get((ir_id, version))
+        if interpretation_request is None:
+            return 404, {'detail': 'Not found.'}
+        return 200, interpretation_request
+
+    @route('GET', r'^/api/2/interpreted-genome/(\d+)/(\d+)/([^/]+)/last/?$')
+    def interpreted_genome(handler, query, ir_id, version, service):
+        interpretation_request = mock.interpretation_requests.get((ir_id, version), {})
+        for interpreted_genome in interpretation_request.get('interpreted_genome', []):
+            if interpreted_genome['interpreted_genome_data']['interpretationService'].lower() == service.lower():
+                return 200, interpreted_genome
+        return 404, {'detail': 'Not found.'}
+
+    @route('POST', r'^/api/2/clinical-report/([^/]+)/([^/]+)/([^/]+)/?$')
+    def clinical_report(handler, query, service, program, case_id):
+        report = handler.read_json()
+        with mock._lock:
+            mock.clinical_reports.append((case_id, report))
+        return 201, report
+
+    @route('PUT', r'^/api/2/exit-questionnaire/(\d+)/(\d+)/(\d+)/?$')
+    def exit_questionnaire(handler, query, ir_id, version, clinical_report_version):
+        questionnaire = handler.read_json()
+        with mock._lock:
+            mock.exit_questionnaires.append(((ir_id, version, clinical_report_version), questionnaire))
+        return 200, questionnaire
+
+    @route('GET', r'^/opencga/webservices/rest/v1/files/search/?$')
+    def file_search(handler, query):
+        names = set(query.get('name', [''])[0].split(','))
+        results = [{'id': file_id, 'name': file_name}
+                   for file_id, (study_id, file_format, file_name, content) in sorted(mock.files.items())
+                   if file_name in names and study_id == query.get('study', [''])[0]
+                   and file_format == query.get('format', [''])[0]]
+        return 200, {'response': [{'result': results}]}
+
+    @route('GET', r'^/opencga/webservices/rest/v1/files/([^/]+)/download/?$')
+    def file_download(handler, query, file_id):
+        if file_id not in mock.files:
+            return 404, {'error': 'File not found'}
+        content = mock.files[file_id][3]
+        match = re.match(r'bytes=(\d+)-', handler.headers.get('Range', ''))
+        if not match:
+            return 200, content
+        start = int(match.group(1))
+        if start >= len(content):
+            return 416, b''
+        return 206, content[start:], {'Content-Range': 'bytes {}-{}/{}'.format(start, len(content) - 1,
+                                                                                len(content))}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def read_json(self):
+            return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+
+        def respond(self):
+            with mock._lock:
+                mock.requests += 1
+                mock.in_flight += 1
+                mock.max_in_flight = max(mock.max_in_flight, mock.in_flight)
+            try:
+                if mock.latency:
+                    time.sleep(mock.latency)
+            finally:
+                with mock._lock:
+                    mock.in_flight -= 1
+            parsed = urlparse(self.path)
+            query = parse_qs(parsed.query)
+            for method, pattern, function in routes:
+                match = pattern.match(parsed.path)
+                if method == self.command and match:
+                    result = function(self, query, *match.groups())
+                    break
+            else:
+                result = 404, {'detail': 'Not found.'}
+            status, body, headers = result if len(result) == 3 else result + ({},)
+            data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream' if isinstance(body, bytes)
+                             else 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,98 @@
+"""
+Throughput benchmarks for jellypy-pyCIPAPI against a local mock CIP-API
+
+Usage:
+    pytest pyCIPAPI/test/test_benchmarks.py --benchmarks --benchmark-only
+"""
+import hashlib
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import jellypy.pyCIPAPI.interpretation_requests as irs
+import jellypy.pyCIPAPI.opencga as opencga
+import jellypy.pyCIPAPI.summary_findings as sf
+import jellypy.pyCIPAPI.variant_table as vt
+from mock_cipapi import MockCIPAPI
+
+NUM_CASES = 200
+FILE_CONTENT = b'##fileformat=VCFv4.2\n' * 50000
+
+# Only run with --benchmarks, see conftest.py
+pytestmark = pytest.mark.benchmarks
+
+
+@pytest.fixture(scope='module')
+def server():
+    """Mock CIP-API with 5ms latency per request and at most 50 cases per list page."""
+    files = {'file-1': ('study-1', 'VCF', 'sample.vcf.gz', FILE_CONTENT)}
+    with MockCIPAPI(num_cases=NUM_CASES, num_variants=200, latency=0.005, max_page_size=50, files=files) as mock:
+        yield mock
+
+
+@pytest.fixture
+def mock_cipapi(server, monkeypatch):
+    server.patch(monkeypatch)
+    return server
+
+
+def test_list_pagination(benchmark, mock_cipapi):
+    """Download every page of the interpretation request list"""
+    session = mock_cipapi.session()
+    cases = benchmark.pedantic(irs.get_interpretation_request_list, kwargs={'page_size': 50, 'session': session},
+                               rounds=5)
+    assert len(cases) == NUM_CASES
+
+
+def test_bulk_interpretation_request_fetch(benchmark, mock_cipapi):
+    """Download every interpretation request with 16 concurrent requests"""
+    session = mock_cipapi.session()
+    ir_ids = sorted(mock_cipapi.interpretation_requests)
+
+    def fetch():
+        return list(irs.get_interpretation_request_jsons(ir_ids, max_workers=16, session=session))
+    results = benchmark.pedantic(fetch, rounds=3)
+    assert all(irjson is not None for ir_id, ir_version, irjson in results)
+
+
+def test_tiered_variant_export(benchmark, mock_cipapi, tmp_path):
+    """Tabulate the tiered variants of every case and write them to a TSV"""
+    irjsons = list(mock_cipapi.interpretation_requests.values())
+
+    def export():
+        table = vt.concat_variant_tables(vt.variant_table(irjson) for irjson in irjsons)
+        vt.write_variant_tsv(table, str(tmp_path / 'tiered_variants.tsv'))
+        return table
+    table = benchmark.pedantic(export, rounds=3)
+    assert len(table) == NUM_CASES * 200
+
+
+def test_clinical_report_submission(benchmark, mock_cipapi):
+    """Build, validate and submit a clinical report for 50 cases"""
+    session = mock_cipapi.session()
+    irjsons = list(mock_cipapi.interpretation_requests.values())[:50]
+
+    def submit():
+        for irjson in irjsons:
+            ir_id, ir_version = irjson['interpretation_request_id'].split('-')
+            cr = sf.create_cr(interpretationRequestId=ir_id, interpretationRequestVersion=int(ir_version),
+                              reportingDate='2020-01-01', user='jbloggs',
+                              genomicInterpretation="No tier 1 or 2 variants detected",
+                              referenceDatabasesVersions=sf.get_ref_db_versions(irjson),
+                              softwareVersions=sf.gel_software_versions(irjson))
+            sf.post_cr(irjson, cr, session=session)
+    benchmark.pedantic(submit, rounds=3)
+    assert len(mock_cipapi.clinical_reports) >= 50
+
+
+def test_opencga_download(benchmark, mock_cipapi, tmp_path):
+    """Find and download a file from openCGA"""
+    session = mock_cipapi.opencga_session()
+
+    def download():
+        file_id = opencga.find_file_id('study-1', 'VCF', 'sample.vcf.gz', session=session)
+        path = opencga.download_file(file_id, 'study-1', 'sample.vcf.gz', download_folder=str(tmp_path),
+                                     session=session, resume=False, md5=hashlib.md5(FILE_CONTENT).hexdigest())
+        return path
+    assert benchmark.pedantic(download, rounds=3) is not None
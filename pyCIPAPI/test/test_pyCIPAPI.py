@@ -5,11 +5,35 @@ Tests for jellypy-pyCIPAPI package
 Usage:
     pytest tierup/test/test_requests.py --jpconfig=tierup/test/config.ini
 """
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import math
+import sqlite3
+import time
+
+import jwt
 import pytest
+import requests
 
 import jellypy.pyCIPAPI.config as config
+import jellypy.pyCIPAPI.async_client as async_client
 import jellypy.pyCIPAPI.auth as auth
+import jellypy.pyCIPAPI.cache as cache
+import jellypy.pyCIPAPI.case_store as case_store
+import jellypy.pyCIPAPI.codec as codec
 import jellypy.pyCIPAPI.interpretation_requests as irs
+import jellypy.pyCIPAPI.metrics as metrics
+import jellypy.pyCIPAPI.selection as selection
+import jellypy.pyCIPAPI.snapshot as snapshot
+import jellypy.pyCIPAPI.opencga as opencga
+import jellypy.pyCIPAPI.streaming as streaming
+import jellypy.pyCIPAPI.summary_findings as sf
+import jellypy.pyCIPAPI.transport as transport
+import jellypy.pyCIPAPI.variant_table as vt
+from mock_cipapi import MockCIPAPI, make_interpretation_request
 
 
 def test_import():
@@ -39,3 +63,747 @@ def test_get_irjson(jpconfig):
     # Attempt to get a known interpretation request. This can be changed in the test config.
     data = irs.get_interpretation_request_json(irid, irversion, reports_v6=True, session=session)
     assert isinstance(data, dict)
+
+
+def make_token(expires_in=3600):
+    """Make an unsigned-verification JWT token with the claims read by AuthenticatedCIPAPISession."""
+    now = int(time.time())
+    token = jwt.encode({'orig_iat': now, 'exp': now + expires_in}, 'secret')
+    return token.decode() if isinstance(token, bytes) else token
+
+
+def test_shared_session():
+    """get_cipapi_session returns one shared session per token and environment"""
+    auth.clear_cipapi_sessions()
+    token = make_token()
+    session = auth.get_cipapi_session(token=token)
+    assert auth.get_cipapi_session(token=token) is session
+    assert auth.get_cipapi_session(token=make_token(7200)) is not session
+    assert session.headers['Authorization'] == 'JWT ' + token
+    auth.clear_cipapi_sessions()
+    assert auth.get_cipapi_session(token=token) is not session
+
+
+def test_shared_session_expired_token():
+    """Sessions built from a supplied token raise once the token is due to expire"""
+    auth.clear_cipapi_sessions()
+    session = auth.get_cipapi_session(token=make_token())
+    session.auth_expires = session.auth_time
+    with pytest.raises(Exception, match='expired'):
+        auth.get_cipapi_session(token=session.headers['Authorization'][4:])
+    auth.clear_cipapi_sessions()
+
+
+class FakeResponse(object):
+    """Minimal stand-in for requests.Response returned by FakeSession."""
+
+    def __init__(self, status_code=200, data=None):
+        self.status_code = status_code
+        self.data = data
+        self.content = json.dumps(data).encode()
+        self.raw = io.BytesIO(self.content)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(response=self)
+
+
+class FakeSession(object):
+    """Session returning queued responses for each URL, recording the URLs requested."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requested = []
+
+    def get(self, url, params=None, **kwargs):
+        self.requested.append(url)
+        return self.responses[url].pop(0)
+
+
+def test_get_interpretation_request_jsons():
+    """Interpretation requests are downloaded in bulk, retrying transient errors"""
+    url = config.live_100k_data_base_url + 'interpretation-request/{}/{}/'
+    responses = {url.format(i, 1): [FakeResponse(data={'case': i})] for i in range(10)}
+    responses[url.format(3, 1)].insert(0, FakeResponse(503))
+    responses[url.format(5, 1)] = [FakeResponse(404)]
+    session = FakeSession(responses)
+    results = irs.get_interpretation_request_jsons(((i, 1) for i in range(10)), max_workers=3,
+                                                   session=session, retries=1, backoff=0)
+    results = {ir_id: data for ir_id, ir_version, data in results}
+    assert len(results) == 10
+    assert results[3] == {'case': 3}
+    assert results[5] is None
+    assert session.requested.count(url.format(3, 1)) == 2
+
+
+def test_get_interpretation_request_list_pages():
+    """All pages of the interpretation request list are fetched and returned in order"""
+    url = config.live_100k_data_base_url + 'interpretation-request'
+    page_url = url + '?page={}&page_size=2'
+    responses = {url: [FakeResponse(data={'count': 7, 'next': page_url.format(2), 'results': [0, 1]})]}
+    for page in range(2, 5):
+        results = list(range((page - 1) * 2, min(page * 2, 7)))
+        responses[page_url.format(page)] = [FakeResponse(data={'count': 7, 'next': None, 'results': results})]
+    session = FakeSession(responses)
+    assert irs.get_interpretation_request_list(page_size=2, session=session, max_workers=2) == list(range(7))
+    assert len(session.requested) == 4
+
+
+def test_content_cache(tmp_path):
+    """Cached documents are validated, and least recently used entries are evicted"""
+    content_cache = cache.ContentCache(str(tmp_path / 'cache.sqlite'))
+    content_cache.put('a', {'case': 'a'}, validator='v1')
+    assert content_cache.get('a', validator='v1') == {'case': 'a'}
+    assert content_cache.get('a') == {'case': 'a'}
+    assert content_cache.get('a', validator='v2') is None
+    assert content_cache.get('b') is None
+    # Shrink the cache so that only one entry fits
+    content_cache.max_bytes = content_cache._db.execute('SELECT size FROM entries').fetchone()[0]
+    content_cache.put('b', {'case': 'b'})
+    assert len(content_cache) == 1
+    assert content_cache.get('a') is None
+    assert content_cache.get('b') == {'case': 'b'}
+
+
+def test_content_cache_buffers_hits(tmp_path):
+    """Hits are written in one batch by the next put, and evict by the access times of recent hits"""
+    content_cache = cache.ContentCache(str(tmp_path / 'cache.sqlite'))
+    content_cache.put('a', {'case': 'a'})
+    content_cache.put('b', {'case': 'b'})
+    stored = dict(content_cache._db.execute('SELECT key, last_access FROM entries'))
+    assert content_cache.get('a') == {'case': 'a'}
+    assert dict(content_cache._db.execute('SELECT key, last_access FROM entries')) == stored
+    # Room for two entries, so adding a third evicts b, which was used least recently
+    content_cache.max_bytes = content_cache._total
+    content_cache.put('c', {'case': 'c'})
+    assert sorted(key for (key,) in content_cache._db.execute('SELECT key FROM entries')) == ['a', 'c']
+    assert content_cache._total == content_cache._size()
+    content_cache.put('c', {'case': 'c', 'more': list(range(100))})
+    assert content_cache._total == content_cache._size()
+    content_cache.close()
+    # Closing the cache writes the access times of hits since the last put
+    with cache.ContentCache(str(tmp_path / 'cache.sqlite')) as content_cache:
+        content_cache.put('d', {'case': 'd'})
+        stored = dict(content_cache._db.execute('SELECT key, last_access FROM entries'))
+        assert content_cache.get('d') == {'case': 'd'}
+    with cache.ContentCache(str(tmp_path / 'cache.sqlite')) as content_cache:
+        assert dict(content_cache._db.execute('SELECT key, last_access FROM entries'))['d'] > stored['d']
+
+
+def test_get_interpretation_request_jsons_cache(tmp_path):
+    """Bulk downloads only request cases missing from the cache or changed since caching"""
+    content_cache = cache.ContentCache(str(tmp_path / 'cache.sqlite'))
+    url = config.live_100k_data_base_url + 'interpretation-request/{}/1/'
+    session = FakeSession({url.format(i): [FakeResponse(data={'case': i})] * 2 for i in range(3)})
+    validators = {(i, 1): 'v1' for i in range(3)}
+    list(irs.get_interpretation_request_jsons([(i, 1) for i in range(3)], session=session,
+                                              cache=content_cache, validators=validators))
+    validators[(2, 1)] = 'v2'
+    results = list(irs.get_interpretation_request_jsons([(i, 1) for i in range(3)], session=session,
+                                                        cache=content_cache, validators=validators))
+    assert sorted(data['case'] for ir_id, ir_version, data in results) == [0, 1, 2]
+    assert len(session.requested) == 4
+
+
+def test_case_store_sync(tmp_path, monkeypatch):
+    """Case store syncs request only cases updated since the previous sync"""
+    requested = []
+
+    def fake_list(update_date=None, **kwargs):
+        requested.append(update_date)
+        if update_date is None:
+            return [{'interpretation_request_id': '1-1', 'status': 'a'}, {'interpretation_request_id': '2-1'}]
+        return [{'interpretation_request_id': '1-1', 'status': 'b'}]
+
+    monkeypatch.setattr(case_store, 'get_interpretation_request_list', fake_list)
+    store = case_store.CaseStore(str(tmp_path / 'cases.sqlite'))
+    assert store.sync() == 2
+    assert store.sync() == 1
+    assert requested[0] is None and requested[1] is not None
+    assert len(store) == 2
+    assert store.get('1-1')['status'] == 'b'
+
+
+def test_case_store_query(tmp_path):
+    """Cases are selected by site, status and update date using the indexed columns"""
+    path = str(tmp_path / 'cases.sqlite')
+    # A store written before the indexed columns existed is upgraded when opened
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE cases (interpretation_request_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+    db.execute('INSERT INTO cases VALUES (?, ?)', ('1-1', json.dumps(
+        {'interpretation_request_id': '1-1', 'sites': ['RR8'], 'last_status': 'sent_to_gmcs',
+         'last_modified': '2020-01-01T10:00:00Z', 'family_id': 100})))
+    db.commit()
+    db.close()
+    store = case_store.CaseStore(path)
+    store.update([
+        {'interpretation_request_id': '2-1', 'sites': ['RR8', 'RGT'], 'last_status': 'report_sent',
+         'last_modified': '2020-02-01T10:00:00Z', 'family_id': 200},
+        {'interpretation_request_id': '3-1', 'sites': ['RGT'], 'last_status': 'sent_to_gmcs',
+         'last_modified': '2020-03-01T10:00:00Z', 'family_id': 300},
+    ])
+    ids = lambda cases: [case['interpretation_request_id'] for case in cases]
+    assert ids(store.query()) == ['1-1', '2-1', '3-1']
+    assert ids(store.query(sites='RR8')) == ['1-1', '2-1']
+    assert ids(store.query(sites=['RR8', 'RGT'], last_status='sent_to_gmcs')) == ['1-1', '3-1']
+    assert ids(store.query(family_id=100)) == ['1-1']
+    assert ids(store.query(updated_since='2020-02-01', updated_before='2020-03-01')) == ['2-1']
+    store.update([{'interpretation_request_id': '2-1', 'sites': ['RGT']}])
+    assert ids(store.query(sites='RR8')) == ['1-1']
+
+
+def test_streaming_sections():
+    """Tiered variants and selected sections are read from a streamed interpretation request"""
+    pytest.importorskip('ijson')
+    url = config.live_100k_data_base_url + 'interpretation-request/1/1/'
+    irjson = {
+        'case_id': 'SAP-1-1',
+        'interpretation_request_data': {'json_request': {
+            'TieredVariants': [{'position': 1, 'af': 0.5}, {'position': 2}],
+            'pedigree': {'participants': [{'gelId': 'p1', 'isProband': True}]},
+        }},
+        'clinical_report': [],
+        'interpreted_genome': [{'interpreted_genome_data': {'interpretationService': 'x'}}],
+    }
+    session = FakeSession({url: [FakeResponse(data=irjson), FakeResponse(data=irjson)]})
+    variants = list(streaming.iter_tiered_variants(1, 1, session=session))
+    assert variants == irjson['interpretation_request_data']['json_request']['TieredVariants']
+    sections = streaming.get_interpretation_request_sections(1, 1, sections=('pedigree', 'clinical_report', 'case_id'),
+                                                             session=session)
+    assert sections == {'pedigree': irjson['interpretation_request_data']['json_request']['pedigree'],
+                        'clinical_report': [], 'case_id': 'SAP-1-1'}
+
+
+def make_irjson(variants):
+    """Make a minimal interpretation request json for a trio with the given tiered variants."""
+    participants = [
+        {'gelId': 'p1', 'isProband': True},
+        {'gelId': 'm1', 'isProband': False, 'additionalInformation': {'relation_to_proband': 'Mother'}},
+        {'gelId': 'f1', 'isProband': False, 'additionalInformation': {'relation_to_proband': 'Father'}},
+    ]
+    return {'case_id': 'SAP-1-1', 'interpretation_request_data': {'json_request': {
+        'TieredVariants': variants, 'pedigree': {'participants': participants}}}}
+
+
+def make_variant(position, tier, genotypes):
+    """Make a minimal tiered variant with the given tier and {gelId: genotype} calls."""
+    return {'dbSNPid': 'rs{}'.format(position), 'chromosome': '1', 'position': position, 'reference': 'A',
+            'alternate': 'T', 'reportEvents': [{'tier': 'TIER{}'.format(tier)}, {'tier': 'TIER3'}],
+            'calledGenotypes': [{'gelId': gel_id, 'genotype': genotype} for gel_id, genotype in genotypes.items()]}
+
+
+def test_variant_table(tmp_path):
+    """Tiered variants are converted to a typed table with tier counts and TSV export"""
+    irjson = make_irjson([make_variant(1, 1, {'p1': 'heterozygous', 'm1': 'reference_homozygous'}),
+                          make_variant(2, 3, {'p1': 'alternate_homozygous'})])
+    table = vt.variant_table(irjson)
+    assert table['tier'].dtype == 'int8'
+    assert list(table['proband_zygosity']) == ['heterozygous', 'alternate_homozygous']
+    assert list(table['father_zygosity']) == ['Unknown', 'Unknown']
+    empty = vt.variant_table(make_irjson([]), case_id='SAP-2-1')
+    combined = vt.concat_variant_tables([table, empty])
+    assert vt.tier_counts(combined).loc['SAP-1-1'].tolist() == [1, 0, 1]
+    assert vt.tier_counts(empty).sum().tolist() == [0, 0, 0]
+    tsv = tmp_path / 'variants.tsv'
+    vt.write_variant_tsv(table, str(tsv))
+    lines = tsv.read_text().splitlines()
+    assert lines[1] == 'rs1\t1\t1\tA\tT\t1\theterozygous\treference_homozygous\tUnknown'
+    assert vt.case_tier_counts(irjson) == {'T1': 1, 'T2': 0, 'T3': 1}
+    case_tsv = tmp_path / 'case_variants.tsv'
+    vt.write_case_variant_tsv(irjson, str(case_tsv))
+    assert case_tsv.read_bytes() == tsv.read_bytes()
+
+
+def test_call_zygosities():
+    """All family members' zygosities are resolved from the pedigree index in one call"""
+    variant = make_variant(1, 1, {'p1': 'heterozygous', 'm1': 'reference_homozygous', 's1': 'heterozygous'})
+    pedigree_index = irs.get_pedigree_index({'interpretation_request_data': make_irjson([variant])})
+    assert pedigree_index == {'p1': 'Proband', 'm1': 'Mother', 'f1': 'Father'}
+    assert irs.get_call_zygosities(variant, pedigree_index) == {
+        'Proband': 'heterozygous', 'Mother': 'reference_homozygous', 'Father': 'Unknown'}
+
+
+class FakeDownloadSession(object):
+    """openCGA session serving a file which is cut short on the first request."""
+
+    host_url = 'https://opencga.test'
+    sid = 'sid'
+
+    def __init__(self, content, status_code=None):
+        self.content = content
+        self.status_code = status_code
+        self.range_headers = []
+        self.responses = []
+
+    def get(self, url, stream=False, headers=None):
+        offset = int(headers['Range'][len('bytes='):-1]) if headers else 0
+        self.range_headers.append(offset)
+        response = FakeResponse(self.status_code or (206 if offset else 200))
+        self.responses.append(response)
+        response.headers = {'Content-Length': str(len(self.content) - offset)}
+        if offset:
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(offset, len(self.content) - 1,
+                                                                       len(self.content))
+        # The first request is interrupted half way through
+        body = self.content[offset:] if offset else self.content[:len(self.content) // 2]
+        response.iter_content = lambda chunk_size: [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        return response
+
+
+def test_download_file_resume(tmp_path):
+    """Interrupted openCGA downloads are resumed with a Range request and verified"""
+    content = b'0123456789' * 10
+    session = FakeDownloadSession(content)
+    md5 = hashlib.md5(content).hexdigest()
+    args = (1, 2, 'file.vcf.gz')
+    assert opencga.download_file(*args, download_folder=str(tmp_path), session=session, chunk_size=7, md5=md5) is None
+    path = opencga.download_file(*args, download_folder=str(tmp_path), session=session, chunk_size=7, md5=md5)
+    assert session.range_headers == [0, 50]
+    assert path == str(tmp_path / 'file.vcf.gz')
+    assert (tmp_path / 'file.vcf.gz').read_bytes() == content
+    assert all(response.closed for response in session.responses)
+
+
+def test_download_files_failure(tmp_path):
+    """A download which fails part way through is recorded as None without losing the other downloads"""
+    content = b'0123456789' * 10
+
+    class FailingSession(FakeDownloadSession):
+        """Serves whole files, except file 2 whose connection drops after the first chunk."""
+        def get(self, url, stream=False, headers=None):
+            response = FakeDownloadSession.get(self, url, stream=stream, headers=headers)
+
+            def iter_content(chunk_size):
+                for i in range(0, len(content), chunk_size):
+                    if i and '/files/2/' in url:
+                        raise requests.exceptions.ChunkedEncodingError('Connection broken')
+                    yield content[i:i + chunk_size]
+            response.iter_content = iter_content
+            return response
+
+    session = FailingSession(content)
+    paths = opencga.download_files([(i, 5, 'file{}.vcf.gz'.format(i)) for i in (1, 2, 3)],
+                                   download_folder=str(tmp_path), session=session, max_workers=3, chunk_size=7)
+    assert paths == {'file1.vcf.gz': str(tmp_path / 'file1.vcf.gz'), 'file2.vcf.gz': None,
+                     'file3.vcf.gz': str(tmp_path / 'file3.vcf.gz')}
+    assert (tmp_path / 'file2.vcf.gz.part').read_bytes() == content[:7]
+    assert all(response.closed for response in session.responses)
+
+
+def test_download_file_error_closes_response(tmp_path):
+    """Streamed responses are closed when the download can't be started"""
+    session = FakeDownloadSession(b'0123456789', status_code=403)
+    assert opencga.download_file(1, 2, 'file.vcf.gz', download_folder=str(tmp_path), session=session) is None
+    assert len(session.responses) == 1 and session.responses[0].closed
+
+
+def test_find_file_ids(tmp_path):
+    """openCGA file IDs are resolved in grouped searches and cached"""
+    class FakeSearchSession(FakeDownloadSession):
+        def get(self, url, **kwargs):
+            self.range_headers.append(url)
+            names = url.split('&name=')[1].split('&')[0].split(',')
+            results = [{'name': name, 'id': int(name[1:])} for name in names if name != 'f9']
+            # Duplicated name, the later created file should be ignored
+            results.append({'name': 'f1', 'id': 100})
+            return FakeResponse(data={'response': [{'result': results}]})
+
+    session = FakeSearchSession(b'')
+    content_cache = cache.ContentCache(str(tmp_path / 'cache.sqlite'))
+    files = [(1, 'VCF', 'f{}'.format(i)) for i in range(1, 10)] + [(2, 'BAM', 'f1')]
+    file_ids = opencga.find_file_ids(files, session=session, batch_size=4, cache=content_cache)
+    assert file_ids[(1, 'VCF', 'f1')] == 1
+    assert file_ids[(1, 'VCF', 'f9')] is None
+    assert file_ids[(2, 'BAM', 'f1')] == 1
+    assert len(session.range_headers) == 4
+    assert opencga.find_file_id(1, 'VCF', 'f2', session=session) == 2
+    opencga.find_file_ids(files[:8], session=session, cache=content_cache)
+    assert len(session.range_headers) == 5
+
+
+def test_get_interpreted_genomes_for_cases():
+    """Interpreted genomes for many cases are downloaded concurrently"""
+    url = config.live_100k_data_base_url + 'interpreted-genome/{}/1/pharma/last/?reports_v6=true'
+    session = FakeSession({url.format(i): [FakeResponse(data={'case': i})] for i in range(5)})
+    results = irs.get_interpreted_genomes_for_cases([(i, 1) for i in range(5)], 'pharma', max_workers=2,
+                                                     session=session)
+    assert sorted(genome['case'] for ir, version, genome in results) == list(range(5))
+
+
+def make_cr(user='jbloggs', validate=True):
+    return sf.create_cr(interpretationRequestId='12345', interpretationRequestVersion=1, reportingDate='2020-01-01',
+                        user=user, genomicInterpretation="No tier 1 or 2 variants detected",
+                        referenceDatabasesVersions={'genomeAssembly': 'GRCh38'}, softwareVersions={},
+                        validate=validate)
+
+
+def test_validated_payload_serialised_once(monkeypatch):
+    """Report objects are serialised once and the cached JSON is reused for submission"""
+    calls = []
+    to_json_dict = sf.ClinicalReport.toJsonDict
+    monkeypatch.setattr(sf.ClinicalReport, 'toJsonDict', lambda self: calls.append(1) or to_json_dict(self))
+    cr, = sf.validate_payloads([make_cr(validate=False)])
+    assert cr.toJsonDict() is cr.toJsonDict()
+    assert cr.user == 'jbloggs'
+    assert len(calls) == 1
+    # Validating on creation keeps the report models return types, and post_cr submits the validated JSON
+    calls[:] = []
+    cr = make_cr()
+    assert isinstance(cr, sf.ClinicalReport)
+    session = FakeSession({})
+    session.post = lambda url, json=None: session.requested.append(json) or FakeResponse(201, data=json)
+    sf.post_cr({'case_id': 'SAP-12345-1'}, cr, session=session)
+    assert session.requested == [cr._validated_json_dict] and len(calls) == 1
+    eq = sf.create_eq('2020-01-01', 'jbloggs', sf.create_flq('no', 'no', 'comment'))
+    assert isinstance(eq, sf.RareDiseaseExitQuestionnaire)
+    assert eq.toJsonDict()['familyLevelQuestions']['caseSolvedFamily'] == 'no'
+
+
+def test_validate_payloads():
+    """A batch of reports is validated in one pass, reporting every invalid report"""
+    payloads = sf.validate_payloads([make_cr(validate=False) for i in range(3)])
+    assert [payload.toJsonDict()['user'] for payload in payloads] == ['jbloggs'] * 3
+    with pytest.raises(TypeError) as error:
+        sf.validate_payloads([make_cr(validate=False), make_cr(user=1, validate=False)])
+    assert str(error.value).startswith('1 of 2 objects not valid')
+    with pytest.raises(TypeError):
+        make_cr(user=1)
+
+
+def test_gel_software_versions(monkeypatch):
+    """Software versions are read from the raw interpreted genome json and remembered for each case"""
+    sf.clear_interpreted_genome_summaries()
+    monkeypatch.setattr(sf.InterpretedGenome, 'fromJsonDict', None)
+    ir_json = {'case_id': 'SAP-12345-1', 'interpreted_genome': [
+        {'interpreted_genome_data': {'interpretationService': 'Exomiser', 'softwareVersions': {'exomiser': '1'}}},
+        {'interpreted_genome_data': {'interpretationService': 'genomics_england_tiering',
+                                     'softwareVersions': {'gel-tiering': '1.0'}}},
+    ]}
+    assert sf.gel_software_versions(ir_json) == {'gel-tiering': '1.0'}
+    ir_json['interpreted_genome'] = []
+    assert sf.gel_software_versions(ir_json) == {'gel-tiering': '1.0'}
+    # Beta cases share IDs with live cases
+    assert sf.gel_software_versions(ir_json, testing_on=True) is None
+    sf.clear_interpreted_genome_summaries()
+    assert sf.gel_software_versions(ir_json) is None
+
+
+def test_interpreted_genome_summaries_bounded(monkeypatch):
+    """Only the most recently used cases' interpreted genome summaries are remembered"""
+    sf.clear_interpreted_genome_summaries()
+    monkeypatch.setattr(sf, 'INTERPRETED_GENOME_SUMMARIES_SIZE', 2)
+    for ir_id in (1, 2, 1, 3):
+        sf.interpreted_genome_summaries({'case_id': 'SAP-{}-1'.format(ir_id), 'interpreted_genome': []})
+    assert list(sf._interpreted_genome_summaries) == [(False, '1', '1'), (False, '3', '1')]
+    sf.clear_interpreted_genome_summaries()
+
+
+def test_async_client(monkeypatch):
+    """The asyncio client shares one token across concurrent requests and downloads list pages concurrently"""
+    web = pytest.importorskip('aiohttp.web')
+    calls = []
+
+    async def get_ir(request):
+        calls.append(request.headers['Authorization'])
+        return web.json_response({'case_id': 'SAP-{}-{}'.format(request.match_info['ir_id'],
+                                                                 request.match_info['version'])})
+
+    async def get_list(request):
+        page = int(request.query.get('page', 1))
+        next_url = str(request.url.update_query({'page': page + 1})) if page < 3 else None
+        return web.json_response({'count': 5, 'next': next_url,
+                                  'results': [{'page': page}] * (2 if page < 3 else 1)})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/2/interpretation-request/{ir_id}/{version}/', get_ir)
+        app.router.add_get('/api/2/interpretation-request', get_list)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(async_client, 'live_100k_data_base_url', 'http://127.0.0.1:{}/api/2/'.format(port))
+        try:
+            async with async_client.AsyncCIPAPIClient(token=make_token(), max_concurrency=4) as client:
+                irjsons = await client.get_interpretation_request_jsons([(i, 1) for i in range(20)])
+                cases = await client.get_interpretation_request_list(page_size=2)
+                # A trial request which fails before it is sent still ends the trial
+                client.circuit_breaker = transport.CircuitBreaker(failure_threshold=1, reset_seconds=0)
+                client.circuit_breaker.record(False)
+                with pytest.raises(TypeError):
+                    await client.request('GET', async_client.live_100k_data_base_url, params={'bad': object()})
+                client.circuit_breaker.before_request()
+        finally:
+            await runner.cleanup()
+        return irjsons, cases
+
+    irjsons, cases = asyncio.run(run())
+    assert [irjson['case_id'] for ir_id, version, irjson in irjsons] == ['SAP-{}-1'.format(i) for i in range(20)]
+    assert len(set(calls)) == 1
+    assert [case['page'] for case in cases] == [1, 1, 2, 2, 3]
+
+
+def test_async_client_authenticate(monkeypatch):
+    """The asyncio client decodes Active Directory token responses with the codec"""
+    web = pytest.importorskip('aiohttp.web')
+    decoded = []
+    loads = async_client.loads
+    monkeypatch.setattr(async_client, 'loads', lambda data: decoded.append(data) or loads(data))
+    monkeypatch.setattr(async_client, 'use_active_directory', True)
+    now = int(time.time())
+
+    async def get_token(request):
+        return web.json_response({'access_token': 'abc', 'not_before': str(now), 'expires_on': str(now + 3600)})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/token', get_token)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(async_client, 'live_100K_auth_url', 'http://127.0.0.1:{}/token'.format(port))
+        try:
+            credentials = {'client_id': 'id', 'client_secret': 'secret'}
+            async with async_client.AsyncCIPAPIClient(auth_credentials=credentials) as client:
+                await client.authenticate()
+                return client.headers['Authorization'], client.auth_expires
+        finally:
+            await runner.cleanup()
+
+    authorization, expires = asyncio.run(run())
+    assert authorization == 'JWT abc' and expires == datetime.datetime.fromtimestamp(now + 3600)
+    assert len(decoded) == 1 and isinstance(decoded[0], bytes)
+
+
+class FlakyAdapter(transport.RetryingHTTPAdapter):
+    """RetryingHTTPAdapter which returns canned responses rather than using the network"""
+
+    def __init__(self, statuses, **kwargs):
+        transport.RetryingHTTPAdapter.__init__(self, backoff=0, **kwargs)
+        self.statuses = list(statuses)
+        self.sent = 0
+
+    def build_fake_response(self, request, status):
+        response = requests.Response()
+        response.status_code = status
+        response.request = request
+        response.raw = io.BytesIO(b'{}')
+        if status == 429:
+            response.headers['Retry-After'] = '0'
+        return response
+
+
+def test_retrying_adapter(monkeypatch):
+    """Idempotent requests are retried on transient errors, other requests are not"""
+    def send(self, request, **kwargs):
+        self.sent += 1
+        status = self.statuses.pop(0)
+        if status is None:
+            raise requests.exceptions.ConnectionError('connection reset')
+        return self.build_fake_response(request, status)
+    monkeypatch.setattr(transport.HTTPAdapter, 'send', send)
+    session = requests.Session()
+    adapter = FlakyAdapter([503, None, 429, 200, 503])
+    session.mount('http://', adapter)
+    assert session.get('http://cipapi/').status_code == 200
+    assert adapter.sent == 4
+    assert session.post('http://cipapi/').status_code == 503
+    assert adapter.sent == 5
+
+
+def test_circuit_breaker(monkeypatch):
+    """The circuit opens after repeated failures and closes after a successful trial request"""
+    clock = [0.0]
+    monkeypatch.setattr(transport.time, 'monotonic', lambda: clock[0])
+    breaker = transport.CircuitBreaker(failure_threshold=2, reset_seconds=10)
+    breaker.record(False)
+    breaker.before_request()
+    breaker.record(False)
+    with pytest.raises(transport.CircuitOpenError):
+        breaker.before_request()
+    clock[0] = 11
+    breaker.before_request()
+    with pytest.raises(transport.CircuitOpenError):
+        breaker.before_request()
+    breaker.record(True)
+    breaker.before_request()
+    # Any error during a trial request ends the trial, not just connection errors
+    monkeypatch.setattr(transport.HTTPAdapter, 'send', lambda self, request, **kwargs: 1 / 0)
+    breaker = transport.CircuitBreaker(failure_threshold=1, reset_seconds=10)
+    session = requests.Session()
+    session.mount('http://', transport.RetryingHTTPAdapter(retries=0, circuit_breaker=breaker))
+    breaker.record(False)
+    for attempt in range(2):
+        clock[0] += 11
+        with pytest.raises(ZeroDivisionError):
+            session.get('http://cipapi/')
+    # An open circuit stops a bulk download rather than being reported as a missing case
+    session = FakeSession({})
+    session.get = lambda url, params=None, **kwargs: breaker.before_request()
+    with pytest.raises(transport.CircuitOpenError):
+        list(irs.get_interpretation_request_jsons([(1, 1), (2, 1)], session=session))
+
+
+def test_token_bucket(monkeypatch):
+    """Requests beyond the burst capacity are spaced out to the rate limit"""
+    monkeypatch.setattr(transport.time, 'monotonic', lambda: 0.0)
+    bucket = transport.TokenBucket(rate=2, capacity=2)
+    assert [bucket.reserve() for i in range(4)] == [0, 0, 0.5, 1.0]
+    assert transport.parse_retry_after('3') == 3
+    assert transport.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+
+def test_retry_delay_bounded():
+    """A Retry-After longer than max_backoff is capped"""
+    assert transport.retry_delay(0, max_backoff=60, retry_after=3) == 3
+    assert transport.retry_delay(0, max_backoff=60, retry_after=86400) == 60
+    far_off = transport.parse_retry_after('Fri, 01 Jan 2100 00:00:00 GMT')
+    assert transport.retry_delay(0, max_backoff=60, retry_after=far_off) == 60
+    assert 0 <= transport.retry_delay(10, backoff=1, max_backoff=60) <= 60
+
+
+def test_interpreted_genome_errors():
+    """A missing analysis returns None but an invalid response is an error"""
+    url = config.live_100k_data_base_url + 'interpreted-genome/{}/1/pharma/last/?reports_v6=true'
+    truncated = FakeResponse(200)
+    truncated.content = b'{"interpreted_genome_data": '
+    session = FakeSession({url.format(1): [FakeResponse(404)], url.format(2): [truncated]})
+    assert irs.get_interpreted_genome_for_case(1, 1, 'pharma', session=session) is None
+    with pytest.raises(ValueError):
+        irs.get_interpreted_genome_for_case(2, 1, 'pharma', session=session)
+
+
+def test_session_metrics(tmp_path, monkeypatch):
+    """Sessions record latency, size and retries per endpoint, and caches record hit rates"""
+    statuses = [503, 200, 200]
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = statuses.pop(0)
+        response.request = request
+        response.raw = io.BytesIO(b'{"results": []}')
+        response.headers['Content-Length'] = '15'
+        return response
+    monkeypatch.setattr(transport.HTTPAdapter, 'send', send)
+    monkeypatch.setattr(transport, 'retry_delay', lambda *args, **kwargs: 0)
+    recorder = metrics.Metrics(trace_path=str(tmp_path / 'trace.jsonl'))
+    session = auth.AuthenticatedCIPAPISession(token=make_token(), metrics=recorder)
+    session.get(config.live_100k_data_base_url + 'interpretation-request/12345/1/')
+    session.get(config.live_100k_data_base_url + 'interpretation-request/12346/2/')
+    content_cache = cache.ContentCache(str(tmp_path / 'cache.sqlite'), metrics=recorder)
+    content_cache.get('missing')
+    snapshot = recorder.snapshot()
+    stats, = snapshot['requests']
+    assert stats['endpoint'] == 'interpretation-request/{id}/{id}/'
+    assert (stats['count'], stats['retries'], stats['bytes_received']) == (2, 1, 30)
+    assert stats['buckets']['+Inf'] == 2
+    assert snapshot['caches']['content_cache'] == {'hits': 0, 'misses': 1, 'hit_rate': 0.0}
+    prometheus = recorder.to_prometheus()
+    assert 'jellypy_request_retries_total{method="GET",endpoint="interpretation-request/{id}/{id}/"} 1' in prometheus
+    assert 'jellypy_cache_lookups_total{cache="content_cache",result="miss"} 1' in prometheus
+    recorder.disable_trace()
+    assert len(open(str(tmp_path / 'trace.jsonl')).readlines()) == 2
+
+
+def test_select_cases(tmp_path, monkeypatch):
+    """Case selection runs one list query per site in parallel and merges the results"""
+    assert selection.build_queries() == [{}]
+    assert selection.build_queries(sites=['RR8', 'RGT'], sample_type='cancer', last_status=None) == [
+        {'sample_type': 'cancer', 'workspace': 'RR8'}, {'sample_type': 'cancer', 'workspace': 'RGT'}]
+    with MockCIPAPI(num_cases=30, num_variants=0, max_page_size=4) as server:
+        server.patch(monkeypatch)
+        session = server.session()
+        cases = selection.select_cases(sites=['RGT', 'RVJ'], session=session)
+        assert sorted(int(case['interpretation_request_id'].split('-')[0]) for case in cases) == \
+            [ir_id for ir_id in range(1, 31) if ir_id % 3 != 2]
+        store = case_store.CaseStore(str(tmp_path / 'cases.sqlite'))
+        assert selection.sync_selection(store, sites=['RGT', 'RVJ'], session=session) == 20
+        assert len(store.query(sites='RVJ')) == 10
+
+
+
+def test_sync_selection_overlaps_sites(tmp_path, monkeypatch):
+    """Each site's list query downloads at the same time, rather than waiting for the case store"""
+    latency = 0.3
+    with MockCIPAPI(num_cases=30, num_variants=0, latency=latency) as server:
+        server.patch(monkeypatch)
+        store = case_store.CaseStore(str(tmp_path / 'cases.sqlite'))
+        started = time.time()
+        assert selection.sync_selection(store, sites=['RGT', 'RVJ', 'R1K'], session=server.session()) == 30
+        # One page per site: about one latency in parallel, three if the sites ran one at a time
+        assert time.time() - started < 2 * latency
+
+
+def test_selection_bounds_requests_in_flight(tmp_path, monkeypatch):
+    """Sites and their list pages share max_workers, rather than each site downloading max_workers pages"""
+    with MockCIPAPI(num_cases=60, num_variants=0, latency=0.05, max_page_size=5) as server:
+        server.patch(monkeypatch)
+        sites = ['RGT', 'RVJ', 'R1K']
+        assert selection.split_workers(4, len(sites)) == (3, 1)
+        assert selection.split_workers(100, 1) == (1, config.connection_pool_size)
+        cases = selection.select_cases(sites=sites, max_workers=4, session=server.session())
+        assert len(cases) == 60
+        store = case_store.CaseStore(str(tmp_path / 'cases.sqlite'))
+        assert selection.sync_selection(store, sites=sites, max_workers=4, session=server.session()) == 60
+        assert 1 < server.max_in_flight <= 4
+
+
+def test_snapshot_round_trip(tmp_path):
+    """Case lists and variant tables are written to Parquet and read back a column at a time"""
+    pytest.importorskip('pyarrow')
+    cases = [
+        {'interpretation_request_id': '1-1', 'sites': ['RR8'], 'T1': 2, 'files': [{'name': 'a.vcf'}],
+         'interpretation_request_data': {'json_request': {}}},
+        {'interpretation_request_id': '2-1', 'sites': ['RGT', 'RR8'], 'T1': 0, 'files': []},
+    ]
+    path = snapshot.save_case_list(cases, fmt='parquet', directory=str(tmp_path))
+    assert path.endswith('_interpretation_request_audit.parquet')
+    assert snapshot.load_case_list(directory=str(tmp_path)) == [
+        {'interpretation_request_id': '1-1', 'sites': ['RR8'], 'T1': 2, 'files': [{'name': 'a.vcf'}]},
+        {'interpretation_request_id': '2-1', 'sites': ['RGT', 'RR8'], 'T1': 0, 'files': []},
+    ]
+    assert snapshot.load_case_list(columns=['T1'], directory=str(tmp_path)) == [{'T1': 2}, {'T1': 0}]
+    with pytest.raises(FileNotFoundError):
+        snapshot.load_case_list(directory=str(tmp_path / 'missing'))
+    assert list(snapshot.read_snapshot(path, columns=['interpretation_request_id', 'T1'])['T1']) == [2, 0]
+    json_path = snapshot.save_case_list(cases, fmt='json', directory=str(tmp_path))
+    assert snapshot.read_snapshot_records(json_path, columns=['T1']) == [{'T1': 2}, {'T1': 0}]
+    irjson = make_interpretation_request(1, 1, num_variants=6)
+    table = vt.variant_table(irjson)
+    snapshot.write_snapshot(table, str(tmp_path / 'variants.parquet'))
+    assert snapshot.read_snapshot(str(tmp_path / 'variants.parquet'), columns=['tier'])['tier'].tolist() == \
+        table['tier'].tolist()
+    with pytest.raises(ValueError):
+        snapshot.write_snapshot(cases, str(tmp_path / 'cases.csv'))
+
+
+@pytest.mark.parametrize('backend', codec.BACKENDS)
+def test_codec(backend):
+    """Every installed JSON backend decodes bytes and str and falls back to the standard library"""
+    if backend not in codec.available_backends():
+        pytest.skip('{} is not installed'.format(backend))
+    previous = codec.get_backend()
+    try:
+        assert codec.set_backend(backend) == backend
+        document = {'case_id': 'SAP-1-1', 'variants': [{'position': 1, 'af': 0.5, 'dbSNPid': None}], 'ok': True}
+        assert codec.loads(codec.dumps(document)) == document
+        assert codec.loads(codec.dumps_text(document)) == document
+        assert math.isnan(codec.loads(b'{"af": NaN}')['af'])
+        assert codec.loads(codec.dumps({1: 'a'})) == {'1': 'a'}
+        assert codec.response_json(FakeResponse(data=document)) == document
+        with pytest.raises(ValueError):
+            codec.loads(b'{"case_id": ')
+    finally:
+        codec.set_backend(previous)
+    with pytest.raises(ValueError):
+        codec.set_backend('yaml')
@@ -0,0 +1,228 @@
+"""
+Tests for the scripts using jellypy-pyCIPAPI, run against a local mock CIP-API
+
+Usage:
+    pytest pyCIPAPI/test/test_scripts.py
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+import pytest
+
+import jellypy.pyCIPAPI.cache as cache
+import jellypy.pyCIPAPI.case_store as case_store
+import jellypy.pyCIPAPI.interpretation_requests as irs
+import jellypy.pyCIPAPI.selection as selection
+import jellypy.pyCIPAPI.summary_findings as sf
+from mock_cipapi import MockCIPAPI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+
+import cancer_cases_with_pharma_results  # noqa: E402
+import get_tiered_variants  # noqa: E402
+import neg_batch_close  # noqa: E402
+import variant_count_audit  # noqa: E402
+
+
+@pytest.fixture
+def mock_cipapi(tmp_path, monkeypatch):
+    """Mock CIP-API used by the shared session, with the working directory, cache and case store in tmp_path."""
+    with MockCIPAPI(num_cases=12, num_variants=20) as server:
+        server.patch(monkeypatch)
+        session = server.session()
+        for module in (irs, selection):
+            monkeypatch.setattr(module, 'get_cipapi_session', lambda **kwargs: session)
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'output').mkdir()
+        yield server
+
+
+def test_get_tiered_variants(mock_cipapi, tmp_path, monkeypatch):
+    """A variant TSV is written for every case, and the next run reuses the day's case list snapshot"""
+    monkeypatch.setattr(get_tiered_variants, 'ContentCache', lambda: cache.ContentCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(get_tiered_variants, 'CaseStore', lambda: case_store.CaseStore(str(tmp_path / 'cases')))
+    args = {'--force-update': False, '--json': False, '--workers': '4', '--site': False, 'SITE': []}
+    get_tiered_variants._main(args)
+    outputs = os.listdir(str(tmp_path / 'output'))
+    assert len([name for name in outputs if name.endswith('_tiered_variants.tsv')]) == 12
+    assert len([name for name in outputs if '_interpretation_request_audit.' in name]) == 1
+    lines = (tmp_path / 'output' / '1_1_1_GRCh38_tiered_variants.tsv').read_text().splitlines()
+    assert len(lines) == 21 and lines[0].startswith('#id\t')
+    cases = get_tiered_variants.get_latest_interpretation_request_list(sites=['RVJ'])
+    assert sorted(case['interpretation_request_id'] for case in cases) == ['1-1', '10-1', '4-1', '7-1']
+
+
+def test_variant_count_audit(mock_cipapi, tmp_path, monkeypatch):
+    """Each audited case gets a TSV row, and cases which can't be downloaded are recorded and counted as failures"""
+    caches = []
+    monkeypatch.setattr(variant_count_audit, 'ContentCache',
+                        lambda: caches.append(cache.ContentCache(str(tmp_path / 'cache'))) or caches[-1])
+    # Listed but no longer downloadable
+    del mock_cipapi.interpretation_requests[('5', '1')]
+    for run in range(2):
+        assert variant_count_audit._main(max_workers=4) == 1
+        tsv = tmp_path / variant_count_audit.audit_output_file('tsv')
+        rows = [line.split('\t') for line in tsv.read_text().splitlines()]
+        assert sorted(int(row[0]) for row in rows) == [ir_id for ir_id in range(1, 13) if ir_id != 5]
+        assert set(tuple(row[4:]) for row in rows) == {('7', '7', '6')}
+        jsonl = tmp_path / variant_count_audit.audit_output_file('jsonl')
+        records = [json.loads(line) for line in jsonl.read_text().splitlines()]
+        assert len(records) == 12
+        assert [record['interpretation_request_id'] for record in records
+                if record['audit_status'] == 'failed'] == ['5-1']
+    # The second run's cache hits were saved when the cache was closed
+    assert len(caches) == 2 and caches[1].hits == 11 and not caches[1]._accessed
+
+
+def test_neg_batch_close(mock_cipapi, tmp_path, monkeypatch, capsys):
+    """Cases which can't be downloaded, built or validated are recorded in the ledger without stopping the batch"""
+    sf.clear_interpreted_genome_summaries()
+    monkeypatch.setattr(neg_batch_close, 'get_cipapi_session', lambda **kwargs: mock_cipapi.session())
+    # Not downloadable, a malformed clinical report list and an existing clinical report
+    del mock_cipapi.interpretation_requests[('2', '1')]
+    mock_cipapi.interpretation_requests[('3', '1')]['clinical_report'] = None
+    mock_cipapi.interpretation_requests[('4', '1')]['clinical_report'] = [{'clinical_report_version': 1}]
+    # An invalid clinical report
+    get_ref_db_versions = neg_batch_close.get_ref_db_versions
+    monkeypatch.setattr(neg_batch_close, 'get_ref_db_versions', lambda ir_json: (
+        {'genomeAssembly': 38} if ir_json['case_id'] == 'SAP-5-1' else get_ref_db_versions(ir_json)))
+    batch = tmp_path / 'batch.csv'
+    batch.write_text('interpretation_request,reporter,date\n' + ''.join(
+        '{}-1,jbloggs,2020-01-01\n'.format(ir_id) for ir_id in (1, 2, 3, 4, 5, 6, 6)))
+    args = argparse.Namespace(csv=str(batch), ledger=None, submit='both', workers=4, rate=0, testing=False)
+    neg_batch_close._main(args)
+    assert '6-1 is listed more than once' in capsys.readouterr().out
+    with open(str(batch) + '.ledger.csv') as fin:
+        outcomes = set((row['interpretation_request'], row['step'], row['status']) for row in csv.DictReader(fin))
+    assert outcomes == {
+        ('1-1', 'clinical_report', 'success'), ('1-1', 'exit_questionnaire', 'success'),
+        ('2-1', 'download', 'failed'),
+        ('3-1', 'download', 'failed'),
+        ('4-1', 'clinical_report', 'failed'),
+        ('5-1', 'clinical_report', 'failed'),
+        ('6-1', 'clinical_report', 'success'), ('6-1', 'exit_questionnaire', 'success'),
+    }
+    assert sorted(case_id for case_id, report in mock_cipapi.clinical_reports) == ['SAP-1-1', 'SAP-6-1']
+    assert len(mock_cipapi.exit_questionnaires) == 2
+    # A resumed run only retries the failed cases
+    neg_batch_close._main(args)
+    assert len(mock_cipapi.clinical_reports) == 2
+
+
+def test_cancer_case_details(mock_cipapi, tmp_path):
+    """Only the positive cases are fetched and stored, and cases which can't be found are left out"""
+    store = case_store.CaseStore(str(tmp_path / 'cases'))
+    details = cancer_cases_with_pharma_results.get_case_details(['1-1', '3-1', '99-1'], False, case_store=store)
+    assert sorted(details) == ['1-1', '3-1'] and details['3-1']['proband'] == 'p3'
+    assert sorted(case['interpretation_request_id'] for case in store.cases()) == ['1-1', '3-1']
+    # Stored cases are not fetched again
+    requests = mock_cipapi.requests
+    assert sorted(cancer_cases_with_pharma_results.get_case_details(['1-1'], False, case_store=store)) == ['1-1']
+    assert mock_cipapi.requests == requests
+
+
+def write_vcf(path, contigs, records):
+    """Write an uncompressed vcf with a sample s1, where records are (chrom, pos, ref, alt, qual, genotype)"""
+    lines = ['##fileformat=VCFv4.2']
+    lines += ['##contig=<ID={}>'.format(contig) for contig in contigs]
+    lines += ['##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+              '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1']
+    lines += ['{}\t{}\t.\t{}\t{}\t{}\tPASS\t.\tGT\t{}'.format(*record) for record in records]
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_vcfs_compare(tmp_path):
+    """Files sorted in different contig orders are compared by key, and repeated records are reported"""
+    pytest.importorskip('pysam')
+    import vcfs_compare
+    records = [('chr1', 100, 'A', 'G', 50, '0/1'), ('chr1', 200, 'C', 'T', 50, '1/1'),
+               ('chr2', 100, 'G', 'A', 50, '0/1')]
+    vcf1 = write_vcf(tmp_path / 'a.vcf', ['chr1', 'chr2'], records)
+    vcf2 = write_vcf(tmp_path / 'b.vcf', ['chr2', 'chr1'], records[2:] + records[:2])
+    report = vcfs_compare.compare_vcfs(vcf1, vcf2)
+    assert report['discordances'] == [] and report['compared'] == 3 and not report['sorted']
+
+    vcf2 = write_vcf(tmp_path / 'c.vcf', ['chr1', 'chr2'], [
+        ('chr1', 100, 'A', 'G', 50, '0/1'), ('chr1', 100, 'A', 'G', 50, '0/1'), ('chr1', 200, 'C', 'T', 50, '0/1'),
+        ('chr2', 100, 'G', 'A', 50, '0/1'), ('chr2', 300, 'T', 'C', 50, '0/1')])
+    expected = [('chr1', 100, 'duplicate_in_vcf2', []), ('chr1', 200, 'mismatch', ['sample s1']),
+                ('chr2', 300, 'only_in_vcf2', [])]
+    report = vcfs_compare.compare_vcfs(vcf1, vcf2)
+    assert report['sorted'] and report['compared'] == 4
+    assert [(d.chrom, d.pos, d.kind, d.fields) for d in report['discordances']] == expected
+    _, discordances = vcfs_compare.compare_keyed(vcf1, vcf2, ['s1'])
+    assert [(d.chrom, d.pos, d.kind, d.fields) for d in discordances] == expected
+
+
+def test_vcfs_fingerprint_compare(tmp_path):
+    """Only contigs whose fingerprints differ are compared record by record"""
+    pytest.importorskip('pysam')
+    import vcfs_compare
+    records = [('chr1', 100, 'A', 'G', 50, '0/1'), ('chr1', 200, 'C', 'T', 50, '1/1'),
+               ('chr2', 100, 'G', 'A', 50, '0/1')]
+    vcf1 = write_vcf(tmp_path / 'a.vcf', ['chr1', 'chr2'], records)
+    vcf2 = write_vcf(tmp_path / 'b.vcf', ['chr1', 'chr2'], records)
+    report = vcfs_compare.fingerprint_compare(vcf1, vcf2, processes=2)
+    assert report['contigs_checked'] == [] and report['discordances'] == [] and report['compared'] == 3
+    assert os.path.isfile(vcf1 + vcfs_compare.FINGERPRINT_SUFFIX)
+
+    vcf2 = write_vcf(tmp_path / 'c.vcf', ['chr1', 'chr2'], records[:2] + [('chr2', 100, 'G', 'A', 50, '1/1')])
+    report = vcfs_compare.fingerprint_compare(vcf1, vcf2, processes=2)
+    assert report['contigs_checked'] == ['chr2'] and report['compared'] == 3
+    assert [(d.chrom, d.pos, d.kind, d.fields) for d in report['discordances']] == [
+        ('chr2', 100, 'mismatch', ['sample s1'])]
+
+
+def test_vcf_fingerprint_cache(tmp_path, monkeypatch):
+    """Cached fingerprints are reused until the size or modification time of the vcf changes"""
+    pytest.importorskip('pysam')
+    import vcfs_compare
+    records = [('chr1', 100, 'A', 'G', 50, '0/1'), ('chr2', 100, 'G', 'A', 50, '0/1')]
+    vcf = write_vcf(tmp_path / 'a.vcf', ['chr1', 'chr2'], records)
+    fingerprint = vcfs_compare.vcf_fingerprint(vcf)
+    assert sorted(fingerprint) == ['chr1', 'chr2'] and fingerprint['chr1'][1] == 1
+    normalise_record = vcfs_compare.normalise_record
+    normalised = []
+    monkeypatch.setattr(vcfs_compare, 'normalise_record',
+                        lambda rec, samples: normalised.append(rec.chrom) or normalise_record(rec, samples))
+    assert vcfs_compare.vcf_fingerprint(vcf) == fingerprint
+    assert normalised == []
+
+    # A new modification time
+    stat = os.stat(vcf)
+    os.utime(vcf, (stat.st_atime, stat.st_mtime + 10))
+    assert vcfs_compare.vcf_fingerprint(vcf) == fingerprint
+    assert normalised == ['chr1', 'chr2']
+
+    # A new size, with the modification time put back
+    stat = os.stat(vcf)
+    write_vcf(tmp_path / 'a.vcf', ['chr1', 'chr2'], records + [('chr2', 200, 'C', 'T', 50, '0/1')])
+    os.utime(vcf, (stat.st_atime, stat.st_mtime))
+    assert vcfs_compare.vcf_fingerprint(vcf)['chr2'][1] == 2
+    assert vcfs_compare.vcf_fingerprint(vcf, use_cache=False)['chr2'][1] == 2
+
+
+def test_vcfs_compare_indexed(tmp_path):
+    """Tabix indexed files are compared a contig at a time in parallel, finding the same differences as a merge"""
+    pysam = pytest.importorskip('pysam')
+    import vcfs_compare
+    contigs = ['chr1', 'chr2', 'chr3']
+    records1 = [(contig, pos, 'A', 'G', 50, '0/1') for contig in contigs for pos in (100, 200, 300)]
+    records2 = [record for record in records1 if record[:2] != ('chr1', 200)]
+    records2[records2.index(('chr2', 300, 'A', 'G', 50, '0/1'))] = ('chr2', 300, 'A', 'G', 50, '1/1')
+    records2.append(('chr3', 400, 'T', 'C', 50, '0/1'))
+    plain1 = write_vcf(tmp_path / 'a.vcf', contigs, records1)
+    plain2 = write_vcf(tmp_path / 'b.vcf', contigs, records2)
+    serial = vcfs_compare.compare_vcfs(plain1, plain2)
+    indexed1 = pysam.tabix_index(write_vcf(tmp_path / 'c.vcf', contigs, records1), preset='vcf', force=True)
+    indexed2 = pysam.tabix_index(write_vcf(tmp_path / 'd.vcf', contigs, records2), preset='vcf', force=True)
+    with pysam.VariantFile(indexed1) as vcf:
+        assert vcf.index is not None
+    parallel = vcfs_compare.compare_vcfs(indexed1, indexed2, processes=2)
+    assert [(d.chrom, d.pos, d.kind, d.fields) for d in parallel['discordances']] == [
+        ('chr1', 200, 'only_in_vcf1', []), ('chr2', 300, 'mismatch', ['sample s1']), ('chr3', 400, 'only_in_vcf2', [])]
+    assert parallel['discordances'] == serial['discordances'] and parallel['compared'] == serial['compared'] == 10
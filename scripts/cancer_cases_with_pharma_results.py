@@ -3,8 +3,11 @@ from time import strptime
 from datetime import date, timedelta
 import os
 import pandas as pd
-from jellypy.pyCIPAPI.interpretation_requests import access_date_summary_content, get_interpreted_genome_for_case, \
-    get_interpretation_request_list
+from jellypy.pyCIPAPI.case_store import CaseStore
+from jellypy.pyCIPAPI.config import beta_case_store_path, case_store_path
+from jellypy.pyCIPAPI.interpretation_requests import access_date_summary_content, \
+    get_interpreted_genomes_for_cases
+from jellypy.pyCIPAPI.selection import run_queries
 
 
 def parser_args():
@@ -22,22 +25,23 @@ def parser_args():
     return parser.parse_args()
 
 
-def get_dpyd_cases(case_list, testing):
+def get_dpyd_cases(case_list, testing, max_workers=8):
     """
     Takes a list of cases, tries to find an interpreted genome for the pharma service, and checks if present
     at time of writing, any pharma variants are DPYD, more granular check may be required in future
+    Interpreted genomes are downloaded concurrently over one shared session
     :param case_list: list of case strings in IR-VER format
+    :param max_workers: number of interpreted genomes to download at once
     :return:
     """
 
-    dpyd_cases = []
+    positive_cases = set()
 
-    for case in case_list:
-        ir, ver = case.split('-')
-
-        pharma_genome = get_interpreted_genome_for_case(ir=ir, version=ver,
-                                                        tiering_service='genomics_england_pharmacogenomics',
-                                                        testing_on=testing)
+    cases = [tuple(case.split('-')) for case in case_list]
+    for ir, ver, pharma_genome in get_interpreted_genomes_for_cases(cases,
+                                                                    'genomics_england_pharmacogenomics',
+                                                                    max_workers=max_workers,
+                                                                    testing_on=testing):
 
         if not pharma_genome:
             continue
@@ -45,13 +49,12 @@ def get_dpyd_cases(case_list, testing):
         elif pharma_genome == {'detail': 'Not found.'}:
             continue
 
-        # print(pharma_genome)
-
         if pharma_genome['interpreted_genome_data']['variants']:
             if len(pharma_genome['interpreted_genome_data']['variants']) > 0:
-                dpyd_cases.append(case)
+                positive_cases.add('{}-{}'.format(ir, ver))
 
-    return dpyd_cases
+    # keep the order of the input case list
+    return [case for case in case_list if case in positive_cases]
 
 
 def create_filename(parsed_args):
@@ -68,6 +71,26 @@ def create_filename(parsed_args):
     return filename
 
 
+def get_case_details(case_list, testing, case_store=None):
+    """
+    Gets the interpretation request list entries for a list of cases, from the local case store where they have been
+    stored before, otherwise by querying the list endpoint for each case in parallel (adding them to the store)
+    :param case_list: list of case strings in IR-VER format
+    :param case_store: optional CaseStore, defaults to the live or beta case store
+    :return: dictionary of case string to list entry, without cases which couldn't be found
+    """
+    if case_store is None:
+        case_store = CaseStore(beta_case_store_path if testing else case_store_path)
+    case_jsons = {case: case_store.get(case) for case in case_list}
+    missing = [dict(zip(('interpretation_request_id', 'version'), case.split('-')))
+               for case, case_json in case_jsons.items() if case_json is None]
+    if missing:
+        found = run_queries(missing, testing_on=testing)
+        case_store.update(found)
+        case_jsons.update((case_json['interpretation_request_id'], case_json) for case_json in found)
+    return {case: case_json for case, case_json in case_jsons.items() if case_json is not None}
+
+
 def assemble_output(dpyd_cases, output_name, testing):
     """
 
@@ -76,8 +99,6 @@ def assemble_output(dpyd_cases, output_name, testing):
     :return:
     """
 
-    case_count_df = pd.DataFrame(columns=["case_id", "Participant", "LDP"])
-
     if os.path.exists(output_name + '.xlsx'):
         response_string = '{} exists, do you want to overwrite it?\n(y/n)\n'.format(output_name + '.xlsx')
         try:
@@ -91,14 +112,20 @@ def assemble_output(dpyd_cases, output_name, testing):
                 print(case)
             quit()
 
-    # provided we're not overwriting files and there are cases to write, write them!
-    for count, case in enumerate(dpyd_cases):
-        # get the minimmal endpoint details for a single case - could try/except wrap, but should work
-        case_json = get_interpretation_request_list(interpretation_request_id=case.split('-')[0], testing_on=testing)[0]
-        ldp = case_json['sites'][0]
+    # provided we're not overwriting files and there are cases to write, get the proband and LDP for all cases
+    case_jsons = get_case_details(dpyd_cases, testing)
+
+    rows = []
+    for case in dpyd_cases:
+        case_json = case_jsons.get(case)
+        if case_json is None:
+            print('{} was not found in the interpretation request list, leaving it out of the output'.format(case))
+            continue
+        ldp = case_json['sites'][0] if case_json.get('sites') else None
         proband = case_json['proband']
-        case_count_df.loc[count] = [case, proband, ldp]  # lookup of LDP to GMC shouldn't be required at GMC level
+        rows.append([case, proband, ldp])  # lookup of LDP to GMC shouldn't be required at GMC level
 
+    case_count_df = pd.DataFrame(rows, columns=["case_id", "Participant", "LDP"])
     case_count_df.to_excel(excel_writer=output_name + '.xlsx', sheet_name='DPYD_cases', index=False)
 
 
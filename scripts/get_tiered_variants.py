@@ -1,7 +1,7 @@
 """Output TSV file of tiered variants ready for Alamut Batch annotation.
 
 Usage:
-    get_tiered_variants.py [--force-update] [--site SITE ...]
+    get_tiered_variants.py [--force-update] [--json] [--workers=<n>] [--site SITE ...]
     get_tiered_variants.py (-h | --help)
     get_tiered_variants.py --version
 
@@ -10,49 +10,82 @@ Options:
     --version       Show version.
     --force_update  Get data from API even if a cached version exists.
     --site          One or more site codes to limit output by site, eg: RR8.
+    --json          Also export the interpretation request list as JSON.
+    --workers=<n>   Number of interpretation requests to download in parallel
+                    [default: 8].
 
 """
 from __future__ import print_function, absolute_import
-try:
-    from exceptions import FileNotFoundError as FileError
-except ImportError:
-    from exceptions import IOError as FileError
 import os
-import datetime
-import json
 from docopt import docopt
+from jellypy.pyCIPAPI.cache import ContentCache, case_validator
+from jellypy.pyCIPAPI.case_store import CaseStore
+from jellypy.pyCIPAPI.selection import sync_selection
 from jellypy.pyCIPAPI.interpretation_requests import (
-    get_interpretation_request_json, get_interpretation_request_list,
-    get_pedigree_dict, get_variant_tier, save_interpretation_request_list_json)
+    get_call_zygosities, get_interpretation_request_json,
+    get_interpretation_request_jsons, get_pedigree_dict)
+from jellypy.pyCIPAPI.snapshot import DEFAULT_FORMAT, load_case_list, save_case_list
+from jellypy.pyCIPAPI.variant_table import write_case_variant_tsv
 
 
 def _main(args):
-    # load or get interpretation_request_list
-    interpretation_request_list = (get_latest_interpretation_request_list(
-                                   args['--force-update']))
-    for case in interpretation_request_list:
-        # Ignore cases where the site is not in the list of given sites
-        # Or if no sites have been given do the case handling anyway
-        if (args['--site'] and not
-           set(case['sites']).intersection(set(args['SITE']))):
-            pass
+    # load or get interpretation_request_list, limited to the given sites
+    # if any have been given
+    sites = args['SITE'] if args['--site'] else None
+    selected_cases = (get_latest_interpretation_request_list(
+                      args['--force-update'], sites=sites))
+    # Handle cases which already have their data straight away
+    missing_data = {}
+    for case in selected_cases:
+        if 'interpretation_request_data' in case:
+            handle_interpretation_request(case, args['--force-update'])
         else:
+            missing_data[tuple(case['interpretation_request_id']
+                               .split('-'))] = case
+    # Download the remaining cases in parallel, handling each as it arrives.
+    # Unless forcing an update, cases unchanged since the last run are read
+    # from the local content cache.
+    cache = None if args['--force-update'] else ContentCache()
+    validators = {key: case_validator(case)
+                  for key, case in missing_data.items()}
+    try:
+        for ir_id, ir_version, interpretation_request_data in (
+                get_interpretation_request_jsons(
+                    list(missing_data), max_workers=int(args['--workers']),
+                    cache=cache, validators=validators)):
+            if interpretation_request_data is None:
+                continue
+            case = missing_data[(ir_id, ir_version)]
+            case['interpretation_request_data'] = interpretation_request_data
             handle_interpretation_request(case, args['--force-update'])
-    # Save the interpretation_request_list to JSON
-    save_interpretation_request_list_json(interpretation_request_list,
-                                          args['--force-update'])
-
-
-def get_latest_interpretation_request_list(force_update=False):
+    finally:
+        # Write the access times of cache hits, so eviction keeps them
+        if cache is not None:
+            cache.close()
+    # Save a snapshot of the interpretation_request_list. Only the full list
+    # is saved, so a later run for other sites doesn't load a partial list.
+    # Payloads are left out as they are kept in the content cache.
+    if not sites:
+        save_case_list(selected_cases, fmt=DEFAULT_FORMAT,
+                       force_update=args['--force-update'])
+        if args['--json'] and DEFAULT_FORMAT != 'json':
+            save_case_list(selected_cases, fmt='json',
+                           force_update=args['--force-update'])
+
+
+def get_latest_interpretation_request_list(force_update=False, sites=None):
     """Get the latest version of the interpretation_request_list.
 
     Check if there is a up to date (using today's date) interpretation request
-    list JSON saved to disk. If there is load it, if not use the helper
-    functions to load it.
+    list snapshot saved to disk. If there is load it, if not sync the local case
+    store with cases updated since the last run and query it for the cases at
+    the given sites. When sites are given only their cases are synced, with
+    one list query per site run in parallel.
 
     Args:
-        force_update (bool): If True create the interpretation request list
-            using the helper function, even if an on disk version exists.
+        force_update (bool): If True download the full interpretation request
+            list, even if an on disk version exists.
+        sites (list): Optional site codes to limit the list to.
 
     Returns:
         interpretation_request_list: List of individual interpretation request
@@ -61,20 +94,20 @@ def get_latest_interpretation_request_list(force_update=False):
     """
     if not force_update:
         try:
-            input_file = ('{}_interpretation_request_audit.json'
-                          .format(datetime.datetime.today()
-                                  .strftime('%Y%m%d')))
-            input_file_path = os.path.join(os.getcwd(), 'output', input_file)
-            with open(input_file_path, 'r+') as fin:
-                interpretation_request_list = json.load(fin)
+            interpretation_request_list = load_case_list()
             print('Using cached interpretation request list.')
-        except FileError:
-            print('Querying CIPAPI for interpretation request list.')
-            interpretation_request_list = get_interpretation_request_list()
+            if sites:
+                interpretation_request_list = [
+                    case for case in interpretation_request_list
+                    if set(case['sites']).intersection(sites)]
+            return interpretation_request_list
+        except FileNotFoundError:
+            print('Querying CIPAPI for updated interpretation requests.')
     else:
         print('Querying CIPAPI for interpretation request list.')
-        interpretation_request_list = get_interpretation_request_list()
-    return interpretation_request_list
+    case_store = CaseStore()
+    sync_selection(case_store, sites=sites, full=force_update)
+    return case_store.query(sites=sites)
 
 
 def handle_interpretation_request(interpretation_request, force_update=False):
@@ -132,39 +165,10 @@ def output_variant_tsv(interpretation_request, force_update=False):
     # Check for file existance or force_update boolean
     if not (os.path.isfile(variant_tsv_path)) or (force_update is True):
         print('Writing variants to {}'.format(variant_tsv_path))
-        with open(variant_tsv_path, 'w') as fout:
-            # Write header row ofr human readability
-            header = ('#id\tchr\tposition\tref\talt\tTier\tproband_zygosity\t'
-                      'mother_zygosity\tfather_zygosity\n')
-            fout.write(header)
-            # Construct the row for a given variant
-            for variant in (
-                 interpretation_request['interpretation_request_data']
-                 ['interpretation_request_data']['json_request']
-                 ['TieredVariants']):
-                dbSNPid = variant['dbSNPid']
-                chromosome = variant['chromosome']
-                position = variant['position']
-                ref = variant['reference']
-                alt = variant['alternate']
-                # Get variant tier
-                tier = str(get_variant_tier(variant))
-                # Get the zygosities where known
-                proband_zygosity = (get_call_zygosity(
-                                    variant,
-                                    interpretation_request['simple_pedigree'],
-                                    'Proband'))
-                mother_zygosity = (get_call_zygosity(
-                                   variant,
-                                   interpretation_request['simple_pedigree'],
-                                   'Mother'))
-                father_zygosity = (get_call_zygosity(
-                                   variant,
-                                   interpretation_request['simple_pedigree'],
-                                   'Father'))
-                fout.write('\t'.join([dbSNPid, chromosome, str(position), ref,
-                           alt, tier, proband_zygosity, mother_zygosity,
-                           father_zygosity]) + '\n')
+        # Write the variants, tiers and zygosities where known
+        write_case_variant_tsv(
+            interpretation_request['interpretation_request_data'],
+            variant_tsv_path)
 
 
 def get_call_zygosity(variant, simple_pedigree, family_member):
@@ -186,11 +190,10 @@ def get_call_zygosity(variant, simple_pedigree, family_member):
             member. 'Unknown' if not present.
 
     """
-    zygosity = 'Unknown'
-    for genotype in variant['calledGenotypes']:
-        if genotype['gelId'] == simple_pedigree.get(family_member, False):
-            zygosity = genotype['genotype']
-    return zygosity
+    pedigree_index = {gel_id: relation
+                      for relation, gel_id in simple_pedigree.items()}
+    return get_call_zygosities(variant, pedigree_index,
+                               (family_member,))[family_member]
 
 
 if __name__ == '__main__':
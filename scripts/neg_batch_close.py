@@ -0,0 +1,268 @@
+import argparse
+import csv
+import datetime
+import os
+import re
+import sys
+from jellypy.pyCIPAPI.auth import get_cipapi_session
+from jellypy.pyCIPAPI.interpretation_requests import get_interpretation_request_jsons
+from jellypy.pyCIPAPI.summary_findings import create_cr, post_cr, create_flq, create_eq, put_eq, \
+    num_existing_reports, get_ref_db_versions, gel_software_versions, validate_payload, validate_payloads
+from jellypy.pyCIPAPI.transport import TokenBucket
+
+# Header of the ledger recording the outcome of each submission
+LEDGER_FIELDS = ['interpretation_request', 'step', 'status', 'message', 'timestamp']
+
+
+def parser_args():
+    """Parse arguments from the command line"""
+    parser = argparse.ArgumentParser(
+        description='Generates and submits clinical reports (summary of findings) and/or exit questionnaires for a '
+                    'batch of NegNeg cases via CIP API')
+    parser.add_argument(
+        '-c', '--csv',
+        help='CSV file with a header row and the columns interpretation_request (in the format 11111-1), reporter '
+             '(CIP-API user name, normally in the format "jbloggs") and date (YYYY-MM-DD)',
+        required=True, type=str)
+    parser.add_argument(
+        '-s', '--submit',
+        help='What to submit for each case: clinical_report, exit_questionnaire or both (default)',
+        choices=['clinical_report', 'exit_questionnaire', 'both'], default='both')
+    parser.add_argument(
+        '-l', '--ledger',
+        help='CSV ledger of successful and failed submissions. Cases already submitted successfully are skipped, so '
+             'a partial run can be resumed. Defaults to <csv>.ledger.csv',
+        type=str)
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of interpretation requests to download in parallel (default 8)', type=int, default=8)
+    parser.add_argument(
+        '-r', '--rate',
+        help='Maximum number of submissions per second (default 2)', type=float, default=2)
+    parser.add_argument(
+        '-t', '--testing',
+        help='Flag to use the CIP-API Beta data during testing', action='store_true')
+    return parser.parse_args()
+
+
+def read_batch(csv_path):
+    """Read the batch CSV, checking the format of each interpretation request ID and date"""
+    cases = []
+    with open(csv_path) as fin:
+        for row in csv.DictReader(fin):
+            # Regex to check that entered value is digits separated by -
+            if not bool(re.match(r"^\d+-\d+$", row['interpretation_request'].strip())):
+                sys.exit("Interpretation request ID {} doesn't match the format 11111-1, please check entry".format(
+                    row['interpretation_request']))
+            # Check date in correct format (YYYY-MM-DD)
+            datetime.datetime.strptime(row['date'].strip(), "%Y-%m-%d")
+            cases.append({key: value.strip() for key, value in row.items()})
+    return cases
+
+
+def read_ledger(ledger_path):
+    """Return the set of (interpretation_request, step) pairs already submitted successfully"""
+    completed = set()
+    if os.path.isfile(ledger_path):
+        with open(ledger_path) as fin:
+            for row in csv.DictReader(fin):
+                if row['status'] == 'success':
+                    completed.add((row['interpretation_request'], row['step']))
+    return completed
+
+
+class Ledger(object):
+    """Append-only CSV record of the outcome of each submission, flushed after every row"""
+
+    def __init__(self, ledger_path):
+        new_file = not os.path.isfile(ledger_path)
+        self.fout = open(ledger_path, 'a')
+        self.writer = csv.DictWriter(self.fout, fieldnames=LEDGER_FIELDS)
+        if new_file:
+            self.writer.writeheader()
+
+    def record(self, interpretation_request, step, status, message=''):
+        self.writer.writerow({
+            'interpretation_request': interpretation_request,
+            'step': step,
+            'status': status,
+            'message': message,
+            'timestamp': datetime.datetime.now().isoformat()
+        })
+        self.fout.flush()
+        print('{} {}: {} {}'.format(interpretation_request, step, status, message).strip())
+
+    def close(self):
+        self.fout.close()
+
+
+def build_clinical_report(case, ir_json_v6, testing_on=False):
+    """Create the clinical report object for a case, raising an error if it can't be submitted"""
+    ir_id, ir_version = case['interpretation_request'].split('-')
+    # Check that there is not already an exisitng clinical report
+    if num_existing_reports(ir_json_v6):
+        raise ValueError("Existing clinical reports detected")
+    return create_cr(
+        interpretationRequestId=ir_id,
+        interpretationRequestVersion=int(ir_version),
+        reportingDate=case['date'],
+        user=case['reporter'],
+        referenceDatabasesVersions=get_ref_db_versions(ir_json_v6),
+        softwareVersions=gel_software_versions(ir_json_v6, testing_on=testing_on),
+        genomicInterpretation="No tier 1 or 2 variants detected",
+        validate=False
+    )
+
+
+def build_exit_questionnaire(case, existing_reports):
+    """Create the exit questionnaire object for a case, raising an error if it can't be submitted"""
+    # Check that there is only one exisitng clinical report
+    if existing_reports != 1:
+        raise ValueError("Expected 1 clinical report but found {num}".format(num=existing_reports))
+    return create_eq(
+        eventDate=case['date'],
+        reporter=case['reporter'],
+        familyLevelQuestions=create_flq(
+            caseSolvedFamily="no",
+            segregationQuestion="no",
+            additionalComments="No tier 1 or 2 variants detected",
+            validate=False
+        ),
+        validate=False
+    )
+
+
+def cases_to_submit(cases, steps, completed):
+    """
+    Return the cases with steps still to submit, keyed by (interpretation request ID, version).
+    Duplicate rows for a case are reported, and the last one is used.
+    """
+    to_submit = {}
+    for case in cases:
+        irid = case['interpretation_request']
+        if all((irid, step) in completed for step in steps):
+            continue
+        key = tuple(irid.split('-'))
+        if key in to_submit:
+            print('Warning: {} is listed more than once, using its last row'.format(irid))
+        to_submit[key] = case
+    return to_submit
+
+
+def build_submissions(to_submit, steps, completed, ledger, max_workers=8, testing_on=False, session=None):
+    """
+    Download each case and create its reports, recording cases which can't be submitted in the ledger.
+    Returns a list of (case, ir_json_v6, reports) tuples, where reports is a list of (step, report object) in the order
+    they are submitted.
+    """
+    submissions = []
+    # Get v6 of interpretation request JSONs concurrently, creating the reports for each as it arrives
+    for ir_id, ir_version, ir_json_v6 in get_interpretation_request_jsons(
+            list(to_submit), max_workers=max_workers, reports_v6=True, testing_on=testing_on, session=session):
+        case = to_submit[(ir_id, ir_version)]
+        irid = case['interpretation_request']
+        if ir_json_v6 is None:
+            ledger.record(irid, 'download', 'failed', 'Unable to get interpretation request')
+            continue
+        reports = []
+        step = 'download'
+        try:
+            existing_reports = num_existing_reports(ir_json_v6)
+            for step in steps:
+                if (irid, step) in completed:
+                    continue
+                if step == 'clinical_report':
+                    reports.append((step, build_clinical_report(case, ir_json_v6, testing_on)))
+                    # The downloaded JSON predates the report that will be submitted
+                    existing_reports += 1
+                else:
+                    reports.append((step, build_exit_questionnaire(case, existing_reports)))
+        except Exception as e:
+            ledger.record(irid, step, 'failed', str(e).replace('\n', ' '))
+            # Don't submit an exit questionnaire for a case whose clinical report failed
+            if not reports:
+                continue
+        # post_cr only needs the case ID, so the rest of the interpretation request isn't kept for the batch
+        submissions.append((case, {'case_id': ir_json_v6.get('case_id')}, reports))
+    return submissions
+
+
+def validate_submissions(submissions, ledger):
+    """
+    Validate every report in the batch in a single pass, replacing each report object with its ValidatedPayload.
+    If any are not valid, each case is validated separately so that invalid reports are recorded in the ledger and
+    the rest of the batch can still be submitted.
+    """
+    reports = [report for case, ir_json_v6, case_reports in submissions for step, report in case_reports]
+    try:
+        payloads = iter(validate_payloads(reports))
+    except TypeError:
+        validated = []
+        for case, ir_json_v6, case_reports in submissions:
+            payloads = []
+            for step, report in case_reports:
+                try:
+                    payloads.append((step, validate_payload(report, type(report).__name__)))
+                except TypeError as e:
+                    ledger.record(case['interpretation_request'], step, 'failed', str(e).replace('\n', ' '))
+                    # Later steps depend on this one
+                    break
+            if payloads:
+                validated.append((case, ir_json_v6, payloads))
+        return validated
+    return [(case, ir_json_v6, [(step, next(payloads)) for step, report in case_reports])
+            for case, ir_json_v6, case_reports in submissions]
+
+
+def submit(submissions, ledger, rate=2, testing_on=False, session=None):
+    """Submit validated reports to the CIP-API, at no more than rate submissions per second, recording each outcome"""
+    rate_limiter = TokenBucket(rate, capacity=1) if rate else None
+    for case, ir_json_v6, payloads in submissions:
+        irid = case['interpretation_request']
+        ir_id, ir_version = irid.split('-')
+        for step, payload in payloads:
+            try:
+                if rate_limiter:
+                    rate_limiter.acquire()
+                if step == 'clinical_report':
+                    # Push clinical report to CIP-API
+                    post_cr(clinical_report=payload, ir_json_v6=ir_json_v6, testing_on=testing_on, session=session)
+                else:
+                    # Push exit questionnaire to CIP-API
+                    put_eq(exit_questionnaire=payload, ir_id=ir_id, ir_version=ir_version, testing_on=testing_on,
+                           session=session)
+            except Exception as e:
+                ledger.record(irid, step, 'failed', str(e).replace('\n', ' '))
+                # Don't submit an exit questionnaire for a case whose clinical report failed
+                break
+            ledger.record(irid, step, 'success')
+
+
+def _main(parsed_args):
+    cases = read_batch(parsed_args.csv)
+    ledger_path = parsed_args.ledger if parsed_args.ledger else parsed_args.csv + '.ledger.csv'
+    completed = read_ledger(ledger_path)
+    steps = ['clinical_report', 'exit_questionnaire'] if parsed_args.submit == 'both' else [parsed_args.submit]
+    # Skip cases where every step has already been submitted successfully
+    to_submit = cases_to_submit(cases, steps, completed)
+    print('{} of {} cases to submit'.format(len(to_submit), len(cases)))
+
+    # One pooled session is used for downloading and submitting
+    session = get_cipapi_session(testing_on=parsed_args.testing)
+    ledger = Ledger(ledger_path)
+    try:
+        submissions = build_submissions(to_submit, steps, completed, ledger, max_workers=parsed_args.workers,
+                                        testing_on=parsed_args.testing, session=session)
+        submissions = validate_submissions(submissions, ledger)
+        submit(submissions, ledger, rate=parsed_args.rate, testing_on=parsed_args.testing, session=session)
+    finally:
+        ledger.close()
+
+
+def main():
+    # Parse arguments from the command line
+    _main(parser_args())
+
+
+if __name__ == '__main__':
+    main()
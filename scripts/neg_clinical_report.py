@@ -60,7 +60,7 @@ def main():
         reportingDate=parsed_args.date,
         user=parsed_args.reporter,
         referenceDatabasesVersions=get_ref_db_versions(ir_json_v6),
-        softwareVersions=gel_software_versions(ir_json_v6),
+        softwareVersions=gel_software_versions(ir_json_v6, testing_on=parsed_args.testing),
         genomicInterpretation="No tier 1 or 2 variants detected"
     )
     # Push clinical report to CIP-API
@@ -1,48 +1,143 @@
+import argparse
 import datetime
+import sys
+from jellypy.pyCIPAPI.cache import ContentCache, case_validator
+from jellypy.pyCIPAPI.codec import dumps_text
 from jellypy.pyCIPAPI.interpretation_requests import (
-    get_interpretation_request_list, get_interpretation_request_json,
-    get_variant_tier, save_interpretation_request_list_json)
+    get_interpretation_request_json, get_interpretation_request_jsons)
+from jellypy.pyCIPAPI.selection import select_cases
+from jellypy.pyCIPAPI.snapshot import DEFAULT_FORMAT, save_case_list
+from jellypy.pyCIPAPI.variant_table import case_tier_counts
 
 
-def _main():
-    interpretation_requests_list = get_interpretation_request_list()
-    for case in interpretation_requests_list:
-        count_tiered_variants(case)
-    output_tsv(interpretation_requests_list)
-    save_interpretation_request_list_json(interpretation_requests_list)
+def parser_args():
+    """Parse arguments from the command line"""
+    parser = argparse.ArgumentParser(
+        description='Counts the tier 1, 2 and 3 variants in each interpretation request')
+    parser.add_argument(
+        '-s', '--site', nargs='+',
+        help='One or more site codes to limit the audit to, eg: RR8')
+    parser.add_argument(
+        '--sample-type',
+        help='Only audit cases of this sample type, eg: raredisease')
+    parser.add_argument(
+        '--status', nargs='+',
+        help='Only audit cases with one of these statuses, eg: sent_to_gmcs')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=8,
+        help='Number of interpretation requests to download in parallel (default 8)')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='Also export the case list snapshot as JSON')
+    return parser.parse_args()
 
 
-def count_tiered_variants(case):
-    """Count the number of variants in each tier for a case."""
-    case['T1'] = 0
-    case['T2'] = 0
-    case['T3'] = 0
-    ir_id, ir_version = case['interpretation_request_id'].split('-')
-    interpretation_request = get_interpretation_request_json(ir_id, ir_version)
-    case['interpretation-request_data'] = interpretation_request
-    for variant in (interpretation_request['interpretation_request_data']
-                    ['json_request']['TieredVariants']):
-        tier = get_variant_tier(variant)
-        case['T{}'.format(tier)] += 1
+def _main(max_workers=8, sites=None, sample_type=None, statuses=None,
+          export_json=False):
+    """Audit the tier counts of the selected cases.
+
+    Returns:
+        failures (int): Number of cases which could not be downloaded.
+    """
+    # Only list the cases matching the criteria, one query per site and status
+    interpretation_requests_list = select_cases(sites=sites,
+                                                sample_type=sample_type,
+                                                last_status=statuses,
+                                                max_workers=max_workers)
+    cases = {tuple(case['interpretation_request_id'].split('-')): case
+             for case in interpretation_requests_list}
+    # Only download cases which have changed since they were last cached.
+    # The cache is closed even if the audit fails, saving its hit times.
+    with ContentCache() as cache:
+        validators = {key: case_validator(case) for key, case in cases.items()}
+        failed, errors = set(), {}
+        # Download the interpretation requests in parallel and write each
+        # case's counts as it arrives, so only the payloads in flight are held
+        # in memory. Both files are rewritten, so running the audit again
+        # replaces them.
+        with open(audit_output_file('tsv'), 'w') as tsv, \
+                open(audit_output_file('jsonl'), 'w') as jsonl:
+            for ir_id, ir_version, interpretation_request in (
+                    get_interpretation_request_jsons(list(cases),
+                                                     max_workers=max_workers,
+                                                     cache=cache,
+                                                     validators=validators,
+                                                     errors=errors)):
+                case = cases[(ir_id, ir_version)]
+                # Leave cases which could not be downloaded out of the TSV
+                # rather than report false counts, recording the error in the
+                # JSON Lines
+                if interpretation_request is None:
+                    failed.add((ir_id, ir_version))
+                    jsonl.write(dumps_text(dict(
+                        case, audit_status='failed',
+                        error=str(errors.get((ir_id, ir_version))))) + '\n')
+                    continue
+                count_tiered_variants(case, interpretation_request)
+                del interpretation_request
+                tsv.write(tsv_line(case) + '\n')
+                jsonl.write(dumps_text(dict(case, audit_status='ok')) + '\n')
+                jsonl.flush()
+    if failed:
+        print('{} of {} interpretation requests could not be downloaded and '
+              'are missing from the audit'.format(len(failed), len(cases)))
+    # Only the full list is saved, as get_tiered_variants reuses it. The
+    # columnar snapshot lets later runs load just the columns they need.
+    if not (sites or sample_type or statuses):
+        audited_cases = [case for key, case in cases.items()
+                         if key not in failed]
+        save_case_list(audited_cases, fmt=DEFAULT_FORMAT)
+        if export_json and DEFAULT_FORMAT != 'json':
+            save_case_list(audited_cases, fmt='json')
+    return len(failed)
+
+
+def count_tiered_variants(case, interpretation_request=None):
+    """Count the number of variants in each tier for a case.
+
+    The interpretation request is downloaded if it is not supplied. Only the
+    counts are added to the case, the interpretation request itself is not
+    kept.
+    """
+    if interpretation_request is None:
+        ir_id, ir_version = case['interpretation_request_id'].split('-')
+        interpretation_request = get_interpretation_request_json(ir_id,
+                                                                 ir_version)
+    case.update(case_tier_counts(interpretation_request))
+
+
+def audit_output_file(extension):
+    """Date stamped audit output file name, eg 20200101_interpretation_request_audit.tsv"""
+    return ('{}_interpretation_request_audit.{}'
+            .format(datetime.datetime.today().strftime('%Y%m%d'), extension))
+
+
+def tsv_line(case):
+    """Format a case's audit fields as a line of the TSV (without a newline).
+
+    Fields: Gel Family ID, Number of samples, Site(s), Sample Type, Tier 1,
+    Tier 2, and Tier 3 variant counts.
+    """
+    return '\t'.join(
+        [str(n) for n in [
+            case['family_id'], case['number_of_samples'],
+            ','.join(case['sites']), case['sample_type'],
+            case['T1'], case['T2'], case['T3']]])
 
 
 def output_tsv(interpretation_requests_list):
     """Output a date stamped TSV file of the interpretation_requests_list.
 
-    Output file fields: Gel Family ID, Number of samples, Site(s), Sample Type,
-    Tier 1, Tier 2, and Tier 3 variant counts.
+    Output file fields are described in tsv_line().
     """
-    output_file = ('{}_interpretation_request_audit.tsv'
-                   .format(datetime.datetime.today().strftime('%Y%m%d')))
-    with open(output_file, 'w') as fout:
+    with open(audit_output_file('tsv'), 'w') as fout:
         for case in interpretation_requests_list:
-            line = ('\t'.join(
-                    [str(n) for n in [
-                        case['family_id'], case['number_of_samples'],
-                        ','.join(case['sites']), case['sample_type'],
-                        case['T1'], case['T2'], case['T3']]]))
-            fout.write(line + '\n')
+            fout.write(tsv_line(case) + '\n')
 
 
 if __name__ == '__main__':
-    _main()
+    parsed_args = parser_args()
+    failures = _main(max_workers=parsed_args.workers, sites=parsed_args.site,
+                     sample_type=parsed_args.sample_type,
+                     statuses=parsed_args.status, export_json=parsed_args.json)
+    sys.exit(1 if failures else 0)
@@ -1,29 +1,58 @@
 #!/usr/bin/python
 """
- 
- Script to compare the variants in two vcf files, to ensure the 
- variants are the same. Everythig is compared but data in the 
+
+ Script to compare the variants in two vcf files, to ensure the
+ variants are the same. Everythig is compared but data in the
  info field
 
+ Records are matched on (chrom, pos, ref, alt). If both files are
+ bgzipped and tabix indexed the contigs are compared in parallel,
+ otherwise both files are streamed in a single sorted merge. Files
+ which aren't sorted in the same contig order are compared by
+ looking up every record of vcf file 1 in the records of vcf file 2.
+ Records repeated within a file are reported as duplicates.
+
+ In fingerprint mode each file is read once to compute a digest of
+ every contig, and only contigs whose digests differ are compared
+ record by record. Digests are cached next to the vcf files.
+
 
  Kim Brugger (10 Jan 2018), contact: kim@brugger.dk
 """
 
 import sys
+import os
+import json
+import hashlib
 import argparse
+import itertools
+import multiprocessing
 import pprint
+from collections import namedtuple
 pp = pprint.PrettyPrinter(indent=4)
 
 import pysam
 
 
+# A variant present in only one file, present in both with differing fields, or repeated within a file
+Discordance = namedtuple('Discordance', ['chrom', 'pos', 'ref', 'alts', 'kind', 'fields'])
+
+# Suffix of the file the fingerprint of a vcf is cached in
+FINGERPRINT_SUFFIX = '.fingerprint.json'
+
+
+class UnsortedRecordsError(ValueError):
+    """ records are not sorted in the contig order of the vcf headers, so can't be compared in a sorted merge """
+    pass
+
+
 
 def handle_error( error, exit_on_error = False):
     """ Print the error, and if flag is set exits
 
     Args:
        error (str): error string to print
-       exit_on_error (bool): default false, if true terminates the program after printing the error 
+       exit_on_error (bool): default false, if true terminates the program after printing the error
 
     """
     print( "{}".format(error))
@@ -33,98 +62,497 @@ def handle_error( error, exit_on_error = False):
 
 
 
-def next_vcf_rec( vcf_handle ):
-    """ reads next vcf record, or returns none
+def compare_vcfs( vcf_file1, vcf_file2, exit_on_error = False, processes = None):
+    """ compare variants and sample information in two vcfs to ensure their integrity
+
+    Args:
+       vcf_file1 (str): filename of vcf file nr 1
+       vcf_file2 (str): filename of vcf file nr 2
+       exit_on_error (bool): stop comparing at the first discordant variant
+       processes (int): number of processes comparing contigs in parallel, defaults to the number of cpus.
+                        Only used when both files are tabix indexed
+
+    Returns:
+       dict with keys:
+          samples_match (bool): whether both files have the same samples in the same order
+          compared (int): number of distinct (chrom, pos, ref, alt) variants compared
+          discordances (list): Discordance tuples in file order
+          sorted (bool): whether the records were compared in a sorted merge, rather than by key
+    """
+
+    vcf1 = pysam.VariantFile( vcf_file1 )
+    vcf2 = pysam.VariantFile( vcf_file2 )
+
+    vcf1_samples = list(vcf1.header.samples)
+    vcf2_samples = list(vcf2.header.samples)
+    # Only samples present in both files can be compared record by record
+    samples = [ sample for sample in vcf1_samples if sample in vcf2_samples ]
+    contigs = contig_order( vcf1, vcf2 )
+
+    indexed = vcf1.index is not None and vcf2.index is not None
+    is_sorted = True
+    max_discordances = 1 if exit_on_error else None
+    if ( indexed and not exit_on_error ):
+        vcf1.close()
+        vcf2.close()
+        jobs = [ (vcf_file1, vcf_file2, contig, samples, contigs) for contig in contigs ]
+        pool = multiprocessing.Pool( processes )
+        try:
+            results = pool.map( compare_contig, jobs )
+        finally:
+            pool.close()
+            pool.join()
+        compared = sum( result[0] for result in results )
+        discordances = [ discordance for result in results for discordance in result[1] ]
+    else:
+        try:
+            compared, discordances = compare_records( vcf1, vcf2, samples, contigs, max_discordances )
+        except UnsortedRecordsError as error:
+            handle_error( "{}, comparing records by key instead".format( error ))
+            is_sorted = False
+            compared, discordances = compare_keyed( vcf_file1, vcf_file2, samples, max_discordances = max_discordances )
+        finally:
+            vcf1.close()
+            vcf2.close()
+
+    return { 'samples_match': vcf1_samples == vcf2_samples,
+             'compared': compared,
+             'discordances': discordances,
+             'sorted': is_sorted }
+
+
+def contig_order( vcf1, vcf2 ):
+    """ contigs from both vcf headers, in vcf1 header order followed by any only in vcf2
+
+    Records are only merged in this order if both files are sorted in it, see compare_records.
+
+    Args:
+      vcf1 (obj): pysam vcf handle
+      vcf2 (obj): pysam vcf handle
+
+    Returns:
+      list of contig names
+    """
+    contigs = list(vcf1.header.contigs)
+    contigs += [ contig for contig in vcf2.header.contigs if contig not in vcf1.header.contigs ]
+    return contigs
+
+
+def compare_contig( job ):
+    """ compare the records on one contig of two tabix indexed vcfs, run in a worker process
+
+    Args:
+      job (tuple): vcf_file1, vcf_file2, contig, samples, contigs
+
+    Returns:
+      tuple of number of variants compared and list of discordances
+    """
+    vcf_file1, vcf_file2, contig, samples, contigs = job
+    vcf1 = pysam.VariantFile( vcf_file1 )
+    vcf2 = pysam.VariantFile( vcf_file2 )
+    try:
+        return compare_records( fetch_contig( vcf1, contig ), fetch_contig( vcf2, contig ), samples, contigs )
+    finally:
+        vcf1.close()
+        vcf2.close()
+
+
+def fetch_contig( vcf_handle, contig ):
+    """ records on a contig from an indexed vcf, or none if the contig is not in the index
 
     Args:
       vcf_handle (obj): pysam vcf handle
+      contig (str): contig name
 
     """
     try:
-        vcf_rec = vcf_handle.next()
-        return vcf_rec
-    except:
-        return None
+        return vcf_handle.fetch( contig )
+    except ValueError:
+        return iter([])
 
 
-def compare_vcfs( vcf_file1, vcf_file2, exit_on_error = False):
-    """ compare variants and sample information in two vcfs to ensure their integrity
-    
+def compare_records( records1, records2, samples, contigs, max_discordances = None ):
+    """ sorted merge of two streams of vcf records, comparing records with the same (chrom, pos, ref, alt)
+
+    Records are grouped by position, ordering contigs as in the vcf headers, so records at the same
+    position are matched on their alleles regardless of their order in the files. Records repeated
+    within a file are reported as duplicates and compared once.
+
     Args:
-       vcf_file1 (str): filename of vcf file nr 1
-       vcf_file2 (str): filename of vcf file nr 2
-       exit_on_error (bool): print error and exit program on first found error
-    
+      records1 (iter): pysam vcf records from vcf file 1
+      records2 (iter): pysam vcf records from vcf file 2
+      samples (list): samples to compare
+      contigs (list): contig names in sort order
+      max_discordances (int): stop after this many discordances, default compare everything
+
     Returns:
-       list of disconcodant variants
+      tuple of number of variants compared and list of discordances
+
+    Raises:
+      UnsortedRecordsError: if either file is not sorted in the contig order, eg the vcf headers list
+                            contigs in different orders. Compare the files with compare_keyed instead.
     """
+    contig_rank = dict( (contig, rank) for rank, contig in enumerate(contigs) )
+
+    def position( rec ):
+        return ( contig_rank.get( rec.chrom, len(contig_rank) ), rec.chrom, rec.pos )
+
+    groups1 = sorted_groups( records1, position, 'vcf file 1' )
+    groups2 = sorted_groups( records2, position, 'vcf file 2' )
+    group1 = next( groups1, None )
+    group2 = next( groups2, None )
+
+    compared = 0
+    discordances = []
+    while ( group1 is not None or group2 is not None ):
+        # Take the records at the earliest position from either or both files
+        if ( group2 is None or ( group1 is not None and group1[0] < group2[0] )):
+            recs1, recs2 = list(group1[1]), []
+            group1 = next( groups1, None )
+        elif ( group1 is None or group2[0] < group1[0] ):
+            recs1, recs2 = [], list(group2[1])
+            group2 = next( groups2, None )
+        else:
+            recs1, recs2 = list(group1[1]), list(group2[1])
+            group1 = next( groups1, None )
+            group2 = next( groups2, None )
+
+        alleles1 = index_records( recs1, 'vcf1', discordances )
+        alleles2 = index_records( recs2, 'vcf2', discordances )
+        for key in sorted( set(alleles1) | set(alleles2) ):
+            compared += 1
+            discordance = compare_variant( key, alleles1.get( key ), alleles2.get( key ), samples )
+            if ( discordance ):
+                discordances.append( discordance )
+            if ( max_discordances is not None and len(discordances) >= max_discordances ):
+                return compared, discordances[ :max_discordances ]
+
+    return compared, discordances
 
+
+def compare_keyed( vcf_file1, vcf_file2, samples, contigs = None, max_discordances = None ):
+    """ compare two vcfs in any record order, by looking up each record of vcf file 1 in the records of vcf file 2
+
+    The records of vcf file 2 are held in memory, so this is only used when the files can't be merged.
+
+    Args:
+      vcf_file1 (str): filename of vcf file nr 1
+      vcf_file2 (str): filename of vcf file nr 2
+      samples (list): samples to compare
+      contigs (set): only compare records on these contigs, default compare everything
+      max_discordances (int): stop after this many discordances, default compare everything
+
+    Returns:
+      tuple of number of variants compared and list of discordances, in vcf file 1 order followed by
+      variants only in vcf file 2
+    """
+    discordances = []
+    compared = 0
+    seen = set()
     vcf1 = pysam.VariantFile( vcf_file1 )
     vcf2 = pysam.VariantFile( vcf_file2 )
+    try:
+        alleles2 = index_records( ( rec for rec in vcf2 if contigs is None or rec.chrom in contigs ),
+                                  'vcf2', discordances )
+        for rec in vcf1:
+            if ( contigs is not None and rec.chrom not in contigs ):
+                continue
+            key = record_key( rec )
+            if ( key in seen ):
+                discordances.append( Discordance( key[0], key[1], key[2], key[3], 'duplicate_in_vcf1', [] ))
+            else:
+                seen.add( key )
+                compared += 1
+                discordance = compare_variant( key, rec, alleles2.pop( key, None ), samples )
+                if ( discordance ):
+                    discordances.append( discordance )
+            if ( max_discordances is not None and len(discordances) >= max_discordances ):
+                return compared, discordances[ :max_discordances ]
+    finally:
+        vcf1.close()
+        vcf2.close()
+
+    # Records left in vcf file 2 didn't match any in vcf file 1
+    for key in alleles2:
+        compared += 1
+        discordances.append( compare_variant( key, None, alleles2[ key ], samples ))
+        if ( max_discordances is not None and len(discordances) >= max_discordances ):
+            break
+
+    return compared, discordances[ :max_discordances ]
+
+
+def sorted_groups( records, position, name ):
+    """ group records by position, checking that the positions only increase
+
+    Args:
+      records (iter): pysam vcf records
+      position (function): sort key of a record
+      name (str): name of the file in errors
+
+    Raises:
+      UnsortedRecordsError: if a position is not after the position before it
+    """
+    previous = None
+    for key, group in itertools.groupby( records, position ):
+        if ( previous is not None and key <= previous ):
+            raise UnsortedRecordsError( "Records in {} are not sorted in vcf header contig order at {}:{}".format(
+                name, key[1], key[2] ))
+        previous = key
+        yield key, group
+
+
+def record_key( rec ):
+    """ the (chrom, pos, ref, alts) a record is matched on """
+    return ( rec.chrom, rec.pos, rec.ref, tuple(rec.alts or ()) )
+
+
+def index_records( records, name, discordances ):
+    """ records keyed by (chrom, pos, ref, alts), adding a discordance for every repeated record
+
+    Args:
+      records (iter): pysam vcf records
+      name (str): vcf1 or vcf2, used in the discordance kind
+      discordances (list): list the duplicate discordances are added to
+
+    Returns:
+      dict of key to the first record with that key
+    """
+    indexed = {}
+    for rec in records:
+        key = record_key( rec )
+        if ( key in indexed ):
+            discordances.append( Discordance( key[0], key[1], key[2], key[3], 'duplicate_in_{}'.format( name ), [] ))
+        else:
+            indexed[ key ] = rec
+    return indexed
+
+
+def compare_variant( key, vcf1_rec, vcf2_rec, samples ):
+    """ discordance for a variant, or none if it is in both files with the same fields
+
+    Args:
+      key (tuple): chrom, pos, ref, alts of the variant
+      vcf1_rec (obj): pysam vcf record from vcf file 1, or none if it is not in the file
+      vcf2_rec (obj): pysam vcf record from vcf file 2, or none if it is not in the file
+      samples (list): samples to compare
+
+    """
+    if ( vcf2_rec is None ):
+        return Discordance( key[0], key[1], key[2], key[3], 'only_in_vcf1', [] )
+    if ( vcf1_rec is None ):
+        return Discordance( key[0], key[1], key[2], key[3], 'only_in_vcf2', [] )
+    fields = compare_fields( vcf1_rec, vcf2_rec, samples )
+    if ( fields ):
+        return Discordance( key[0], key[1], key[2], key[3], 'mismatch', fields )
+    return None
+
+
+def compare_fields( vcf1_rec, vcf2_rec, samples ):
+    """ compare everything but the info field of two records for the same variant
+
+    Args:
+      vcf1_rec (obj): pysam vcf record from vcf file 1
+      vcf2_rec (obj): pysam vcf record from vcf file 2
+      samples (list): samples to compare
 
-    vcf1_samples = vcf1.header.samples
-    vcf2_samples = vcf2.header.samples
+    Returns:
+      list of names of the fields which differ
+    """
+    errors = []
+    if ( vcf1_rec.id != vcf2_rec.id ):
+        errors.append('ID')
+
+    # Some odd rounding errors and making strings into float bug,
+    # so as long as the qual score is with in +/- 1 I am happy
+    # with it.
+    if ( vcf1_rec.qual is None or vcf2_rec.qual is None ):
+        if ( vcf1_rec.qual != vcf2_rec.qual ):
+            errors.append('qual')
+    elif ( abs(vcf1_rec.qual - vcf2_rec.qual) > 1 ):
+        errors.append('qual')
+
+    if ( list(vcf1_rec.filter) != list(vcf2_rec.filter) ):
+        errors.append('filter')
 
-    vcf1_rec = vcf1.next()
-    vcf2_rec = vcf2.next()
-            
+    if ( list(vcf1_rec.format) != list(vcf2_rec.format) ):
+        errors.append('format')
 
-    if ( list(vcf1_samples) != list(vcf2_samples) ):
-        error  = "Sample name differs. VCF1: [{}], VCF2: [{}]".format(",".join(list(vcf1_samples)), ",".join(list(vcf2_samples)))
-#        errors = handle_error( error, errors, exit_on_error  )
+    for sample in samples:
+        if ( dict(vcf1_rec.samples[ sample ].items()) != dict(vcf2_rec.samples[ sample ].items()) ):
+            errors.append('sample {}'.format( sample ))
 
-    while ( vcf1_rec is not None and vcf2_rec is not None ):
+    return errors
 
-        error_string= "{type}\n[%s]\n[%s]" % (vcf1_rec, vcf2_rec)
-#        print error_string
-        errors = []
-        # Check on the various fields and append to the error list that is printed later on.
-        if ( vcf1_rec.chrom != vcf2_rec.chrom ):
-            errors.append('chromosome')
 
-        if ( vcf1_rec.pos != vcf2_rec.pos ):
-            errors.append('chromosome')
+def vcf_fingerprint( vcf_file, use_cache = True ):
+    """ digest of the variants and sample fields (everything but info) on each contig of a vcf
+
+    The digest is computed in a single sequential read of the file. It is cached in a
+    <vcf_file>.fingerprint.json file, which is reused while the size and modification
+    time of the vcf are unchanged.
+
+    Args:
+      vcf_file (str): filename of vcf file
+      use_cache (bool): read and write the cached fingerprint, default True
 
-        if ( vcf1_rec.id != vcf2_rec.id ):
-            errors.append('ID')
+    Returns:
+      dict of contig name to [hex digest, number of records]
+    """
+    stat = os.stat( vcf_file )
+    cache_file = vcf_file + FINGERPRINT_SUFFIX
+    if ( use_cache and os.path.isfile( cache_file )):
+        try:
+            with open( cache_file ) as fin:
+                cached = json.load( fin )
+            if ( cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime ):
+                return cached['contigs']
+        except (ValueError, KeyError, IOError, OSError):
+            pass
+
+    vcf = pysam.VariantFile( vcf_file )
+    samples = list(vcf.header.samples)
+    digests = {}
+    counts = {}
+    for rec in vcf:
+        if ( rec.chrom not in digests ):
+            digests[ rec.chrom ] = hashlib.sha1()
+            counts[ rec.chrom ] = 0
+        digests[ rec.chrom ].update( normalise_record( rec, samples ).encode('utf-8') )
+        counts[ rec.chrom ] += 1
+    vcf.close()
+    contigs = dict( (contig, [digest.hexdigest(), counts[ contig ]]) for contig, digest in digests.items() )
+
+    if ( use_cache ):
+        try:
+            with open( cache_file, 'w' ) as fout:
+                json.dump( {'size': stat.st_size, 'mtime': stat.st_mtime, 'contigs': contigs}, fout )
+        except (IOError, OSError):
+            # Not being able to cache the fingerprint, eg in a read only directory, is fine
+            pass
+
+    return contigs
+
+
+def normalise_record( rec, samples ):
+    """ a string of every field of a record but info, used for fingerprinting
+
+    Qual is rounded so small rounding differences are less likely to change a digest.
+
+    Args:
+      rec (obj): pysam vcf record
+      samples (list): samples to include
+
+    Returns:
+      str: one line representation of the record
+    """
+    qual = '.' if rec.qual is None else str(int(round( rec.qual )))
+    fields = [ rec.chrom, str(rec.pos), rec.id or '.', rec.ref, ",".join( rec.alts or () ), qual,
+               ";".join( rec.filter ), ":".join( rec.format ) ]
+    fields += [ repr(sorted( rec.samples[ sample ].items() )) for sample in samples ]
+    return "\t".join( fields ) + "\n"
 
-        if ( vcf1_rec.alts != vcf2_rec.alts ):
-            errors.append('Alts')
 
-        # Some odd rounding errors and making strings into float bug,
-        # so as long as the qual score is with in +/- 1 I am happy
-        # with it.
-        if ( abs(vcf1_rec.qual - vcf2_rec.qual) > 1 ):
-            if ( vcf1_rec.qual != vcf2_rec.qual ):
-                errors.append('qual')
+def fingerprint_compare( vcf_file1, vcf_file2, exit_on_error = False, processes = None, use_cache = True ):
+    """ compare two vcfs by contig digest, only comparing records on contigs whose digests differ
 
-            if ( vcf1_rec.filter != vcf2_rec.filter ):
-                errors.append('filter')
+    Args:
+       vcf_file1 (str): filename of vcf file nr 1
+       vcf_file2 (str): filename of vcf file nr 2
+       exit_on_error (bool): stop comparing at the first discordant variant
+       processes (int): number of processes to use, defaults to the number of cpus
+       use_cache (bool): read and write cached fingerprints, default True
 
-            if ( list(vcf1_rec.format) != list(vcf2_rec.format) ):
-                errors.append('format')
+    Returns:
+       dict as returned by compare_vcfs, plus:
+          contigs_checked (list): contigs whose digests differed and were compared record by record
+    """
+    pool = multiprocessing.Pool( processes )
+    try:
+        fingerprint1, fingerprint2 = pool.starmap( vcf_fingerprint, [( vcf_file1, use_cache ), ( vcf_file2, use_cache )] )
+    finally:
+        pool.close()
+        pool.join()
 
-            for sample in vcf1_samples:
-                if ( vcf1_rec.samples[ sample] != vcf2_rec.samples[ sample] ):
-                    errors.append('sample {}'.format( sample ))
+    vcf1 = pysam.VariantFile( vcf_file1 )
+    vcf2 = pysam.VariantFile( vcf_file2 )
+    vcf1_samples = list(vcf1.header.samples)
+    vcf2_samples = list(vcf2.header.samples)
+    samples = [ sample for sample in vcf1_samples if sample in vcf2_samples ]
+    contigs = contig_order( vcf1, vcf2 )
+    contigs += sorted( (set(fingerprint1) | set(fingerprint2)) - set(contigs) )
+
+    # Contigs with the same digest in both files hold identical variants
+    differing = [ contig for contig in contigs if fingerprint1.get( contig ) != fingerprint2.get( contig ) ]
+    compared = sum( fingerprint1[ contig ][1] for contig in contigs
+                    if contig in fingerprint1 and contig not in differing )
+    discordances = []
+    is_sorted = True
+    max_discordances = 1 if exit_on_error else None
+
+    if ( not differing ):
+        pass
+    elif ( vcf1.index is not None and vcf2.index is not None and not exit_on_error ):
+        jobs = [ (vcf_file1, vcf_file2, contig, samples, contigs) for contig in differing ]
+        pool = multiprocessing.Pool( processes )
+        try:
+            results = pool.map( compare_contig, jobs )
+        finally:
+            pool.close()
+            pool.join()
+        compared += sum( result[0] for result in results )
+        discordances = [ discordance for result in results for discordance in result[1] ]
+    else:
+        differing_contigs = set( differing )
+        records1 = ( rec for rec in vcf1 if rec.chrom in differing_contigs )
+        records2 = ( rec for rec in vcf2 if rec.chrom in differing_contigs )
+        try:
+            contig_compared, discordances = compare_records( records1, records2, samples, contigs, max_discordances )
+        except UnsortedRecordsError as error:
+            handle_error( "{}, comparing records by key instead".format( error ))
+            is_sorted = False
+            contig_compared, discordances = compare_keyed( vcf_file1, vcf_file2, samples, differing_contigs,
+                                                           max_discordances )
+        compared += contig_compared
+    vcf1.close()
+    vcf2.close()
+
+    return { 'samples_match': vcf1_samples == vcf2_samples,
+             'compared': compared,
+             'discordances': discordances,
+             'sorted': is_sorted,
+             'contigs_checked': differing }
+
+
+def print_report( report, exit_on_error = False ):
+    """ print a comparison report from compare_vcfs
 
-            if (errors ):
-                errors = handle_error( error_string.format( type="Error(s) on: {}".format( ", ".join(errors))), exit_on_error  )
+    Args:
+      report (dict): output of compare_vcfs
+      exit_on_error (bool): exit after printing the first discordance
 
-                
-        # Track the positions in the vcf files so one does not come ahead of the other 
-        if ( vcf1_rec.pos > vcf2_rec.pos ):
-            vcf2_rec = next_vcf_rec(vcf2 )
-        elif( vcf1_rec.pos < vcf2_rec.pos ):
-            vcf1_rec = next_vcf_rec( vcf1 )
+    """
+    if ( not report['samples_match'] ):
+        handle_error( "Sample names differ between the vcf files" )
+
+    for discordance in report['discordances']:
+        variant = "{}:{} {}>{}".format( discordance.chrom, discordance.pos, discordance.ref,
+                                        ",".join( discordance.alts ))
+        if ( discordance.kind == 'mismatch' ):
+            error = "Error(s) on: {} [{}]".format( ", ".join( discordance.fields ), variant )
         else:
-            vcf1_rec = next_vcf_rec( vcf1 )
-            vcf2_rec = next_vcf_rec( vcf2 )
+            error = "Variant {} [{}]".format( discordance.kind.replace('_', ' '), variant )
+        handle_error( error, exit_on_error )
+
+    print( "{} variants compared, {} discordant".format( report['compared'], len(report['discordances'])))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='vcf_integrity_check: checks the variants and sample information in two vcf files are identical ')
 
     parser.add_argument('-e', '--exit-on-error', action="store_true", default=False,  help="exit on first error observed, defualt FALSE")
+    parser.add_argument('-f', '--fingerprint', action="store_true", default=False,  help="compare contig digests first and only compare records on contigs which differ, default FALSE")
+    parser.add_argument('-p', '--processes', type=int, default=None,  help="processes to compare contigs of tabix indexed vcfs with, default number of cpus")
     parser.add_argument('vcf_file', metavar='vcf-file', nargs=2,   help="vcf files compare")
 
     args = parser.parse_args()
@@ -133,5 +561,11 @@ if __name__ == '__main__':
     vcf1 = args.vcf_file[ 0 ]
     vcf2 = args.vcf_file[ 1 ]
 
-    compare_vcfs( vcf1, vcf2, args.exit_on_error)
+    if ( args.fingerprint ):
+        report = fingerprint_compare( vcf1, vcf2, args.exit_on_error, args.processes)
+    else:
+        report = compare_vcfs( vcf1, vcf2, args.exit_on_error, args.processes)
+    print_report( report, args.exit_on_error )
 
+    if ( report['discordances'] or not report['samples_match'] ):
+        sys.exit(1)